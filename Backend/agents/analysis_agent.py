@@ -1,145 +1,150 @@
 # agents/analysis_agent.py
-from llm import stream_llm_analysis
+from llm import stream_llm_analysis, astream_llm_analysis
 import pandas as pd
 import numpy as np
-import re
-
-def analyze_data_stream(df: pd.DataFrame, user_query: str):
+import asyncio
+from prompts import prompts
+from stats_engine import result_profile
+from anomalies import describe_anomalies
+from sampling import sample_rows
+from agents.prompt_builder import (
+    ANALYSIS_PROMPT_TOKEN_BUDGET, MAX_SAMPLE_ROWS,
+    relevant_columns, encode_rows, fit_rows, estimate_tokens, log_prompt_size
+)
+
+def build_analysis_prompt(df: pd.DataFrame, user_query: str, sql: str = "",
+                          token_budget: int = ANALYSIS_PROMPT_TOKEN_BUDGET,
+                          sql_params: dict = None, target_engine=None, truncated: bool = False,
+                          profile: dict = None, anomalies: list = None, sample: pd.DataFrame = None) -> str:
+    """
+    Statistics, sample rows and formatting rules for the analysis model.
+    Only columns relevant to the question and SQL are shown, and sample rows
+    are added as compact TSV until the prompt reaches `token_budget`.
+    Statistics come from `profile` if given, else from stats_engine, which
+    covers the full result when it knows the engine the SQL ran on.
+    `anomalies` are the result's flagged declarations from anomalies.flagged_in_result.
+    Sample rows come from `sample` if given, else from sampling.sample_rows.
+    """
+    columns = relevant_columns(df, user_query, sql)
+    numeric_cols = df.select_dtypes(include=['number', 'int64', 'float64']).columns
+    text_cols = df.select_dtypes(include=['object']).columns
+
+    if profile is None:
+        profile = result_profile(df, sql, columns, sql_params, target_engine, truncated)
+    total_rows = profile["row_count"]
     
-    if df.empty:
-        yield "⚠️ No data returned for this query."
-        return
-
-    try:
-        
-        total_rows = len(df)
+    # Build stats strings
+    stats_str = ""
+    for col, stats in profile["numeric"].items():
+        stats_str += f"\n• {col}: Min={stats['min']:,.2f}, Max={stats['max']:,.2f}, Avg={stats['mean']:,.2f}"
+        # unit prices carry their spread, which is what under/over-invoicing shows up in
+        if "percentiles" in stats:
+            stats_str += f", Median={stats['median']:,.2f}" + "".join(
+                f", {name.upper()}={value:,.2f}" for name, value in stats["percentiles"].items()
+            )
     
-        # Calculate statistics for numeric columns
-        stats_summary = {}
-        numeric_cols = df.select_dtypes(include=['number', 'int64', 'float64']).columns
-        
-        for col in numeric_cols:
-            try:
-                clean_col = df[col].dropna()
-                
-                if len(clean_col) > 0:
-                    stats_summary[col] = {
-                        'count': len(clean_col),
-                        'mean': float(clean_col.mean()),
-                        'min': float(clean_col.min()),
-                        'max': float(clean_col.max()),
-                        'sum': float(clean_col.sum()),
-                        'median': float(clean_col.median())
-                    }
-            except Exception as col_error:
-                print(f"⚠️ Skipping column {col}: {col_error}")
-                continue
-        
-        # Get unique counts for text columns
-        text_stats = {}
-        text_cols = df.select_dtypes(include=['object']).columns
-        for col in text_cols[:5]:
-            try:
-                text_stats[col] = {
-                    'unique_count': int(df[col].nunique()),
-                    'top_value': str(df[col].mode()[0]) if len(df[col].mode()) > 0 else 'N/A'
-                }
-            except:
-                continue
-        
-        # Increased sample size for better analysis
-        sample_size = min(100, len(df))
-        data_sample = df.head(sample_size).fillna('NULL').to_dict(orient="records")
-        
-        # Build stats strings
-        stats_str = ""
-        for col, stats in list(stats_summary.items())[:5]:
-            stats_str += f"\n• {col}: Min={stats['min']:,.2f}, Max={stats['max']:,.2f}, Avg={stats['mean']:,.2f}"
-        
-        text_stats_str = ""
-        for col, stats in list(text_stats.items())[:3]:
-            text_stats_str += f"\n• {col}: {stats['unique_count']} unique values"
-        
-        # Enhanced prompt with explicit newline instructions
-        prompt = f"""You are an Expert on Post Custom Audit Analysis, You are given the information of Customs Import Stats of Pakistan ports, all the monetary value is dealt in PKR .
-                Analyze this customs import data. You MUST use proper newlines between all sections and bullet points.
-
-USER QUESTION: {user_query}
-
-DATA OVERVIEW:
-- Total Records: {total_rows:,}
-- Columns Available: {len(df.columns)}
-- Numeric Columns: {len(numeric_cols)}
-- Text Columns: {len(text_cols)}
-
-KEY STATISTICS:{stats_str}
-
-TEXT FIELD SUMMARY:{text_stats_str}
-
-SAMPLE DATA (first {sample_size} rows):
-{data_sample}
-
-PROVIDE YOUR ANALYSIS IN THIS EXACT FORMAT (with newlines after each line):
+    text_stats_str = ""
+    for col, stats in profile["text"].items():
+        text_stats_str += f"\n• {col}: {stats['unique_count']} unique values"
 
+    anomalies_str = describe_anomalies(anomalies) if anomalies else " none flagged"
+    
+    # Enhanced prompt with explicit newline instructions
+    def render(data_sample: str, sample_size: int) -> str:
+        return (
+            prompts.ANALYSIS_PROMPT_TEMPLATE
+            .replace("{{total_rows}}", f"{total_rows:,}")
+            .replace("{{column_count}}", str(len(df.columns)))
+            .replace("{{numeric_count}}", str(len(numeric_cols)))
+            .replace("{{text_count}}", str(len(text_cols)))
+            .replace("{{stats}}", stats_str)
+            .replace("{{text_stats}}", text_stats_str)
+            .replace("{{anomalies}}", anomalies_str)
+            .replace("{{sample_size}}", str(sample_size))
+            .replace("{{data_sample}}", data_sample)
+            .replace("{{user_query}}", user_query)
+        )
+
+    # Whatever the instructions and statistics leave of the budget goes to sample rows
+    if sample is None:
+        sample = sample_rows(df, sql, columns, sql_params, target_engine, truncated)
+    lines = encode_rows(sample[[c for c in columns if c in sample.columns]], MAX_SAMPLE_ROWS)
+    data_sample, sample_size = fit_rows(lines, token_budget - estimate_tokens(render("", 0)))
+    prompt = render(data_sample, sample_size)
+
+    log_prompt_size(
+        "Analysis", prompt,
+        rows=f"{sample_size}/{total_rows}", columns=f"{len(columns)}/{len(df.columns)}", budget=token_budget
+    )
+    return prompt
+
+def fallback_analysis(df: pd.DataFrame, error: Exception) -> str:
+    """Canned analysis shown when the analysis engine fails"""
+    return f"""
 📊 KEY COUNTS
-• [First count]
-• [Second count]
-• [Third count]
+• Total Records: {len(df):,}
+• Columns: {len(df.columns)}
+• Data successfully retrieved
 
 📈 PATTERNS OBSERVED
-• [First pattern]
-• [Second pattern]
-• [Third pattern]
+• Query executed successfully
+• {len(df):,} records match your criteria
 
 ⚠️ ANOMALIES OR RED FLAGS
-• [First anomaly]
-• [Second anomaly]
+• Analysis engine error: {str(error)[:100]}
+• Raw data is available for manual review
 
 💡 RECOMMENDATIONS
-• [First recommendation]
-• [Second recommendation]
+• Check the data sample above
+• Try refining your query for better results
+• Contact support if error persists
+"""
 
-CRITICAL FORMATTING RULES:
-1. Add TWO newlines after each section header (📊, 📈, ⚠️, 💡)
-2. Add ONE newline after each bullet point (•)
-3. Each section must be separated by a blank line
-4. Do NOT run sections together
-5. Be concise but informative
-6. Focus on: "{user_query}"
+# First characters of a section header (⚠️ is ⚠ followed by a variation selector)
+SECTION_HEADER_STARTS = frozenset("📊📈💡⚠\ufe0f🔍")
 
-Begin now with proper formatting:"""
+def section_spacing(token: str, previous_token: str) -> str:
+    """Smart newline insertion: what to emit before `token` so headers and bullets start a line"""
+    # Called for every token: a set lookup on the first character instead of a regex
+    if not previous_token or previous_token[-1] == '\n':
+        return ''
+    first = token[0]
+
+    # If we see an emoji header without newlines before it, add them
+    if first in SECTION_HEADER_STARTS:
+        return '\n\n'  # Add spacing before new section
+    
+    # If current token is a bullet and previous wasn't a newline, add one
+    if first == '•':
+        return '\n'
+    return ''
+
+def analyze_data_stream(df: pd.DataFrame, user_query: str, sql: str = ""):
+    
+    if df.empty:
+        yield "⚠️ No data returned for this query."
+        return
+
+    try:
+        prompt = build_analysis_prompt(df, user_query, sql)
 
         token_count = 0
-        has_content = False
-        buffer = ""
         previous_token = ""
         
         print("🔄 Starting analysis stream...")
         
         for token in stream_llm_analysis(prompt):
             if token and token.strip():
-                has_content = True
                 token_count += 1
                 
-                # Smart newline insertion logic
-                # If we see an emoji header without newlines before it, add them
-                if re.match(r'^[📊📈💡⚠️🔍]', token) and previous_token and not previous_token.endswith('\n'):
-                    yield '\n\n'  # Add spacing before new section
-                
-                # If current token is a bullet and previous wasn't a newline, add one
-                if token.startswith('•') and previous_token and not previous_token.endswith('\n'):
-                    yield '\n'
+                spacing = section_spacing(token, previous_token)
+                if spacing:
+                    yield spacing
                 
                 yield token
                 previous_token = token
         
         print(f"✅ Streamed {token_count} tokens")
-        
-        # If no content was streamed, use fallback
-        # if not has_content:
-        #     print("⚠️ No content from streaming, using fallback...")
-        #     for token in stream_llm_analysis_fallback(prompt):
-        #         yield token
                 
     except Exception as e:
         print(f"❌ Analysis error: {e}")
@@ -147,24 +152,65 @@ Begin now with proper formatting:"""
         traceback.print_exc()
         
         try:
-            yield f"""
-📊 KEY COUNTS
-• Total Records: {len(df):,}
-• Columns: {len(df.columns)}
-• Data successfully retrieved
-
-📈 PATTERNS OBSERVED
-• Query executed successfully
-• {len(df):,} records match your criteria
+            yield fallback_analysis(df, e)
+        except:
+            yield "\n\n❌ Critical error in analysis. Please check backend logs."
+
+async def aanalyze_data_stream(df: pd.DataFrame, user_query: str, sql: str = "", outcome: dict = None,
+                               sql_params: dict = None, target_engine=None, truncated: bool = False,
+                               profile=None, anomalies=None, sample=None):
+    """
+    Async analyze_data_stream for the async /query pipeline.
+    The statistics are computed in a worker thread, off the event loop;
+    `profile` may be a future shared with the visualization agent, and
+    `anomalies` a future of the result's flagged declarations and `sample`
+    a future of its sample rows, also shared with the visualization agent.
+    outcome["complete"] is set once the model's analysis streamed to the end
+    (not the canned fallback), i.e. when the text is worth caching.
+    """
+    if df.empty:
+        yield "⚠️ No data returned for this query."
+        return
 
-⚠️ ANOMALIES OR RED FLAGS
-• Analysis engine error: {str(e)[:100]}
-• Raw data is available for manual review
+    try:
+        if profile is not None and not isinstance(profile, dict):
+            profile = await profile
+        if anomalies is not None and not isinstance(anomalies, list):
+            anomalies = await anomalies
+        if sample is not None and not isinstance(sample, pd.DataFrame):
+            sample = await sample
+        prompt = await asyncio.to_thread(
+            build_analysis_prompt, df, user_query, sql,
+            sql_params=sql_params, target_engine=target_engine, truncated=truncated, profile=profile,
+            anomalies=anomalies, sample=sample
+        )
 
-💡 RECOMMENDATIONS
-• Check the data sample above
-• Try refining your query for better results
-• Contact support if error persists
-"""
+        token_count = 0
+        previous_token = ""
+        
+        print("🔄 Starting analysis stream...")
+        
+        async for token in astream_llm_analysis(prompt):
+            if token and token.strip():
+                token_count += 1
+                
+                spacing = section_spacing(token, previous_token)
+                if spacing:
+                    yield spacing
+                
+                yield token
+                previous_token = token
+        
+        print(f"✅ Streamed {token_count} tokens")
+        if outcome is not None:
+            outcome["complete"] = True
+                
+    except Exception as e:
+        print(f"❌ Analysis error: {e}")
+        import traceback
+        traceback.print_exc()
+        
+        try:
+            yield fallback_analysis(df, e)
         except:
             yield "\n\n❌ Critical error in analysis. Please check backend logs."
\ No newline at end of file
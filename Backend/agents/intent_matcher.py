@@ -0,0 +1,377 @@
+# agents/intent_matcher.py
+import os
+import re
+import threading
+from collections import Counter
+
+from db import quote_identifier
+from rollups import rollup_table, measure_alias, GD_COLUMN, PRICE_COLUMN, DECLARED_PRICE_COLUMN
+from fts import fts_table
+
+# Answer everyday question shapes with fixed SQL instead of asking the SQL model
+INTENT_MATCHER_ENABLED = os.getenv("INTENT_MATCHER_ENABLED", "1") == "1"
+
+DEFAULT_TOP_N = 10
+MAX_TOP_N = 100
+
+# Words that add nothing to a matched question ("show me all records for HS code 8513").
+# Anything else left over means the question asks for more than a template can answer.
+FILLER_WORDS = {
+    "a", "all", "an", "and", "any", "are", "by", "case", "cases", "consignments", "customs", "data",
+    "declaration", "declarations", "detail", "details", "display", "entries", "every", "fetch", "find",
+    "for", "from", "gd", "gds", "get", "give", "goods", "have", "import", "imported", "imports", "in",
+    "is", "item", "items", "list", "me", "of", "on", "please", "record", "records", "rows", "see",
+    "shipments", "show", "that", "the", "their", "there", "to", "transactions", "under", "what", "which",
+    "with",
+}
+
+HS_PATTERN = re.compile(
+    r"\b(?:hs|pct)(?:[\s_-]*code)?\s*(?:no\.?|number|#)?\s*[:=-]?\s*(\d{4}(?:\.\d{1,4})?)(?![\d.])", re.IGNORECASE
+)
+NTN_PATTERN = re.compile(r"\bntn\s*(?:no\.?|number|#)?\s*[:=-]?\s*(\d[\d-]{3,}\d)\b", re.IGNORECASE)
+IMPORTER_PATTERN = re.compile(
+    r"\b(?:importer|company|firm)\b\s*(?:named|called|name)?\s*[:=-]?\s*[\"']?"
+    r"([A-Za-z0-9][A-Za-z0-9&/.,' -]*?)[\"']?"
+    r"(?=\s+(?:from|with|for|in|by|hs|pct|ntn|origin|originating|imported)\b|\s*[?.!]*\s*$)",
+    re.IGNORECASE
+)
+COUNTRY_PATTERN = re.compile(
+    r"\b(?:from|origin(?:\s+country)?\s*[:=-]?|originating\s+(?:in|from)|made\s+in)\s+([A-Za-z][A-Za-z .'-]*)",
+    re.IGNORECASE
+)
+TOP_PATTERN = re.compile(
+    r"\b(?:top|largest|biggest|highest|leading)\s+(\d{1,3})?\s*"
+    r"(importers?|hs[\s_-]*codes?|pct[\s_-]*codes?|origin\s+countries|countries|origins?|sros?)\b"
+    r"(?:\s+by\s+(value|assessed\s+value|import\s+value|customs\s+duty|duty|sales\s+tax|income\s+tax|"
+    r"total\s+tax|taxes|tax|total|count|number\s+of\s+declarations|declarations|gds?))?",
+    re.IGNORECASE
+)
+PRICE_PATTERN = re.compile(
+    r"\b(?:unit\s+)?price\s+discrepan\w*|\bdiscrepan\w*(?:\s+in\s+(?:unit\s+)?prices?)?|\bunder[\s-]?invoic\w*"
+    r"|\bover[\s-]?invoic\w*|\bmis[\s-]?declar\w*|\bdeclared\s+vs\.?\s+assessed(?:\s+prices?)?"
+    r"|\baudit[\s-]?prone|\bsuspicious",
+    re.IGNORECASE
+)
+
+# entity word -> (dimension columns, rollup suffix)
+TOP_ENTITIES = {
+    "importer": (["IMPORTER NAME", "NTN"], "importer"),
+    "hs": (["HS CODE"], "hs"),
+    "pct": (["HS CODE"], "hs"),
+    "countr": (["ORIGIN COUNTRY"], "origin"),
+    "origin": (["ORIGIN COUNTRY"], "origin"),
+    "sro": (["SRO"], "sro"),
+}
+
+# "by ..." word -> measure column (None ranks by number of declarations)
+TOP_MEASURES = {
+    "value": "ASSESSED IMPORT VALUE RS",
+    "customs duty": "Customs Duty PAID",
+    "duty": "Customs Duty PAID",
+    "sales tax": "Sales Tax PAID",
+    "income tax": "Income Tax PAID",
+    "total tax": "Total",
+    "taxes": "Total",
+    "tax": "Total",
+    "total": "Total",
+}
+
+
+class IntentStats:
+    """How many questions each template answered and why the rest went to the model."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.questions = 0
+        self.matched = Counter()
+        self.fell_through = Counter()
+
+    def record(self, intent: str = None, reason: str = None):
+        with self._lock:
+            self.questions += 1
+            if intent:
+                self.matched[intent] += 1
+            else:
+                self.fell_through[reason or "no_template"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            matched = sum(self.matched.values())
+            return {
+                "enabled": INTENT_MATCHER_ENABLED,
+                "questions": self.questions,
+                "matched": matched,
+                "match_rate": round(matched / self.questions, 3) if self.questions else None,
+                "by_intent": dict(self.matched),
+                "fell_through": dict(self.fell_through),
+            }
+
+
+intent_stats = IntentStats()
+
+
+def hs_code_range(code: str):
+    """8513 -> [8513, 8514), 8513.10 -> [8513.1, 8513.11): a prefix as a range the index can seek."""
+    decimals = len(code.split(".")[1]) if "." in code else 0
+    low = float(code)
+    return low, round(low + 10 ** -decimals, decimals)
+
+
+def _resolve_country(candidate: str, countries):
+    """
+    Longest run of leading words that names a known origin country, as
+    (every spelling of it in the data, words used). Uploads mix "CHINA" and "China".
+    """
+    words = candidate.split()
+    known = {}
+    for country in countries:
+        if isinstance(country, str):
+            known.setdefault(country.strip().lower(), []).append(country)
+    for length in range(min(len(words), 4), 0, -1):
+        name = " ".join(words[:length]).rstrip(".,'").lower()
+        if name in known:
+            return known[name], length
+    return None, 0
+
+
+def _extract_filters(question: str, context: dict):
+    """
+    Filters the question states, as (filters, consumed spans).
+    Each filter is (kind, value) with kind in hs / ntn / importer / country.
+    """
+    filters, spans = [], []
+
+    for match in HS_PATTERN.finditer(question):
+        filters.append(("hs", match.group(1)))
+        spans.append(match.span())
+    for match in NTN_PATTERN.finditer(question):
+        filters.append(("ntn", match.group(1)))
+        spans.append(match.span())
+    for match in IMPORTER_PATTERN.finditer(question):
+        name = match.group(1).strip(" .,'")
+        if name:
+            filters.append(("importer", name))
+            spans.append(match.span())
+    for match in COUNTRY_PATTERN.finditer(question):
+        spellings, used = _resolve_country(match.group(1), context.get("countries", []))
+        if spellings:
+            # consume the keyword plus only the words that named the country
+            words = list(re.finditer(r"\S+", match.group(1)))
+            end = match.start(1) + words[used - 1].end()
+            filters.append(("country", spellings[0] if len(spellings) == 1 else tuple(spellings)))
+            spans.append((match.start(), end))
+    return filters, spans
+
+
+def _leftover_words(question: str, spans):
+    kept, last = [], 0
+    for start, end in sorted(spans):
+        kept.append(question[last:start])
+        last = max(last, end)
+    kept.append(question[last:])
+    words = re.findall(r"[a-z0-9]+", " ".join(kept).lower())
+    return [w for w in words if w not in FILLER_WORDS]
+
+
+def _where(filters, context: dict, alias: str = ""):
+    """WHERE clauses and bind parameters for the filters, or None if a column is missing."""
+    columns = set(context.get("columns", []))
+    prefix = f"{alias}." if alias else ""
+    clauses, params = [], {}
+    counts = Counter()
+
+    for kind, value in filters:
+        counts[kind] += 1
+        n = counts[kind]
+        if kind == "hs":
+            if "HS CODE" not in columns:
+                return None
+            params[f"hs_low_{n}"], params[f"hs_high_{n}"] = hs_code_range(value)
+            column = f'{prefix}{quote_identifier("HS CODE")}'
+            clauses.append(f"{column} >= :hs_low_{n} AND {column} < :hs_high_{n}")
+        elif kind == "ntn":
+            if "NTN" not in columns:
+                return None
+            params[f"ntn_{n}"] = value
+            clauses.append(f'{prefix}{quote_identifier("NTN")} = :ntn_{n}')
+        elif kind == "importer":
+            if "IMPORTER NAME" not in columns:
+                return None
+            if "IMPORTER NAME" in context.get("fulltext_columns", []):
+                fts = quote_identifier(fts_table(context["table"]))
+                params[f"importer_{n}"] = '"IMPORTER NAME" : "' + value.replace('"', '""') + '"'
+                clauses.append(f"{prefix}rowid IN (SELECT rowid FROM {fts} WHERE {fts} MATCH :importer_{n})")
+            else:
+                params[f"importer_{n}"] = f"%{value}%"
+                clauses.append(f'{prefix}{quote_identifier("IMPORTER NAME")} LIKE :importer_{n}')
+        elif kind == "country":
+            if "ORIGIN COUNTRY" not in columns:
+                return None
+            # an IN list still seeks the origin index, unlike COLLATE NOCASE
+            spellings = value if isinstance(value, tuple) else (value,)
+            names = [f"country_{n}_{i}" for i in range(len(spellings))]
+            params.update(zip(names, spellings))
+            clauses.append(
+                f'{prefix}{quote_identifier("ORIGIN COUNTRY")} IN ({", ".join(":" + name for name in names)})'
+            )
+
+    return clauses, params
+
+
+def _filter_sql(filters, context: dict):
+    where = _where(filters, context)
+    if where is None:
+        return None
+    clauses, params = where
+    sql = f"SELECT * FROM {quote_identifier(context['table'])} WHERE {' AND '.join(clauses)}"
+    return sql, params
+
+
+def _top_sql(match, filters, context: dict):
+    columns = set(context.get("columns", []))
+    table = context["table"]
+    limit = min(int(match.group(1) or DEFAULT_TOP_N), MAX_TOP_N)
+    entity = match.group(2).lower()
+    dims, suffix = next(v for k, v in TOP_ENTITIES.items() if entity.startswith(k))
+    by = re.sub(r"\s+", " ", (match.group(3) or "value").lower())
+    by = {"assessed value": "value", "import value": "value"}.get(by, by)
+    measure = TOP_MEASURES.get(by)
+
+    if not set(dims) <= columns or (measure and measure not in columns) or (not measure and GD_COLUMN not in columns):
+        return None
+
+    dim_list = ", ".join(quote_identifier(d) for d in dims)
+    rank_by = measure_alias(measure) if measure else "gd_count"
+    metrics = ["row_count", "gd_count"] + [measure_alias(m) for m in dict.fromkeys(
+        [TOP_MEASURES["value"], measure]) if m and m in columns]
+
+    rollup = rollup_table(table, suffix)
+    if not filters and rollup in context.get("tables", ()) and GD_COLUMN in columns:
+        sql = (
+            f"SELECT {dim_list}, {', '.join(metrics)} FROM {quote_identifier(rollup)} "
+            f"ORDER BY {rank_by} DESC LIMIT :top_n"
+        )
+        return sql, {"top_n": limit}
+
+    where = _where(filters, context)
+    if where is None:
+        return None
+    clauses, params = where
+    aggregates = ["COUNT(*) AS row_count"]
+    if GD_COLUMN in columns:
+        aggregates.append(f"COUNT(DISTINCT {quote_identifier(GD_COLUMN)}) AS gd_count")
+    for m in dict.fromkeys([TOP_MEASURES["value"], measure]):
+        if m and m in columns:
+            aggregates.append(f"SUM({quote_identifier(m)}) AS {measure_alias(m)}")
+    sql = f"SELECT {dim_list}, {', '.join(aggregates)} FROM {quote_identifier(table)}"
+    if clauses:
+        sql += f" WHERE {' AND '.join(clauses)}"
+    sql += f" GROUP BY {dim_list} ORDER BY {rank_by} DESC LIMIT :top_n"
+    params["top_n"] = limit
+    return sql, params
+
+
+def _price_discrepancy_sql(filters, context: dict):
+    """
+    Declarations under the filters with declared vs assessed unit price, and the
+    assessed price against the median for the same HS code, origin and unit.
+    Largest deviations first.
+    """
+    columns = set(context.get("columns", []))
+    table = context["table"]
+    needed = [GD_COLUMN, PRICE_COLUMN, DECLARED_PRICE_COLUMN]
+    if not set(needed) <= columns:
+        return None
+    where = _where(filters, context, alias="c")
+    if where is None:
+        return None
+    clauses, params = where
+
+    shown = [c for c in [
+        GD_COLUMN, "IMPORTER NAME", "NTN", "HS CODE", "ITEM DESCRIPTION", "ORIGIN COUNTRY", "ASSD UNIT",
+        "ASSD QTY", DECLARED_PRICE_COLUMN, PRICE_COLUMN, "ASSD CURR", "ASSESSED IMPORT VALUE RS",
+    ] if c in columns]
+    price = f"c.{quote_identifier(PRICE_COLUMN)}"
+    declared = f"c.{quote_identifier(DECLARED_PRICE_COLUMN)}"
+    select = [f"c.{quote_identifier(c)}" for c in shown] + [
+        f"{price} - {declared} AS price_gap",
+        f"ROUND({price} / NULLIF({declared}, 0), 3) AS assessed_to_declared",
+    ]
+    order = [f"ABS(COALESCE({price} / NULLIF({declared}, 0), 1) - 1) DESC"]
+    join = ""
+
+    dims = ["HS CODE", "ORIGIN COUNTRY", "ASSD UNIT"]
+    rollup = rollup_table(table, "hs_origin_unit")
+    if rollup in context.get("tables", ()) and set(dims) <= columns:
+        join = f" LEFT JOIN {quote_identifier(rollup)} AS r ON " + " AND ".join(
+            f"r.{quote_identifier(d)} = c.{quote_identifier(d)}" for d in dims
+        )
+        select += [
+            "r.p50_unit_price AS median_unit_price",
+            f"ROUND({price} / NULLIF(r.p50_unit_price, 0), 3) AS price_to_median",
+        ]
+        order.append(f"ABS(COALESCE({price} / NULLIF(r.p50_unit_price, 0), 1) - 1) DESC")
+
+    sql = (
+        f"SELECT {', '.join(select)} FROM {quote_identifier(table)} AS c{join} "
+        f"WHERE {' AND '.join(clauses)} ORDER BY {', '.join(order)}"
+    )
+    return sql, params
+
+
+def match_intent(question: str, context: dict):
+    """
+    SQL for a question that fits one of the fixed templates, else None.
+    `context` is the schema registry state (columns, tables, countries,
+    full-text columns). Returns {"intent", "sql", "params", "filters"}.
+    Every question is counted in intent_stats.
+    """
+    if not INTENT_MATCHER_ENABLED or not context.get("columns"):
+        return None
+
+    price = PRICE_PATTERN.search(question)
+    top = TOP_PATTERN.search(question)
+    # filters are read from the rest, so "top 5 importers" isn't taken for an importer name
+    shape = price or top
+    rest = question
+    if shape:
+        start, end = shape.span()
+        rest = question[:start] + " " * (end - start) + question[end:]
+    filters, spans = _extract_filters(rest, context)
+
+    if price:
+        intent = "price_discrepancy"
+        spans.append(price.span())
+        # a discrepancy check without an HS code is too open-ended for a template
+        if not any(kind == "hs" for kind, _ in filters):
+            intent_stats.record(reason="price_without_hs_code")
+            return None
+    elif top:
+        intent = "top_n"
+        spans.append(top.span())
+    elif filters:
+        intent = "filter"
+    else:
+        intent_stats.record(reason="no_template")
+        return None
+
+    leftover = _leftover_words(question, spans)
+    if leftover:
+        intent_stats.record(reason="extra_conditions")
+        print(f"🧭 Intent {intent} skipped, question also says: {' '.join(leftover[:8])}")
+        return None
+
+    if intent == "price_discrepancy":
+        built = _price_discrepancy_sql(filters, context)
+    elif intent == "top_n":
+        built = _top_sql(top, filters, context)
+    else:
+        built = _filter_sql(filters, context)
+    if built is None:
+        intent_stats.record(reason="missing_columns")
+        return None
+
+    sql, params = built
+    intent_stats.record(intent)
+    print(f"🧭 Matched intent {intent} {filters}")
+    return {"intent": intent, "sql": sql, "params": params, "filters": filters}
@@ -0,0 +1,110 @@
+# agents/prompt_builder.py
+import math
+import os
+import re
+
+import pandas as pd
+
+# Rough budget for everything the analysis model reads before answering
+ANALYSIS_PROMPT_TOKEN_BUDGET = int(os.getenv("ANALYSIS_PROMPT_TOKEN_BUDGET", "6000"))
+
+# Most columns kept in the sample and statistics; wide SELECT * results are trimmed to these
+MAX_PROMPT_COLUMNS = int(os.getenv("MAX_PROMPT_COLUMNS", "12"))
+
+# Upper bound on sample rows, before the token budget cuts it further
+MAX_SAMPLE_ROWS = 100
+
+# Item descriptions can run to hundreds of characters; the start is enough to recognise goods
+MAX_TEXT_CHARS = int(os.getenv("PROMPT_MAX_TEXT_CHARS", "60"))
+
+# English/code text averages about four characters per token for GPT-style tokenizers
+CHARS_PER_TOKEN = 4
+
+# Identify a declaration or its goods; kept whenever the result has them
+KEY_COLUMNS = ["GD_NO_Complete", "IMPORTER NAME", "HS CODE", "ITEM DESCRIPTION"]
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _words(text: str):
+    return set(re.findall(r"[a-z0-9]+", (text or "").lower()))
+
+
+def relevant_columns(df: pd.DataFrame, user_query: str, sql: str = "", max_columns: int = MAX_PROMPT_COLUMNS):
+    """
+    Up to `max_columns` columns worth showing the model, in result order.
+    Preference goes to columns the SQL filters, groups or orders on, then
+    those the question mentions, then identifying key columns.
+    """
+    columns = list(df.columns)
+    if len(columns) <= max_columns:
+        return columns
+
+    # Every result column is in the select list; what follows FROM shows
+    # what the query filters, groups and orders on
+    sql_lower = re.sub(r"\s+", " ", sql or "").lower()
+    clauses = sql_lower.split(" from ", 1)[1] if " from " in sql_lower else ""
+    question_words = _words(user_query)
+
+    def score(column):
+        name = str(column)
+        value = 0
+        if name.lower() in clauses:
+            value += 3
+        column_words = _words(name)
+        if column_words and column_words & question_words:
+            value += 2
+        if name in KEY_COLUMNS:
+            value += 1
+        return value
+
+    ranked = sorted(columns, key=lambda c: -score(c))  # stable: ties keep result order
+    keep = set(ranked[:max_columns])
+    return [c for c in columns if c in keep]
+
+
+def compact_value(value, max_text_chars: int = MAX_TEXT_CHARS) -> str:
+    """One cell as short TSV-safe text."""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    if isinstance(value, float):
+        if value.is_integer():
+            return str(int(value))
+        # four decimals keeps HS codes stored as numbers (8513.1011) intact
+        return f"{value:.4f}".rstrip("0").rstrip(".")
+    text = re.sub(r"\s+", " ", str(value)).strip()
+    if len(text) > max_text_chars:
+        text = text[:max_text_chars - 1] + "…"
+    return text
+
+
+def encode_rows(df: pd.DataFrame, max_rows: int = MAX_SAMPLE_ROWS, max_text_chars: int = MAX_TEXT_CHARS):
+    """Header line plus one tab-separated line per row."""
+    header = "\t".join(compact_value(c, max_text_chars) for c in df.columns)
+    lines = [header]
+    for row in df.head(max_rows).itertuples(index=False, name=None):
+        lines.append("\t".join(compact_value(v, max_text_chars) for v in row))
+    return lines
+
+
+def fit_rows(lines, budget_tokens: int):
+    """
+    As many encoded rows as fit in `budget_tokens`, header included.
+    Returns (TSV text, number of data rows kept).
+    """
+    budget_chars = max(0, budget_tokens) * CHARS_PER_TOKEN
+    kept = [lines[0]]
+    used = len(lines[0]) + 1
+    for line in lines[1:]:
+        if used + len(line) + 1 > budget_chars:
+            break
+        kept.append(line)
+        used += len(line) + 1
+    return "\n".join(kept), len(kept) - 1
+
+
+def log_prompt_size(name: str, prompt: str, **details):
+    extra = ", ".join(f"{key}={value}" for key, value in details.items())
+    print(f"🧾 {name} prompt ≈{estimate_tokens(prompt):,} tokens ({len(prompt):,} chars{', ' + extra if extra else ''})")
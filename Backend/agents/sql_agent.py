@@ -1,19 +1,32 @@
 # agents/sql_agent.py
-from llm import generate_llm_response
-from db import engine, get_schema
+from llm import generate_llm_response, agenerate_llm_response
+from db import get_schema
 import pandas as pd
 from sqlalchemy import text
 from prompts import prompts
 import json
 
-def generate_sql(schema, user_query: str):
+def build_sql_system_prompt(schema, rollups: str = "", fulltext: str = ""):
     system_prompt = prompts.SQL_GENERATOR_SYSTEM_PROMPT
     schema_str = json.dumps(schema, indent=2)
     system_prompt = system_prompt.replace("{{schema}}", schema_str)
+    system_prompt = system_prompt.replace("{{rollups}}", rollups)
+    system_prompt = system_prompt.replace("{{fulltext}}", fulltext)
+    return system_prompt
+
+def generate_sql(schema, user_query: str, rollups: str = "", fulltext: str = "", system_prompt: str = None):
+    # The schema registry passes a prompt it has already rendered for the current schema
+    if system_prompt is None:
+        system_prompt = build_sql_system_prompt(schema, rollups, fulltext)
 
     # return call_llm(system_prompt, user_query)
     return generate_llm_response(system_prompt, user_query)
 
+async def agenerate_sql(schema, user_query: str, rollups: str = "", fulltext: str = "", system_prompt: str = None):
+    if system_prompt is None:
+        system_prompt = build_sql_system_prompt(schema, rollups, fulltext)
+    return await agenerate_llm_response(system_prompt, user_query)
+
 def sanitize_sql(sql: str) -> str:
     
     # Remove any literal backslashes at the end of lines
@@ -1,37 +1,58 @@
 import json
-from llm import generate_llm_response
+import pandas as pd
+import asyncio
+from llm import generate_llm_response, agenerate_llm_response
 from prompts import prompts
+from sampling import sample_rows
 
-def generate_visualization_code(df, user_query: str, analysis_summary: str = ""):
+# Sample rows shown with the data context; enough to show the columns' shape and scale
+VISUALIZATION_SAMPLE_ROWS = 5
+
+def build_visualization_prompts(df, user_query: str, analysis_summary: str = "", profile: dict = None,
+                                sample=None):
     """
-    Generate matplotlib code for visualizing the data
+    (system prompt, user prompt) asking for matplotlib code for this data.
+    With a stats_engine `profile` the row count and statistics describe the
+    full result rather than the fetched rows, and describe() is skipped.
+    Sample rows come from `sample` (sampling.sample_rows) or are drawn from df.
     """
+    if sample is None:
+        sample = sample_rows(df, n=VISUALIZATION_SAMPLE_ROWS * 4)
+    # evenly spaced through the sample: some price extremes, some typical rows
+    step = max(1, len(sample) // VISUALIZATION_SAMPLE_ROWS)
     system_prompt = prompts.VISUALIZATION_GENERATOR_SYSTEM_PROMPT
     
     # Prepare data context
     data_context = {
         "columns": df.columns.tolist(),
         "dtypes": {col: str(dtype) for col, dtype in df.dtypes.items()},
-        "row_count": len(df),
-        "sample_data": df.head(5).to_dict(orient="records"),
+        "row_count": profile["row_count"] if profile else len(df),
+        "sample_data": sample.iloc[::step].head(VISUALIZATION_SAMPLE_ROWS).to_dict(orient="records"),
         "numeric_columns": df.select_dtypes(include=['number']).columns.tolist(),
         "categorical_columns": df.select_dtypes(include=['object', 'category']).columns.tolist()
     }
     
     # Add statistical info for numeric columns
-    if data_context["numeric_columns"]:
+    if profile and profile["numeric"]:
+        data_context["statistics"] = {
+            col: {key: stats[key] for key in ("count", "mean", "std", "min", "median", "max")}
+            for col, stats in profile["numeric"].items()
+        }
+        if profile["text"]:
+            data_context["top_values"] = {col: stats["top_values"] for col, stats in profile["text"].items()}
+    elif data_context["numeric_columns"]:
         stats = df[data_context["numeric_columns"]].describe().to_dict()
         data_context["statistics"] = stats
     
-    context_str = json.dumps(data_context, indent=2)
+    context_str = json.dumps(data_context, indent=2, default=str)
     system_prompt = system_prompt.replace("{{data_context}}", context_str)
     
+    # Without a summary (viz generated in parallel with the analysis) the data context alone drives the chart
+    summary_section = f"Analysis Summary: {analysis_summary}\n\n" if analysis_summary else ""
     user_prompt = f"""
 User Query: {user_query}
 
-Analysis Summary: {analysis_summary}
-
-Generate Python code using matplotlib to create an appropriate visualization for this data.
+{summary_section}Generate Python code using matplotlib to create an appropriate visualization for this data.
 The code should:
 1. Be complete and executable
 2. Save the plot to a file named 'visualization.png'
@@ -41,5 +62,26 @@ The code should:
 
 Return ONLY the Python code, no explanations.
 """
-    
-    return generate_llm_response(system_prompt, user_prompt)
\ No newline at end of file
+    return system_prompt, user_prompt
+
+def generate_visualization_code(df, user_query: str, analysis_summary: str = ""):
+    """
+    Generate matplotlib code for visualizing the data
+    """
+    system_prompt, user_prompt = build_visualization_prompts(df, user_query, analysis_summary)
+    return generate_llm_response(system_prompt, user_prompt)
+
+async def agenerate_visualization_code(df, user_query: str, analysis_summary: str = "", profile=None,
+                                       sample=None):
+    """
+    Async generate_visualization_code; the prompt is built in a worker thread.
+    `profile` and `sample` may be futures shared with the analysis agent.
+    """
+    if profile is not None and not isinstance(profile, dict):
+        profile = await profile
+    if sample is not None and not isinstance(sample, pd.DataFrame):
+        sample = await sample
+    system_prompt, user_prompt = await asyncio.to_thread(
+        build_visualization_prompts, df, user_query, analysis_summary, profile, sample
+    )
+    return await agenerate_llm_response(system_prompt, user_prompt)
\ No newline at end of file
@@ -0,0 +1,432 @@
+# anomalies.py
+import json
+import math
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+from db import read_engine, quote_identifier
+from query_executor import validate_sql, FETCH_BATCH_ROWS, PROGRESS_HANDLER_OPS
+from rollups import AFFECTED_TABLE, GD_COLUMN, PRICE_COLUMN, DECLARED_PRICE_COLUMN
+
+# Price norms per HS code, unit, origin and currency; smaller groups fall back to HS code + unit + currency
+BASELINE_KEYS = ["HS CODE", "ASSD UNIT", "ORIGIN COUNTRY", "ASSD CURR"]
+POOLED_KEYS = ["HS CODE", "ASSD UNIT", "ASSD CURR"]
+ANOMALY_MIN_GROUP_SIZE = int(os.getenv("ANOMALY_MIN_GROUP_SIZE", "5"))
+
+# Modified z-score (Iglewicz-Hoaglin) beyond which a log unit price is an outlier
+ANOMALY_Z_THRESHOLD = float(os.getenv("ANOMALY_Z_THRESHOLD", "3.5"))
+# Declared unit price at least this share below the assessed one
+ANOMALY_GAP_THRESHOLD = float(os.getenv("ANOMALY_GAP_THRESHOLD", "0.2"))
+IQR_FENCE = 1.5
+MAD_SCALE = 1.4826
+# Floor for the log-price spread: many groups have one ruling price and a MAD of 0
+MIN_LOG_SPREAD = 0.05
+
+# Flagged declarations shown to the analysis model
+ANALYSIS_ANOMALY_ROWS = 10
+ANOMALY_LOOKUP_TIMEOUT_SECONDS = 5.0
+
+CONTEXT_COLUMNS = [GD_COLUMN, "IMPORTER NAME", "NTN", "ITEM DESCRIPTION", "ASSD QTY", "ASSESSED IMPORT VALUE RS"]
+
+STAT_COLUMNS = ["n", "median", "q1", "q3", "mad"]
+BASELINE_STAT_COLUMNS = ["level"] + STAT_COLUMNS
+SCORE_COLUMNS = [
+    ("baseline_level", "TEXT"), ("baseline_n", "INTEGER"), ("baseline_median", "REAL"),
+    ("fence_low", "REAL"), ("fence_high", "REAL"), ("z_declared", "REAL"), ("z_assessed", "REAL"),
+    ("price_gap", "REAL"), ("score", "REAL"), ("value_at_risk_rs", "REAL"), ("flags", "TEXT"),
+]
+# HS codes an append touched, kept for the anomaly stage after the rollup refresh
+AFFECTED_CODES_TABLE = "_anomaly_affected_hs"
+
+
+def baseline_table(table: str) -> str:
+    return f"{table}_price_baselines"
+
+
+def anomaly_table(table: str) -> str:
+    return f"{table}_price_anomalies"
+
+
+def _table_columns(conn, table: str):
+    return [r[1] for r in conn.execute(f"PRAGMA table_info({quote_identifier(table)})").fetchall()]
+
+
+def _column_types(conn, table: str):
+    return {r[1]: r[2] or "" for r in conn.execute(f"PRAGMA table_info({quote_identifier(table)})").fetchall()}
+
+
+def _match(keys, left: str, right: str) -> str:
+    return " AND ".join(f"{left}.{quote_identifier(k)} IS {right}.{quote_identifier(k)}" for k in keys)
+
+
+def capture_affected_codes(conn) -> bool:
+    """
+    Keep the HS codes of an append's affected rows, recorded by
+    rollups.capture_affected(), before refresh_rollups() drops them.
+    Returns False when nothing was captured.
+    """
+    conn.execute(f"DROP TABLE IF EXISTS temp.{AFFECTED_CODES_TABLE}")
+    captured = conn.execute(f"PRAGMA temp.table_info({AFFECTED_TABLE})").fetchall()
+    if "HS CODE" not in [r[1] for r in captured]:
+        return False
+    conn.execute(
+        f'CREATE TEMP TABLE {AFFECTED_CODES_TABLE} AS SELECT DISTINCT "HS CODE" FROM temp.{AFFECTED_TABLE}'
+    )
+    return True
+
+
+def _insert_baselines(conn, table: str, source: str, keys, all_keys, level: str):
+    """
+    One baseline row per group of `keys` in `source`: its size, then the
+    median and quartiles of the assessed unit price by nearest rank. Ranks
+    of prices and of log prices are the same, so no log is needed in SQL.
+    """
+    key_list = ", ".join(quote_identifier(k) for k in keys)
+    source_keys = ", ".join(f"c.{quote_identifier(k)}" for k in keys)
+    price = quote_identifier(PRICE_COLUMN)
+
+    def rank(p):
+        return f"MAX(CASE WHEN _rank = CAST({p} * (_n - 1) AS INTEGER) + 1 THEN price END)"
+
+    targets = ", ".join(quote_identifier(k) for k in all_keys)
+    values = ", ".join(quote_identifier(k) if k in keys else "NULL" for k in all_keys)
+    conn.execute(f"""
+        INSERT INTO {quote_identifier(baseline_table(table))} ({targets}, level, n, median, q1, q3)
+        SELECT {values}, ?, MAX(_n), {rank(0.5)}, {rank(0.25)}, {rank(0.75)}
+        FROM (
+            SELECT {source_keys}, c.{price} AS price,
+                   ROW_NUMBER() OVER (PARTITION BY {source_keys} ORDER BY c.{price}) AS _rank,
+                   COUNT(*) OVER (PARTITION BY {source_keys}) AS _n
+            FROM {source} WHERE c.{price} > 0
+        )
+        GROUP BY {key_list}
+    """, (level,))
+
+
+def _fill_mad(conn, table: str, keys, level: str):
+    """
+    Median absolute deviation of the log price for the baselines inserted
+    since the last call (mad still NULL). |log p - log m| = log max(p/m, m/p),
+    so the ranking is done on price ratios and only the medians are logged.
+    """
+    name = quote_identifier(baseline_table(table))
+    price = f"c.{quote_identifier(PRICE_COLUMN)}"
+    ratio = f"MAX({price} / b.median, b.median / {price})"
+    rows = conn.execute(f"""
+        SELECT bid, MAX(CASE WHEN _rank = CAST(0.5 * (_n - 1) AS INTEGER) + 1 THEN ratio END)
+        FROM (
+            SELECT b.rowid AS bid, {ratio} AS ratio,
+                   ROW_NUMBER() OVER (PARTITION BY b.rowid ORDER BY {ratio}) AS _rank,
+                   COUNT(*) OVER (PARTITION BY b.rowid) AS _n
+            FROM {name} AS b JOIN {quote_identifier(table)} AS c ON {_match(keys, "b", "c")}
+            WHERE b.level = ? AND b.mad IS NULL AND {price} > 0
+        )
+        GROUP BY bid
+    """, (level,)).fetchall()
+    conn.executemany(f"UPDATE {name} SET mad = ? WHERE rowid = ?", [(math.log(r), bid) for bid, r in rows])
+    return len(rows)
+
+
+def score_batch(frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    Score a batch of rows against the baselines joined onto them (o_* for
+    the full key, p_* pooled), all vectorised, and return the flagged ones.
+    Scores are on the modified z-score scale: flagged rows score at least
+    ANOMALY_Z_THRESHOLD.
+    """
+    def numeric(column):
+        if column not in frame:
+            return np.full(len(frame), np.nan)
+        return pd.to_numeric(frame[column], errors="coerce").to_numpy(dtype=np.float64)
+
+    # Full-key baselines where the group is big enough, pooled ones otherwise
+    use_full = numeric("o_n") >= ANOMALY_MIN_GROUP_SIZE
+    use_pooled = ~use_full & (numeric("p_n") >= ANOMALY_MIN_GROUP_SIZE)
+
+    def stat(name):
+        return np.where(use_full, numeric(f"o_{name}"), np.where(use_pooled, numeric(f"p_{name}"), np.nan))
+
+    n, mad = stat("n"), stat("mad")
+    median, q1, q3 = np.log(stat("median")), np.log(stat("q1")), np.log(stat("q3"))
+    spread = np.maximum(np.maximum(mad, (q3 - q1) / 1.349 / MAD_SCALE), MIN_LOG_SPREAD) * MAD_SCALE
+    # the same floor on the fences, which are reported for context only
+    fence_width = IQR_FENCE * np.maximum(q3 - q1, 1.349 * MIN_LOG_SPREAD * MAD_SCALE)
+
+    assessed, declared = numeric(PRICE_COLUMN), numeric(DECLARED_PRICE_COLUMN)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        log_assessed = np.log(np.where(assessed > 0, assessed, np.nan))
+        log_declared = np.log(np.where(declared > 0, declared, np.nan))
+        z_assessed = (log_assessed - median) / spread
+        z_declared = (log_declared - median) / spread
+        gap = np.where((assessed > 0) & (declared > 0), 1 - declared / assessed, np.nan)
+
+    flags = {
+        "declared_below_assessed": gap >= ANOMALY_GAP_THRESHOLD,
+        "declared_price_low": z_declared <= -ANOMALY_Z_THRESHOLD,
+        "assessed_price_low": z_assessed <= -ANOMALY_Z_THRESHOLD,
+        "price_high": z_assessed >= ANOMALY_Z_THRESHOLD,
+    }
+    flagged = np.zeros(len(frame), dtype=bool)
+    labels = np.full(len(frame), "", dtype=object)
+    for name, mask in flags.items():
+        flagged |= mask
+        labels = np.where(mask, np.where(labels == "", name, labels + "," + name), labels)
+
+    gap_score = np.nan_to_num(gap, nan=0.0) / ANOMALY_GAP_THRESHOLD * ANOMALY_Z_THRESHOLD
+    score = np.max(np.vstack([
+        np.nan_to_num(-z_declared, nan=0.0), np.nan_to_num(-z_assessed, nan=0.0),
+        np.nan_to_num(z_assessed, nan=0.0), gap_score,
+    ]), axis=0)
+
+    # PKR the assessment would add if the item had been priced at its group median
+    median_price = np.exp(median)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        at_risk = np.where(z_assessed <= -ANOMALY_Z_THRESHOLD,
+                           numeric("ASSESSED IMPORT VALUE RS") * (median_price / assessed - 1), 0.0)
+
+    scored = frame.assign(
+        baseline_level=np.where(use_full, "origin", np.where(use_pooled, "pooled", None)),
+        baseline_n=n, baseline_median=median_price,
+        fence_low=np.exp(q1 - fence_width), fence_high=np.exp(q3 + fence_width),
+        z_declared=z_declared, z_assessed=z_assessed, price_gap=gap,
+        score=score, value_at_risk_rs=np.nan_to_num(at_risk, nan=0.0), flags=labels,
+    )
+    return scored[flagged]
+
+
+def _create_tables(conn, table: str, types: dict, keys, selected):
+    baselines = quote_identifier(baseline_table(table))
+    key_definitions = ", ".join(f"{quote_identifier(k)} {types[k]}" for k in keys)
+    conn.execute(
+        f"CREATE TABLE {baselines} ({key_definitions}, level TEXT, n INTEGER, "
+        f"median REAL, q1 REAL, q3 REAL, mad REAL)"
+    )
+    conn.execute(
+        f"CREATE INDEX {quote_identifier('ix_' + baseline_table(table) + '_hs')} "
+        f'ON {baselines} (level, "HS CODE")'
+    )
+
+    name = quote_identifier(anomaly_table(table))
+    definitions = ", ".join(
+        [f"{quote_identifier(c)} {types[c]}" for c in selected]
+        + [f"{quote_identifier(c)} {t}" for c, t in SCORE_COLUMNS]
+    )
+    conn.execute(f"CREATE TABLE {name} (row_id INTEGER, {definitions})")
+    conn.execute(f"CREATE INDEX {quote_identifier('ix_' + anomaly_table(table) + '_score')} ON {name} (score DESC)")
+    for column in (GD_COLUMN, "HS CODE", "NTN"):
+        if column in selected:
+            index = quote_identifier(f"ix_{anomaly_table(table)}_{column.lower().replace(' ', '_')}")
+            conn.execute(f"CREATE INDEX {index} ON {name} ({quote_identifier(column)})")
+
+
+def build_price_anomalies(conn, table: str = "customs", delta: bool = False):
+    """
+    Build the price baselines and flagged declarations for `table` inside
+    the ingest transaction. Group statistics are computed in SQLite and rows
+    are scored in FETCH_BATCH_ROWS batches. With `delta`, only the HS codes
+    kept by capture_affected_codes() are recomputed. Skipped when the table
+    has no unit prices.
+    """
+    started = time.monotonic()
+    types = _column_types(conn, table)
+    columns = list(types)
+    keys = [k for k in BASELINE_KEYS if k in columns]
+    pooled_keys = [k for k in POOLED_KEYS if k in columns]
+    wanted = list(dict.fromkeys(keys + CONTEXT_COLUMNS + [DECLARED_PRICE_COLUMN, PRICE_COLUMN]))
+    selected = [c for c in wanted if c in columns]
+    baselines, anomalies = quote_identifier(baseline_table(table)), quote_identifier(anomaly_table(table))
+
+    # an append that changed the columns the tables are keyed on gets a full rebuild
+    delta = (
+        delta
+        and conn.execute(f"PRAGMA temp.table_info({AFFECTED_CODES_TABLE})").fetchone() is not None
+        and _table_columns(conn, baseline_table(table)) == keys + BASELINE_STAT_COLUMNS
+        and _table_columns(conn, anomaly_table(table)) == ["row_id"] + selected + [c for c, _ in SCORE_COLUMNS]
+    )
+    if delta:
+        source = (
+            f'temp.{AFFECTED_CODES_TABLE} AS a CROSS JOIN {quote_identifier(table)} AS c '
+            f'ON c."HS CODE" IS a."HS CODE"'
+        )
+        for name in (baselines, anomalies):
+            conn.execute(
+                f'DELETE FROM {name} WHERE EXISTS (SELECT 1 FROM temp.{AFFECTED_CODES_TABLE} AS a '
+                f'WHERE a."HS CODE" IS {name}."HS CODE")'
+            )
+    else:
+        conn.execute(f"DROP TABLE IF EXISTS {baselines}")
+        conn.execute(f"DROP TABLE IF EXISTS {anomalies}")
+        if "HS CODE" not in columns or PRICE_COLUMN not in columns:
+            conn.execute(f"DROP TABLE IF EXISTS temp.{AFFECTED_CODES_TABLE}")
+            return None
+        _create_tables(conn, table, types, keys, selected)
+        source = f"{quote_identifier(table)} AS c"
+
+    groups = 0
+    for level, level_keys in (("origin", keys), ("pooled", pooled_keys)):
+        _insert_baselines(conn, table, source, level_keys, keys, level)
+        groups += _fill_mad(conn, table, level_keys, level)
+
+    stats = ", ".join(f"{alias}.{s} AS {alias}_{s}" for alias in ("o", "p") for s in STAT_COLUMNS)
+    cursor = conn.execute(f"""
+        SELECT c.rowid AS row_id, {", ".join(f"c.{quote_identifier(c)}" for c in selected)}, {stats}
+        FROM {source}
+        LEFT JOIN {baselines} AS o ON o.level = 'origin' AND {_match(keys, "o", "c")}
+        LEFT JOIN {baselines} AS p ON p.level = 'pooled' AND {_match(pooled_keys, "p", "c")}
+    """)
+    names = [d[0] for d in cursor.description]
+    output = ["row_id"] + selected + [c for c, _ in SCORE_COLUMNS]
+    insert = f"INSERT INTO {anomalies} VALUES ({', '.join('?' for _ in output)})"
+    scanned = 0
+    while True:
+        rows = cursor.fetchmany(FETCH_BATCH_ROWS)
+        if not rows:
+            break
+        scanned += len(rows)
+        scored = score_batch(pd.DataFrame.from_records(rows, columns=names))[output]
+        conn.executemany(insert, scored.astype(object).where(scored.notna(), None).itertuples(index=False, name=None))
+
+    conn.execute(f"DROP TABLE IF EXISTS temp.{AFFECTED_CODES_TABLE}")
+    flagged = conn.execute(f"SELECT COUNT(*) FROM {anomalies}").fetchone()[0]
+    print(f"🚩 Scored {scanned:,} declarations against {groups:,} {'refreshed ' if delta else ''}price baselines: "
+          f"{flagged:,} flagged in total ({time.monotonic() - started:.2f}s)")
+    return flagged
+
+
+def _exists(conn, name: str) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+    ).fetchone() is not None
+
+
+def list_anomalies(table: str = "customs", target_engine=None, hs_range=None, ntn: str = None,
+                   importer: str = None, origin: str = None, flag: str = None, min_score: float = None,
+                   limit: int = 100):
+    """
+    Flagged declarations, highest score first, plus counts per flag.
+    `hs_range` is a (low, high) pair of HS CODE bounds. Returns None when
+    the anomaly table has not been built for this dataset.
+    """
+    name = anomaly_table(table)
+    clauses, params = [], []
+    if hs_range:
+        clauses.append('"HS CODE" >= ? AND "HS CODE" < ?')
+        params += list(hs_range)
+    if ntn:
+        clauses.append('"NTN" = ?')
+        params.append(ntn)
+    if importer:
+        clauses.append('"IMPORTER NAME" LIKE ?')
+        params.append(f"%{importer}%")
+    if origin:
+        clauses.append('"ORIGIN COUNTRY" = ? COLLATE NOCASE')
+        params.append(origin)
+    if flag:
+        clauses.append("(',' || flags || ',') LIKE ?")
+        params.append(f"%,{flag},%")
+    if min_score is not None:
+        clauses.append("score >= ?")
+        params.append(min_score)
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+
+    raw = (target_engine or read_engine).raw_connection()
+    try:
+        conn = raw.driver_connection
+        if not _exists(conn, name):
+            return None
+        cursor = conn.execute(
+            f"SELECT * FROM {quote_identifier(name)}{where} ORDER BY score DESC LIMIT ?", params + [limit]
+        )
+        columns = [d[0] for d in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        totals = conn.execute(
+            f"SELECT COUNT(*), COALESCE(SUM(value_at_risk_rs), 0) FROM {quote_identifier(name)}{where}", params
+        ).fetchone()
+        by_flag = {}
+        for flags, count in conn.execute(
+            f"SELECT flags, COUNT(*) FROM {quote_identifier(name)}{where} GROUP BY flags", params
+        ).fetchall():
+            for label in flags.split(","):
+                by_flag[label] = by_flag.get(label, 0) + count
+    finally:
+        raw.close()
+
+    return {
+        "summary": {"flagged": totals[0], "value_at_risk_rs": totals[1], "by_flag": by_flag},
+        "anomalies": rows,
+    }
+
+
+def flagged_in_result(sql: str, params=None, columns=(), table: str = "customs", target_engine=None,
+                      limit: int = ANALYSIS_ANOMALY_ROWS, df: pd.DataFrame = None):
+    """
+    The highest-scoring flagged declarations inside a query's full result,
+    matched on GD number (or on HS code for aggregated results). When `df`
+    holds the whole result its values are matched instead of re-running `sql`.
+    Returns [] when the result has neither column or the lookup fails.
+    """
+    match = next((c for c in (GD_COLUMN, "HS CODE") if c in columns), None)
+    if match is None:
+        return []
+    name = quote_identifier(anomaly_table(table))
+    column = quote_identifier(match)
+    if df is not None and list(df.columns).count(match) == 1:
+        values = df[match].dropna().unique().tolist()
+        within, params = "SELECT value FROM json_each(:result_values)", {"result_values": json.dumps(values)}
+    else:
+        within = f"SELECT {column} FROM ({validate_sql(sql)})"
+    statement = f"SELECT * FROM {name} WHERE {column} IN ({within}) ORDER BY score DESC LIMIT {int(limit)}"
+    deadline = time.monotonic() + ANOMALY_LOOKUP_TIMEOUT_SECONDS
+
+    raw = (target_engine or read_engine).raw_connection()
+    conn = raw.driver_connection
+    conn.set_progress_handler(lambda: 1 if time.monotonic() > deadline else 0, PROGRESS_HANDLER_OPS)
+    try:
+        if not _exists(conn, anomaly_table(table)):
+            return []
+        cursor = conn.execute(statement, params or {})
+        names = [d[0] for d in cursor.description]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        print(f"⚠️ Anomaly lookup failed: {e}")
+        return []
+    finally:
+        conn.set_progress_handler(None, 0)
+        raw.close()
+
+
+def _as_price(value):
+    """A price as float; None when missing or not a number (CSV appends can store TEXT)."""
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def describe_anomalies(rows) -> str:
+    """Bullet lines for the analysis prompt."""
+    lines = []
+    for row in rows:
+        currency = row.get("ASSD CURR") or ""
+        unit = row.get("ASSD UNIT") or "unit"
+        # a declared-price flag needs no assessed price, so either may be missing
+        assessed, declared = _as_price(row.get(PRICE_COLUMN)), _as_price(row.get(DECLARED_PRICE_COLUMN))
+        prices = []
+        if assessed is not None:
+            prices.append(f"assessed {assessed:,.2f} {currency}/{unit}")
+        if declared is not None:
+            prices.append(f"declared {declared:,.2f}")
+        line = (
+            f"\n• {row.get(GD_COLUMN, '?')} | {row.get('IMPORTER NAME') or '?'} | HS {row.get('HS CODE')}"
+            f" | {row.get('ORIGIN COUNTRY') or '?'}: {', '.join(prices) or 'no unit price'}"
+        )
+        # declared-vs-assessed gaps are flagged even where the group is too small for a baseline
+        if row.get("baseline_median") is not None:
+            line += f", group median {row['baseline_median']:,.2f} (n={row['baseline_n']})"
+        line += f" -> {row['flags']} (score {row['score']:.1f})"
+        lines.append(line)
+    return "".join(lines)
@@ -0,0 +1,266 @@
+# audit_scan.py
+import multiprocessing
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from db import read_engine, quote_identifier, get_data_version
+from anomalies import anomaly_table, ANOMALY_GAP_THRESHOLD
+from rollups import MEASURE_COLUMNS, PRICE_COLUMN, DECLARED_PRICE_COLUMN
+
+# Worker processes for the scan; each partition is an independent GROUP BY over a rowid range
+AUDIT_SCAN_WORKERS = int(os.getenv("AUDIT_SCAN_WORKERS", str(os.cpu_count() or 1)))
+# More partitions than workers so a slow range does not leave the other cores idle
+AUDIT_PARTITIONS_PER_WORKER = 4
+# Scans coordinated at once; each one already uses every worker process
+AUDIT_SCAN_JOBS = int(os.getenv("AUDIT_SCAN_JOBS", "1"))
+
+# Importers with fewer lines than this are aggregated but not ranked
+AUDIT_MIN_LINES = int(os.getenv("AUDIT_MIN_LINES", "3"))
+AUDIT_TOP_IMPORTERS = 50
+
+# Share of the score per indicator; each indicator is a percentile rank among importers
+RISK_WEIGHTS = {
+    "price_gap": 0.25,
+    "discrepant_share": 0.15,
+    "tax_shortfall": 0.2,
+    "flagged_share": 0.2,
+    "sro_share": 0.1,
+    "market_share": 0.1,
+}
+# Percentile rank at which an indicator is named as a reason
+REASON_PERCENTILE = 0.9
+
+PAIR_KEYS = ["importer_key", "HS CODE"]
+SUM_COLUMNS = [
+    "lines", "value", "taxes", "declared_value", "assessed_value",
+    "discrepant_lines", "sro_lines", "flagged_lines", "value_at_risk_rs",
+]
+
+audit_executor = ThreadPoolExecutor(max_workers=AUDIT_SCAN_JOBS, thread_name_prefix="audit")
+_process_pool = None
+
+
+def process_pool() -> ProcessPoolExecutor:
+    """Worker processes, started on first use. Spawned, since the server process has threads."""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(
+            max_workers=AUDIT_SCAN_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _process_pool
+
+
+def shutdown_process_pool():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(cancel_futures=True)
+        _process_pool = None
+
+
+def partition_statements(columns, table: str = "customs"):
+    """
+    The per-partition SQL: line, value and tax sums per (importer, HS code)
+    over `rowid BETWEEN ? AND ?`, and the same for flagged price anomalies.
+    """
+    def col(name):
+        return quote_identifier(name)
+
+    importer = [c for c in ("NTN", "IMPORTER NAME") if c in columns]
+    key = f"CAST(COALESCE({', '.join(col(c) for c in importer)}) AS TEXT)"
+    name = f"MAX({col('IMPORTER NAME')})" if "IMPORTER NAME" in columns else key
+    value = f"SUM({col('ASSESSED IMPORT VALUE RS')})" if "ASSESSED IMPORT VALUE RS" in columns else "0"
+    if "Total" in columns:
+        taxes = f"SUM({col('Total')})"
+    else:
+        taxes = " + ".join(
+            f"COALESCE(SUM({col(c)}), 0)" for c in MEASURE_COLUMNS
+            if c in columns and c != "ASSESSED IMPORT VALUE RS"
+        ) or "0"
+
+    priced = declared_value = assessed_value = discrepant = "0"
+    if {PRICE_COLUMN, DECLARED_PRICE_COLUMN, "ASSD QTY"} <= set(columns):
+        d, a, q = col(DECLARED_PRICE_COLUMN), col(PRICE_COLUMN), col("ASSD QTY")
+        priced = f"{d} > 0 AND {a} > 0"
+        declared_value = f"SUM(CASE WHEN {priced} THEN {d} * {q} END)"
+        assessed_value = f"SUM(CASE WHEN {priced} THEN {a} * {q} END)"
+        discrepant = f"SUM({priced} AND {d} < {a} * {1 - ANOMALY_GAP_THRESHOLD})"
+    # SRO notifications grant exemptions; "Part II of First Schedule" is the ordinary tariff
+    sro = f"SUM(instr(upper({col('SRO')}), 'SRO') > 0)" if "SRO" in columns else "0"
+
+    scan = (
+        f"SELECT {key} AS importer_key, {name} AS importer_name, {col('HS CODE')}, COUNT(*) AS lines, "
+        f"{value} AS value, {taxes} AS taxes, {declared_value} AS declared_value, "
+        f"{assessed_value} AS assessed_value, {discrepant} AS discrepant_lines, {sro} AS sro_lines "
+        f"FROM {col(table)} WHERE rowid BETWEEN ? AND ? GROUP BY 1, 3"
+    )
+    flagged = (
+        f"SELECT {key} AS importer_key, {col('HS CODE')}, COUNT(*) AS flagged_lines, "
+        f"SUM(value_at_risk_rs) AS value_at_risk_rs "
+        f"FROM {col(anomaly_table(table))} WHERE row_id BETWEEN ? AND ? GROUP BY 1, 2"
+    )
+    return scan, flagged
+
+
+def scan_partition(path: str, scan_sql: str, flagged_sql: str, low: int, high: int):
+    """
+    Runs in a worker process: the (importer, HS code) sums for one rowid
+    range, read on its own read-only connection. Returns (frame, rows).
+    """
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        conn.execute("PRAGMA query_only = ON")
+        conn.execute("PRAGMA busy_timeout = 30000")
+        cursor = conn.execute(scan_sql, (low, high))
+        frame = pd.DataFrame.from_records(cursor.fetchall(), columns=[d[0] for d in cursor.description])
+        try:
+            cursor = conn.execute(flagged_sql, (low, high))
+            flagged = pd.DataFrame.from_records(cursor.fetchall(), columns=[d[0] for d in cursor.description])
+        except sqlite3.OperationalError:
+            # no anomaly table for datasets ingested before it existed
+            flagged = pd.DataFrame(columns=PAIR_KEYS + ["flagged_lines", "value_at_risk_rs"])
+    finally:
+        conn.close()
+
+    frame = frame.merge(flagged, on=PAIR_KEYS, how="left")
+    frame[SUM_COLUMNS] = frame[SUM_COLUMNS].apply(pd.to_numeric, errors="coerce").fillna(0)
+    return frame, int(frame["lines"].sum())
+
+
+def merge_pairs(pairs, partial):
+    """Fold one partition's sums into the running (importer, HS code) totals."""
+    if pairs is None:
+        return partial
+    combined = pd.concat([pairs, partial], ignore_index=True)
+    sums = combined.groupby(PAIR_KEYS, dropna=False, sort=False)[SUM_COLUMNS].sum()
+    names = combined.groupby(PAIR_KEYS, dropna=False, sort=False)["importer_name"].max()
+    return sums.join(names).reset_index()
+
+
+def score_importers(pairs: pd.DataFrame, top: int = AUDIT_TOP_IMPORTERS):
+    """
+    Importer risk ranking from the (importer, HS code) totals.
+    Taxes are compared with what the importer's HS code mix pays on average,
+    so a low-duty product line is not mistaken for evasion.
+    """
+    by_hs = pairs.groupby("HS CODE", dropna=False)[["value", "taxes"]].sum()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        hs_rate = (by_hs["taxes"] / by_hs["value"]).replace([np.inf, -np.inf], np.nan)
+        pairs = pairs.assign(
+            expected_taxes=pairs["value"] * pairs["HS CODE"].map(hs_rate).fillna(0),
+            market_share=pairs["value"] / pairs["HS CODE"].map(by_hs["value"]),
+        )
+
+    grouped = pairs.groupby("importer_key", dropna=False)
+    importers = grouped[SUM_COLUMNS + ["expected_taxes"]].sum()
+    importers["importer_name"] = grouped["importer_name"].max()
+    importers["hs_codes"] = grouped.size()
+    importers["market_share"] = grouped["market_share"].max()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        importers["price_gap"] = (1 - importers["declared_value"] / importers["assessed_value"]).clip(lower=0)
+        importers["discrepant_share"] = importers["discrepant_lines"] / importers["lines"]
+        importers["tax_shortfall"] = 1 - importers["taxes"] / importers["expected_taxes"]
+        importers["flagged_share"] = importers["flagged_lines"] / importers["lines"]
+        importers["sro_share"] = importers["sro_lines"] / importers["lines"]
+    indicators = list(RISK_WEIGHTS)
+    importers[indicators] = importers[indicators].replace([np.inf, -np.inf], np.nan)
+
+    ranked = importers[importers["lines"] >= AUDIT_MIN_LINES].copy()
+    if ranked.empty:
+        return [], 0
+    percentiles = ranked[indicators].rank(pct=True).fillna(0)
+    weights = pd.Series(RISK_WEIGHTS)
+    ranked["risk_score"] = 100 * (percentiles[indicators] * weights).sum(axis=1) / weights.sum()
+    ranked["reasons"] = [
+        [name for name in indicators if row[name] >= REASON_PERCENTILE]
+        for row in percentiles.to_dict("records")
+    ]
+    ranked = ranked.sort_values("risk_score", ascending=False).head(top).reset_index()
+
+    columns = ["importer_key", "importer_name", "risk_score", "reasons", "lines", "hs_codes", "value",
+               "taxes", "value_at_risk_rs"] + indicators
+    records = ranked[columns].astype(object).where(ranked[columns].notna(), None).to_dict("records")
+    for record in records:
+        for name in ["risk_score"] + indicators:
+            if record[name] is not None:
+                record[name] = round(float(record[name]), 4)
+    return records, len(importers)
+
+
+def partition_bounds(table: str, partitions: int, target_engine=None):
+    """Contiguous rowid ranges covering the table, as evenly sized as the rowids allow."""
+    raw = (target_engine or read_engine).raw_connection()
+    try:
+        low, high = raw.driver_connection.execute(
+            f"SELECT MIN(rowid), MAX(rowid) FROM {quote_identifier(table)}"
+        ).fetchone()
+    finally:
+        raw.close()
+    if low is None:
+        return []
+    edges = np.linspace(low, high + 1, max(1, partitions) + 1).astype(np.int64)
+    return [(int(a), int(b) - 1) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+
+def run_audit_scan(path: str, columns, table: str = "customs", target_engine=None, progress=None,
+                   publish=None, top: int = AUDIT_TOP_IMPORTERS):
+    """
+    Importer risk ranking over the whole table. Rowid partitions are scanned
+    in parallel by the process pool; as each one completes, its sums are
+    merged and `publish(result)` receives the ranking so far.
+    `progress(phase, rows_processed)` is called as partitions finish.
+    """
+    started = time.monotonic()
+    if "HS CODE" not in columns or not ({"NTN", "IMPORTER NAME"} & set(columns)):
+        raise ValueError("Audit scan needs HS CODE and NTN or IMPORTER NAME columns")
+    version_before = get_data_version(table, target_engine)[0]
+    bounds = partition_bounds(table, AUDIT_SCAN_WORKERS * AUDIT_PARTITIONS_PER_WORKER, target_engine)
+    scan_sql, flagged_sql = partition_statements(columns, table)
+
+    pairs, rows, done = None, 0, 0
+    result = {"importers": [], "importers_scored": 0}
+
+    def snapshot(final: bool):
+        return {
+            **result,
+            "complete": final,
+            "partitions_done": done,
+            "partitions": len(bounds),
+            "workers": AUDIT_SCAN_WORKERS,
+            "rows_scanned": rows,
+            "elapsed_seconds": round(time.monotonic() - started, 2),
+            "weights": RISK_WEIGHTS,
+        }
+
+    if progress:
+        progress("scan", 0)
+    pool = process_pool()
+    futures = [pool.submit(scan_partition, path, scan_sql, flagged_sql, low, high) for low, high in bounds]
+    try:
+        for future in as_completed(futures):
+            partial, partial_rows = future.result()
+            pairs = merge_pairs(pairs, partial)
+            rows += partial_rows
+            done += 1
+            importers, scored = score_importers(pairs, top)
+            result = {"importers": importers, "importers_scored": scored}
+            if progress:
+                progress("scan", rows)
+            if publish and done < len(bounds):
+                publish(snapshot(final=False))
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+    final = snapshot(final=True)
+    if get_data_version(table, target_engine)[0] != version_before:
+        final["data_changed_during_scan"] = True
+        print("⚠️ Data changed while the audit scan ran; partitions may mix versions")
+    print(f"🕵️ Audit scan: {rows:,} rows in {len(bounds)} partitions on {AUDIT_SCAN_WORKERS} workers, "
+          f"{final['importers_scored']:,} importers ({final['elapsed_seconds']:.2f}s)")
+    return final
@@ -0,0 +1,197 @@
+# benchmark.py - End-to-end load test of the API
+#
+#   python fake_llm.py --port 8001 &
+#   LLM_BASE_URL=http://localhost:8001/v1 uvicorn main:app --port 8000 &
+#   python benchmark.py --file data.xlsx --queries 200 --concurrency 20 --purge-caches
+#
+# Uploads a file (optional), then runs /query, /download and
+# /generate-visualization at the given concurrency and prints throughput and
+# p50/p95/p99 per stage. With the fake LLM, the numbers are the pipeline's own overhead.
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import Counter, defaultdict
+
+import httpx
+
+DEFAULT_QUESTIONS = [
+    "top 10 importers by value",
+    "top 5 hs codes by duty from China",
+    "list audit prone GDs for HS code 8513.101",
+    "show all records for HS code 8513",
+    "which importers declare unit prices far below the assessed price?",
+    "total assessed value and duty paid by origin country",
+    "how has the average unit price of torches changed across origins?",
+    "which SRO exemptions are used most and by whom?",
+]
+
+# Seconds to wait for an ingest job before giving up
+INGEST_TIMEOUT_SECONDS = 600
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+class Recorder:
+    """Durations per stage, plus failures and free-form counters."""
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.errors = Counter()
+        self.counters = Counter()
+
+    def add(self, stage: str, seconds: float):
+        self.durations[stage].append(seconds)
+
+    def fail(self, stage: str, error):
+        self.errors[stage] += 1
+        print(f"❌ {stage}: {error}")
+
+    def report(self, wall_seconds: float, queries: int):
+        stages = list(self.durations) + [s for s in self.errors if s not in self.durations]
+        print(f"\n{'stage':<24}{'ok':>6}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for stage in stages:
+            ordered = sorted(self.durations.get(stage, []))
+            cells = [percentile(ordered, 50), percentile(ordered, 95), percentile(ordered, 99), ordered[-1] if ordered else None]
+            cells = "".join(f"{c * 1000:>10.1f}" if c is not None else f"{'-':>10}" for c in cells)
+            print(f"{stage:<24}{len(ordered):>6}{self.errors.get(stage, 0):>6}{cells}")
+
+        completed = len(self.durations.get("query_total", []))
+        print(f"\n⏱️  {queries} queries in {wall_seconds:.2f}s -> {completed / wall_seconds:.2f} completed queries/s")
+        if self.counters:
+            print("📊 " + ", ".join(f"{key}={value}" for key, value in sorted(self.counters.items())))
+
+
+async def upload(client: httpx.AsyncClient, path: str, session_id: str, recorder: Recorder):
+    started = time.perf_counter()
+    with open(path, "rb") as f:
+        response = await client.post(
+            "/upload", params={"session_id": session_id}, files={"file": (os.path.basename(path), f)}
+        )
+    if response.status_code != 200:
+        recorder.fail("upload", f"HTTP {response.status_code}: {response.text[:200]}")
+        return False
+    recorder.add("upload_request", time.perf_counter() - started)
+
+    job_id = response.json()["job_id"]
+    while time.perf_counter() - started < INGEST_TIMEOUT_SECONDS:
+        job = (await client.get(f"/jobs/{job_id}")).json()
+        if job["status"] == "done":
+            recorder.add("upload_ingested", time.perf_counter() - started)
+            return True
+        if job["status"] == "failed":
+            recorder.fail("upload_ingested", job.get("error"))
+            return False
+        await asyncio.sleep(0.25)
+    recorder.fail("upload_ingested", "timed out")
+    return False
+
+
+async def sse_events(response: httpx.Response):
+    """JSON payloads of the data: lines of a streamed response, as they arrive."""
+    pending = ""
+    async for chunk in response.aiter_text():
+        lines = (pending + chunk).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            if line.startswith("data: "):
+                yield json.loads(line[6:])
+
+
+async def run_query(client: httpx.AsyncClient, question: str, session_id: str, recorder: Recorder, args):
+    started = time.perf_counter()
+    result_id = None
+    has_visualization = False
+    try:
+        async with client.stream("POST", "/query", json={"question": question, "session_id": session_id}) as response:
+            if response.status_code != 200:
+                await response.aread()
+                recorder.fail("query_total", f"HTTP {response.status_code}: {response.text[:200]}")
+                return
+            first_token = True
+            async for event in sse_events(response):
+                elapsed = time.perf_counter() - started
+                if event["type"] == "metadata":
+                    recorder.add("query_metadata", elapsed)
+                    result_id = event["result_id"]
+                    recorder.counters[f"sql_{event.get('sql_source', 'unknown')}"] += 1
+                    if event.get("analysis_cached"):
+                        recorder.counters["analysis_cached"] += 1
+                elif event["type"] == "token":
+                    recorder.counters["token_frames"] += 1
+                    if first_token:
+                        recorder.add("query_first_token", elapsed)
+                        first_token = False
+                elif event["type"] == "visualization_ready":
+                    recorder.add("query_visualization", elapsed)
+                    has_visualization = True
+                elif event["type"] == "error":
+                    recorder.counters["stream_errors"] += 1
+        recorder.add("query_total", time.perf_counter() - started)
+    except httpx.HTTPError as e:
+        recorder.fail("query_total", f"{type(e).__name__}: {e}")
+        return
+
+    if result_id and args.download_format:
+        started = time.perf_counter()
+        response = await client.get(f"/download/{result_id}", params={"format": args.download_format})
+        if response.status_code == 200:
+            recorder.add("download", time.perf_counter() - started)
+        else:
+            recorder.fail("download", f"HTTP {response.status_code}")
+
+    if result_id and has_visualization and not args.skip_visualization:
+        started = time.perf_counter()
+        response = await client.post(f"/generate-visualization/{result_id}")
+        if response.status_code == 200:
+            recorder.add("generate_visualization", time.perf_counter() - started)
+        else:
+            recorder.fail("generate_visualization", f"HTTP {response.status_code}: {response.text[:200]}")
+
+
+async def main(args):
+    questions = DEFAULT_QUESTIONS
+    if args.questions:
+        with open(args.questions, encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()]
+
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        if args.file and not await upload(client, args.file, args.session_id, recorder):
+            recorder.report(0.0, 0)
+            return
+        if args.purge_caches:
+            await client.delete("/cache/sql")
+            await client.delete("/cache/responses")
+
+        print(f"🚀 {args.queries} queries, concurrency {args.concurrency}, {len(questions)} distinct questions")
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def one(i):
+            async with semaphore:
+                await run_query(client, questions[i % len(questions)], args.session_id, recorder, args)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.queries)))
+        recorder.report(time.perf_counter() - started, args.queries)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end /query benchmark")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--file", help="CSV/Excel file to upload before querying")
+    parser.add_argument("--session-id", default="user_session_1")
+    parser.add_argument("--questions", help="Text file with one question per line")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--download-format", default="csv", help="excel, csv, json or '' to skip")
+    parser.add_argument("--skip-visualization", action="store_true")
+    parser.add_argument("--purge-caches", action="store_true", help="Clear the SQL and response caches first")
+    parser.add_argument("--timeout", type=float, default=120)
+    asyncio.run(main(parser.parse_args()))
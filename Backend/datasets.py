@@ -0,0 +1,174 @@
+# datasets.py
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import db
+from schema_registry import SchemaRegistry, schema_registry
+
+# "shared": every session reads and writes the one customs.db (original behaviour)
+# "session": each session_id gets its own SQLite file under DATASETS_DIR
+DATASET_MODE = os.getenv("DATASET_MODE", "shared")
+DATASETS_DIR = os.path.abspath(os.getenv("DATASETS_DIR", "datasets"))
+
+DEFAULT_SESSION_ID = "user_session_1"
+
+# Open datasets each hold a writer plus up to pool size + overflow readers.
+# Past MAX_OPEN_DATASETS the least recently used idle one is closed.
+MAX_OPEN_DATASETS = int(os.getenv("MAX_OPEN_DATASETS", "16"))
+DATASET_IDLE_SECONDS = int(os.getenv("DATASET_IDLE_SECONDS", "900"))
+# How often the server closes idle datasets between requests
+DATASET_EVICT_INTERVAL_SECONDS = int(os.getenv("DATASET_EVICT_INTERVAL_SECONDS", "60"))
+DATASET_READ_POOL_SIZE = int(os.getenv("DATASET_READ_POOL_SIZE", "2"))
+DATASET_READ_POOL_OVERFLOW = int(os.getenv("DATASET_READ_POOL_OVERFLOW", "4"))
+
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class DatasetNotFound(Exception):
+    """No data has been uploaded for this session."""
+
+
+class Dataset:
+    """One SQLite file with its own writer, reader pool and schema registry."""
+
+    def __init__(self, dataset_id: str, path: str, writer=None, reader=None, registry=None,
+                 read_capacity: int = DATASET_READ_POOL_SIZE + DATASET_READ_POOL_OVERFLOW):
+        self.id = dataset_id
+        self.path = path
+        if writer is None:
+            writer, reader = db.create_engines(path, DATASET_READ_POOL_SIZE, DATASET_READ_POOL_OVERFLOW)
+        self.write_engine = writer
+        self.read_engine = reader
+        self.read_capacity = read_capacity
+        self.schema_registry = registry or SchemaRegistry(read_engine=reader)
+        self.opened_at = time.time()
+        self.last_used = self.opened_at
+        # requests/jobs currently using the dataset; never evicted while > 0
+        self.active = 0
+
+    def close(self):
+        self.write_engine.dispose()
+        self.read_engine.dispose()
+
+    def pool_stats(self):
+        return db.pool_stats(self.write_engine, self.read_engine, self.read_capacity)
+
+    def stats(self):
+        return {
+            "dataset_id": self.id,
+            "path": self.path,
+            "active": self.active,
+            "idle_seconds": round(time.time() - self.last_used, 1),
+            "opened_at": self.opened_at,
+        }
+
+
+class DatasetManager:
+    """
+    Routes session ids to datasets, opening SQLite files on demand and closing
+    idle ones to stay inside the open-file budget.
+    """
+
+    def __init__(self, mode: str = DATASET_MODE, root: str = DATASETS_DIR):
+        self.mode = mode
+        self.root = root
+        self._lock = threading.Lock()
+        self._open = OrderedDict()
+        self.evictions = 0
+        # The shared dataset wraps the module-level engines and is never evicted
+        self.shared = Dataset(
+            "shared", db.DATABASE_PATH, db.engine, db.read_engine, schema_registry,
+            read_capacity=db.READ_POOL_SIZE + db.READ_POOL_OVERFLOW
+        )
+
+    def resolve_session_id(self, session_id: str = None) -> str:
+        if not session_id:
+            return DEFAULT_SESSION_ID
+        if not SESSION_ID_PATTERN.match(session_id):
+            raise ValueError("session_id may only contain letters, digits, '_' and '-' (max 64)")
+        return session_id
+
+    def path_for(self, session_id: str) -> str:
+        return os.path.join(self.root, f"{session_id}.db")
+
+    def get(self, session_id: str = None, create: bool = False) -> Dataset:
+        """
+        Dataset for `session_id`. In session mode a dataset that has never been
+        uploaded raises DatasetNotFound unless `create` is set.
+        """
+        return self._acquire(session_id, create)
+
+    @contextmanager
+    def lease(self, session_id: str = None, create: bool = False):
+        """Use a dataset without it being evicted underneath you."""
+        dataset = self._acquire(session_id, create, lease=True)
+        try:
+            yield dataset
+        finally:
+            with self._lock:
+                dataset.active -= 1
+                dataset.last_used = time.time()
+
+    def _acquire(self, session_id: str = None, create: bool = False, lease: bool = False) -> Dataset:
+        """
+        Look up or open the dataset and, for a lease, count it active in the
+        same lock hold, so no other thread can evict it in between.
+        """
+        if self.mode != "session":
+            with self._lock:
+                self.shared.last_used = time.time()
+                self.shared.active += lease
+            return self.shared
+
+        session_id = self.resolve_session_id(session_id)
+        with self._lock:
+            dataset = self._open.get(session_id)
+            if dataset is None:
+                path = self.path_for(session_id)
+                if not create and not os.path.exists(path):
+                    raise DatasetNotFound(f"No data uploaded for session '{session_id}'")
+                os.makedirs(self.root, exist_ok=True)
+                dataset = Dataset(session_id, path)
+                self._open[session_id] = dataset
+                print(f"📂 Opened dataset {session_id}")
+            self._open.move_to_end(session_id)
+            dataset.last_used = time.time()
+            dataset.active += lease
+            self._evict_locked(keep=session_id)
+            return dataset
+
+    def _evict_locked(self, keep: str = None):
+        """Close idle datasets past the open budget or idle timeout; never `keep`, the one being handed out."""
+        now = time.time()
+        for session_id, dataset in list(self._open.items()):
+            over_budget = len(self._open) > MAX_OPEN_DATASETS
+            idle_too_long = now - dataset.last_used > DATASET_IDLE_SECONDS
+            if dataset.active or session_id == keep or not (over_budget or idle_too_long):
+                continue
+            del self._open[session_id]
+            dataset.close()
+            self.evictions += 1
+            print(f"📁 Closed idle dataset {session_id}")
+
+    def evict_idle(self):
+        with self._lock:
+            self._evict_locked()
+
+    def stats(self):
+        with self._lock:
+            open_datasets = [d.stats() for d in self._open.values()]
+        return {
+            "mode": self.mode,
+            "open": len(open_datasets) if self.mode == "session" else 1,
+            "max_open": MAX_OPEN_DATASETS,
+            "idle_seconds_before_close": DATASET_IDLE_SECONDS,
+            "evictions": self.evictions,
+            "datasets": open_datasets if self.mode == "session" else [self.shared.stats()],
+        }
+
+
+datasets = DatasetManager()
@@ -1,32 +1,175 @@
 # db.py
-import pandas as pd
-from sqlalchemy import create_engine, text
+import os
+from sqlalchemy import create_engine, event, text
+from contextlib import contextmanager
 import json
+import time
+import uuid
 
-DATABASE_URL = "sqlite:///customs.db"
-engine = create_engine(DATABASE_URL)
+DATABASE_PATH = os.path.abspath(os.getenv("CUSTOMS_DB_PATH", "customs.db"))
+DATABASE_URL = f"sqlite:///{DATABASE_PATH}"
 
-def load_csv_to_db(csv_path: str):
-    df = pd.read_csv(csv_path)
-    df.to_sql("customs", engine, if_exists="replace", index=False)
+SCHEMA_DESCRIPTIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.json")
 
-def load_xlsx_to_db(xlsx_path: str, sheet_name=0):
-    df = pd.read_excel(xlsx_path, sheet_name=sheet_name)
-    df.to_sql("customs", engine, if_exists="replace", index=False)
+# Connections handed out to /query, /health and other readers
+READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "8"))
+READ_POOL_OVERFLOW = int(os.getenv("DB_READ_POOL_OVERFLOW", "8"))
 
-def get_schema():
-    schema_query = "PRAGMA table_info(customs)"
-    with engine.connect() as conn:
+# Writers queue for the single write connection; an ingest can hold it for minutes
+WRITE_POOL_TIMEOUT_SECONDS = 600
+
+SQLITE_BUSY_TIMEOUT_MS = 30000
+SQLITE_MMAP_BYTES = 256 * 1024 * 1024
+# Negative cache_size is in KiB: 64 MiB page cache per connection
+SQLITE_CACHE_KIB = 64 * 1024
+
+def _configure_connection(dbapi_connection, read_only: bool):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_BYTES}")
+    cursor.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_KIB}")
+    cursor.execute("PRAGMA temp_store = MEMORY")
+    if read_only:
+        cursor.execute("PRAGMA query_only = ON")
+    else:
+        # WAL lets readers keep reading the last committed snapshot while an ingest writes
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute("PRAGMA synchronous = NORMAL")
+    cursor.close()
+
+def create_engines(path: str, read_pool_size: int = READ_POOL_SIZE, read_pool_overflow: int = READ_POOL_OVERFLOW):
+    """
+    (writer, reader) engines for one SQLite file: a single write connection
+    (SQLite allows one writer at a time anyway) and a pool of read-only ones.
+    """
+    path = os.path.abspath(path)
+    writer = create_engine(f"sqlite:///{path}", pool_size=1, max_overflow=0, pool_timeout=WRITE_POOL_TIMEOUT_SECONDS)
+    # Read-only URI so a reader can never take the write lock
+    reader = create_engine(
+        f"sqlite:///file:{path}?mode=ro&uri=true",
+        pool_size=read_pool_size, max_overflow=read_pool_overflow
+    )
+
+    @event.listens_for(writer, "connect")
+    def _on_write_connect(dbapi_connection, connection_record):
+        _configure_connection(dbapi_connection, read_only=False)
+
+    @event.listens_for(reader, "connect")
+    def _on_read_connect(dbapi_connection, connection_record):
+        _configure_connection(dbapi_connection, read_only=True)
+
+    # Create the file and switch it to WAL before any read-only connection opens it
+    with writer.connect():
+        pass
+
+    return writer, reader
+
+engine, read_engine = create_engines(DATABASE_PATH)
+
+def pool_stats(writer=None, reader=None, read_capacity: int = READ_POOL_SIZE + READ_POOL_OVERFLOW):
+    """Utilisation of the writer connection and the reader pool."""
+    writer = writer or engine
+    reader = reader or read_engine
+    stats = {}
+    for name, pool_engine, capacity in (("writer", writer, 1), ("readers", reader, read_capacity)):
+        pool = pool_engine.pool
+        checked_out = pool.checkedout()
+        stats[name] = {
+            "size": pool.size(),
+            "max_overflow": capacity - pool.size(),
+            "checked_out": checked_out,
+            "checked_in": pool.checkedin(),
+            "overflow": max(0, pool.overflow()),
+            "utilisation": round(checked_out / capacity, 3),
+        }
+    with reader.connect() as conn:
+        stats["journal_mode"] = conn.execute(text("PRAGMA journal_mode")).scalar()
+    return stats
+
+def quote_identifier(name: str) -> str:
+    # SQLite identifier escaping: wrap in double quotes and double any internal ones
+    return '"' + str(name).replace('"', '""') + '"'
+
+@contextmanager
+def write_transaction(target_engine=None):
+    """
+    Yield a raw sqlite3 connection wrapped in one explicit transaction.
+    pysqlite only opens transactions implicitly before DML, so DDL such as
+    DROP/CREATE TABLE would otherwise autocommit on its own.
+    """
+    raw = (target_engine or engine).raw_connection()
+    conn = raw.driver_connection
+    previous_isolation = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    finally:
+        conn.isolation_level = previous_isolation
+        raw.close()
+
+def load_csv_to_db(csv_path: str, mode: str = "replace"):
+    from ingest import ingest_file
+    return ingest_file(csv_path, file_format="csv", mode=mode)
+
+def load_xlsx_to_db(xlsx_path: str, sheet_name=0, mode: str = "replace"):
+    from ingest import ingest_file
+    return ingest_file(xlsx_path, file_format="xlsx", sheet_name=sheet_name, mode=mode)
+
+def meta_table(table: str = "customs") -> str:
+    return f"{table}_meta"
+
+def bump_data_version(conn, table: str = "customs"):
+    """
+    Record that `table` changed. Called inside the ingest transaction with a raw
+    sqlite3 connection. data_token is random so two datasets that happen to
+    reach the same version number still differ.
+    """
+    meta = quote_identifier(meta_table(table))
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {meta} (key TEXT PRIMARY KEY, value TEXT)")
+    row = conn.execute(f"SELECT value FROM {meta} WHERE key = 'data_version'").fetchone()
+    version = int(row[0]) + 1 if row else 1
+    conn.executemany(
+        f"INSERT OR REPLACE INTO {meta} (key, value) VALUES (?, ?)",
+        [("data_version", str(version)), ("data_token", uuid.uuid4().hex), ("updated_at", str(time.time()))]
+    )
+    return version
+
+def get_data_version(table: str = "customs", target_engine=None):
+    """(data_version, data_token) of `table`; (0, '') if it was never ingested through ingest.py."""
+    meta = meta_table(table)
+    with (target_engine or read_engine).connect() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": meta}
+        ).fetchone()
+        if not exists:
+            return 0, ""
+        values = dict(conn.execute(text(f"SELECT key, value FROM {quote_identifier(meta)}")).fetchall())
+    return int(values.get("data_version", 0)), values.get("data_token", "")
+
+def get_schema(table: str = "customs", target_engine=None):
+    schema_query = f"PRAGMA table_info({quote_identifier(table)})"
+    with (target_engine or read_engine).connect() as conn:
         rows = conn.execute(text(schema_query)).fetchall()
 
     schema = [{"column": r[1], "type": r[2]} for r in rows]
     return schema
 
 
-def attach_schema_descriptions(schema):
+def load_schema_descriptions(path: str = SCHEMA_DESCRIPTIONS_PATH):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def attach_schema_descriptions(schema, schema_descriptions=None):
     # attach schema descriptions to the schema, schema is the list of dictionaries with column name and type
-    with open('schema.json', 'r') as f:
-        schema_descriptions = json.load(f)
+    if schema_descriptions is None:
+        schema_descriptions = load_schema_descriptions()
     for row in schema:
         row['description'] = schema_descriptions.get(row['column'], '')
-    return schema
\ No newline at end of file
+    return schema
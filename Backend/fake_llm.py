@@ -0,0 +1,182 @@
+# fake_llm.py - Offline stand-in for the OpenAI-compatible chat completions API
+#
+#   python fake_llm.py --port 8001 --latency-ms 300 --tokens-per-second 80
+#   LLM_BASE_URL=http://localhost:8001/v1 uvicorn main:app --port 8000
+#
+# Answers with canned SQL, analysis text or chart code depending on the request,
+# after a configurable delay, so the pipeline can be measured without a real model.
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Delay before the response (or the first streamed token), plus up to FAKE_LLM_JITTER_MS on top
+FAKE_LLM_LATENCY_MS = int(os.getenv("FAKE_LLM_LATENCY_MS", "300"))
+FAKE_LLM_JITTER_MS = int(os.getenv("FAKE_LLM_JITTER_MS", "100"))
+# Streaming speed; 0 sends every token at once
+FAKE_LLM_TOKENS_PER_SECOND = float(os.getenv("FAKE_LLM_TOKENS_PER_SECOND", "80"))
+# Share of requests answered with a 503, to exercise retries and fallbacks
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+
+FAKE_LLM_SQL = os.getenv("FAKE_LLM_SQL", """
+SELECT "HS CODE", "ORIGIN COUNTRY", COUNT(*) AS declarations,
+       SUM("ASSESSED IMPORT VALUE RS") AS total_value,
+       AVG("ASSD UNIT PRICE") AS avg_unit_price
+FROM customs
+GROUP BY "HS CODE", "ORIGIN COUNTRY"
+ORDER BY total_value DESC
+LIMIT 50
+""".strip())
+
+FAKE_LLM_ANALYSIS = """📊 KEY COUNTS
+• The result covers the top HS code and origin country pairs by assessed value
+• A handful of pairs account for most of the assessed import value
+
+📈 PATTERNS OBSERVED
+• China dominates both declaration counts and assessed value
+• Average unit prices vary widely within the same HS code across origins
+
+⚠️ ANOMALIES OR RED FLAGS
+• Some origins show unit prices far below the HS code's typical level
+• Low-value, high-volume pairs are candidates for under-invoicing checks
+
+💡 RECOMMENDATIONS
+• Compare declared and assessed unit prices for the lowest-priced origins
+• Review importers behind the largest value concentrations
+"""
+
+FAKE_LLM_VISUALIZATION = """```python
+fig, ax = plt.subplots(figsize=(12, 6))
+numeric = df.select_dtypes(include="number")
+if not numeric.empty:
+    column = numeric.columns[-1]
+    labels = df.iloc[:15, 0].astype(str)
+    ax.bar(labels, numeric[column].head(15), color="#2E86AB")
+    ax.set_ylabel(column)
+    ax.set_title(f"{column} by {df.columns[0]}")
+    plt.xticks(rotation=45, ha="right")
+plt.tight_layout()
+plt.savefig('visualization.png', dpi=100, bbox_inches='tight')
+plt.close()
+```"""
+
+app = FastAPI()
+
+stats = {"requests": 0, "streamed": 0, "errors": 0, "by_kind": {"sql": 0, "analysis": 0, "visualization": 0}}
+
+
+def response_kind(messages) -> str:
+    """Which agent is asking: the SQL and chart generators send system prompts, the analysis does not."""
+    system = " ".join(m.get("content", "") for m in messages if m.get("role") == "system")
+    if "matplotlib" in system or "visualization" in system.lower():
+        return "visualization"
+    if system:
+        return "sql"
+    return "analysis"
+
+
+def canned_response(kind: str) -> str:
+    return {"sql": FAKE_LLM_SQL, "analysis": FAKE_LLM_ANALYSIS, "visualization": FAKE_LLM_VISUALIZATION}[kind]
+
+
+def split_tokens(content: str):
+    """Word-sized pieces, whitespace kept with the word before it, roughly like model tokens."""
+    return re.findall(r"\S+\s*|\s+", content)
+
+
+async def wait_latency():
+    await asyncio.sleep((FAKE_LLM_LATENCY_MS + random.uniform(0, FAKE_LLM_JITTER_MS)) / 1000)
+
+
+def completion_chunk(completion_id: str, model: str, delta: dict, finish_reason=None) -> str:
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(chunk)}\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "fake-model")
+    kind = response_kind(body.get("messages", []))
+    content = canned_response(kind)
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+    stats["requests"] += 1
+    stats["by_kind"][kind] += 1
+
+    if FAKE_LLM_ERROR_RATE and random.random() < FAKE_LLM_ERROR_RATE:
+        stats["errors"] += 1
+        await wait_latency()
+        return JSONResponse({"error": {"message": "fake upstream overloaded", "type": "server_error"}}, status_code=503)
+
+    if not body.get("stream"):
+        await wait_latency()
+        tokens = len(split_tokens(content))
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": tokens, "total_tokens": tokens},
+        }
+
+    stats["streamed"] += 1
+
+    async def stream():
+        await wait_latency()
+        yield completion_chunk(completion_id, model, {"role": "assistant", "content": ""})
+        gap = 1 / FAKE_LLM_TOKENS_PER_SECOND if FAKE_LLM_TOKENS_PER_SECOND > 0 else 0
+        for token in split_tokens(content):
+            yield completion_chunk(completion_id, model, {"content": token})
+            if gap:
+                await asyncio.sleep(gap)
+        yield completion_chunk(completion_id, model, {}, "stop")
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+@app.get("/v1/models")
+async def list_models():
+    return {"object": "list", "data": [{"id": "fake-model", "object": "model", "owned_by": "fake_llm"}]}
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Offline OpenAI-compatible LLM stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency-ms", type=int, default=FAKE_LLM_LATENCY_MS)
+    parser.add_argument("--jitter-ms", type=int, default=FAKE_LLM_JITTER_MS)
+    parser.add_argument("--tokens-per-second", type=float, default=FAKE_LLM_TOKENS_PER_SECOND)
+    parser.add_argument("--error-rate", type=float, default=FAKE_LLM_ERROR_RATE)
+    args = parser.parse_args()
+
+    FAKE_LLM_LATENCY_MS = args.latency_ms
+    FAKE_LLM_JITTER_MS = args.jitter_ms
+    FAKE_LLM_TOKENS_PER_SECOND = args.tokens_per_second
+    FAKE_LLM_ERROR_RATE = args.error_rate
+
+    print(f"🤖 Fake LLM on http://{args.host}:{args.port}/v1 "
+          f"(latency {args.latency_ms}ms, {args.tokens_per_second:g} tokens/s, error rate {args.error_rate:g})")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
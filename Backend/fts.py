@@ -0,0 +1,124 @@
+# fts.py
+import sqlite3
+
+from sqlalchemy import text
+
+from db import read_engine, quote_identifier
+from prompts import prompts
+
+# Free-text columns auditors search by keyword
+FTS_COLUMNS = ["ITEM DESCRIPTION", "IMPORTER NAME"]
+
+# unicode61 folds case and diacritics; prefix queries (solar*) are the common case
+FTS_TOKENIZER = "unicode61 remove_diacritics 2"
+
+
+def fts_table(table: str) -> str:
+    return f"{table}_fts"
+
+
+def fts5_available() -> bool:
+    conn = sqlite3.connect(":memory:")
+    try:
+        return bool(conn.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')").fetchone()[0])
+    finally:
+        conn.close()
+
+
+FTS5_AVAILABLE = fts5_available()
+
+
+def _create_triggers(conn, table: str, columns):
+    """Keep the external-content index in step with inserts, updates and deletes."""
+    table_q = quote_identifier(table)
+    fts_q = quote_identifier(fts_table(table))
+    column_list = ", ".join(quote_identifier(c) for c in columns)
+    new_values = ", ".join(f"new.{quote_identifier(c)}" for c in columns)
+    old_values = ", ".join(f"old.{quote_identifier(c)}" for c in columns)
+
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {quote_identifier(table + '_fts_ai')} AFTER INSERT ON {table_q} BEGIN
+            INSERT INTO {fts_q} (rowid, {column_list}) VALUES (new.rowid, {new_values});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {quote_identifier(table + '_fts_ad')} AFTER DELETE ON {table_q} BEGIN
+            INSERT INTO {fts_q} ({fts_q}, rowid, {column_list}) VALUES ('delete', old.rowid, {old_values});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {quote_identifier(table + '_fts_au')} AFTER UPDATE OF {column_list} ON {table_q} BEGIN
+            INSERT INTO {fts_q} ({fts_q}, rowid, {column_list}) VALUES ('delete', old.rowid, {old_values});
+            INSERT INTO {fts_q} (rowid, {column_list}) VALUES (new.rowid, {new_values});
+        END
+    """)
+
+
+def sync_fts(conn, table: str = "customs", rebuild: bool = False):
+    """
+    Make sure `table` has an FTS5 shadow index over FTS_COLUMNS.
+    The index is rebuilt from the table when it is new or `rebuild` is set
+    (after a replace ingest); otherwise triggers have already kept it in sync.
+    """
+    if not FTS5_AVAILABLE:
+        return False
+
+    table_columns = {r[1] for r in conn.execute(f"PRAGMA table_info({quote_identifier(table)})").fetchall()}
+    columns = [c for c in FTS_COLUMNS if c in table_columns]
+    name = fts_table(table)
+    fts_q = quote_identifier(name)
+
+    existing = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+    ).fetchone()
+    column_list = ", ".join(quote_identifier(c) for c in columns)
+    create_sql = (
+        f"CREATE VIRTUAL TABLE {fts_q} USING fts5({column_list}, "
+        f"content={quote_identifier(table)}, content_rowid='rowid', tokenize='{FTS_TOKENIZER}')"
+    )
+
+    # Columns changed since the index was made (or the table lost them entirely)
+    if existing and existing[0] != create_sql:
+        for suffix in ("ai", "ad", "au"):
+            conn.execute(f"DROP TRIGGER IF EXISTS {quote_identifier(f'{table}_fts_{suffix}')}")
+        conn.execute(f"DROP TABLE {fts_q}")
+        existing = None
+    if not columns:
+        return False
+
+    if not existing:
+        conn.execute(create_sql)
+        rebuild = True
+
+    _create_triggers(conn, table, columns)
+    if rebuild:
+        conn.execute(f"INSERT INTO {fts_q} ({fts_q}) VALUES ('rebuild')")
+        print(f"🔎 Rebuilt full-text index {name} over {', '.join(columns)}")
+    return True
+
+
+def fulltext_columns(table: str = "customs", target_engine=None):
+    """Columns covered by the table's full-text index, or [] when there is none."""
+    target_engine = target_engine or read_engine
+    name = fts_table(table)
+    with target_engine.connect() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": name}
+        ).fetchone()
+        if not exists:
+            return []
+        return [r[1] for r in conn.execute(text(f"PRAGMA table_info({quote_identifier(name)})")).fetchall()]
+
+
+def describe_fulltext(table: str = "customs", target_engine=None) -> str:
+    """Full-text search instructions for the SQL generator, if the index exists."""
+    name = fts_table(table)
+    columns = fulltext_columns(table, target_engine)
+    if not columns:
+        return "(no full-text index available - use LIKE for keyword searches)"
+
+    return (
+        prompts.FULLTEXT_SEARCH_INSTRUCTIONS
+        .replace("{{fts_table}}", name)
+        .replace("{{fts_columns}}", ", ".join(quote_identifier(c) for c in columns))
+    )
@@ -0,0 +1,121 @@
+# indexes.py
+from sqlalchemy import text
+
+from db import read_engine, write_transaction, quote_identifier
+
+# Secondary indexes for the columns generated SQL filters and groups on.
+# GD_NO_Complete lookups are served by the unique (GD_NO_Complete, ITEM LINE)
+# key index that ingest creates, and single-column lookups on HS CODE and
+# IMPORTER NAME by the leading column of the composites below.
+# (name suffix, columns)
+CUSTOMS_INDEXES = [
+    ("hs_origin_unit", ["HS CODE", "ORIGIN COUNTRY", "ASSD UNIT"]),
+    ("importer_hs", ["IMPORTER NAME", "HS CODE"]),
+    ("ntn", ["NTN"]),
+    ("origin", ["ORIGIN COUNTRY"]),
+    # lets append refresh the SRO rollup without scanning the table
+    ("sro", ["SRO"]),
+]
+
+
+def index_name(table: str, suffix: str) -> str:
+    return f"ix_{table}_{suffix}"
+
+
+def _index_columns(conn, name: str):
+    return [r[2] for r in conn.execute(f"PRAGMA index_info({quote_identifier(name)})").fetchall()]
+
+
+def ensure_indexes(conn, table: str = "customs"):
+    """
+    Create any missing index from CUSTOMS_INDEXES on `table`.
+    An index whose columns no longer match its definition is dropped and
+    rebuilt. Indexes on columns the table doesn't have are skipped.
+    Returns the names of the indexes that were (re)built.
+    """
+    table_columns = {r[1] for r in conn.execute(f"PRAGMA table_info({quote_identifier(table)})").fetchall()}
+    built = []
+
+    for suffix, columns in CUSTOMS_INDEXES:
+        if not set(columns) <= table_columns:
+            continue
+
+        name = index_name(table, suffix)
+        existing = _index_columns(conn, name)
+        if existing == columns:
+            continue
+        if existing:
+            conn.execute(f"DROP INDEX {quote_identifier(name)}")
+
+        column_list = ", ".join(quote_identifier(c) for c in columns)
+        conn.execute(f"CREATE INDEX {quote_identifier(name)} ON {quote_identifier(table)} ({column_list})")
+        built.append(name)
+
+    if built:
+        print(f"🗂️ Built indexes: {', '.join(built)}")
+    return built
+
+
+def analyze(conn, table: str = "customs"):
+    """Refresh sqlite_stat1 so the planner can choose between the indexes."""
+    conn.execute(f"ANALYZE {quote_identifier(table)}")
+
+
+def index_after_ingest(conn, table: str = "customs"):
+    """
+    Called inside the ingest transaction, after the new rows are in place.
+    A replaced table gets its indexes built from scratch; an appended one
+    already maintains them, so this only refreshes statistics.
+    """
+    built = ensure_indexes(conn, table)
+    analyze(conn, table)
+    return built
+
+
+def rebuild_indexes(table: str = "customs", target_engine=None):
+    """
+    Recreate every index on `table` from its data and re-analyze it.
+    Returns the names of indexes that had to be created first.
+    """
+    with write_transaction(target_engine) as conn:
+        built = ensure_indexes(conn, table)
+        conn.execute(f"REINDEX {quote_identifier(table)}")
+        analyze(conn, table)
+    return built
+
+
+def list_indexes(table: str = "customs", target_engine=None):
+    """Indexes on `table` with their columns and the planner statistics ANALYZE recorded."""
+    target_engine = target_engine or read_engine
+    table_q = quote_identifier(table)
+
+    with target_engine.connect() as conn:
+        index_rows = conn.execute(text(f"PRAGMA index_list({table_q})")).fetchall()
+
+        stats = {}
+        has_stats = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+        ).fetchone()
+        if has_stats:
+            for idx, stat in conn.execute(
+                text("SELECT idx, stat FROM sqlite_stat1 WHERE tbl = :table"), {"table": table}
+            ).fetchall():
+                stats[idx] = stat
+
+        indexes = []
+        for _, name, unique, origin, partial in index_rows:
+            columns = [r[2] for r in conn.execute(text(f"PRAGMA index_info({quote_identifier(name)})")).fetchall()]
+            indexes.append({
+                "name": name,
+                "columns": columns,
+                "unique": bool(unique),
+                "managed": name in {index_name(table, s) for s, _ in CUSTOMS_INDEXES},
+                "stat": stats.get(name)
+            })
+
+    return {
+        "table": table,
+        # every sqlite_stat1 entry starts with the row count of the table
+        "analyzed_rows": int(next(iter(stats.values())).split()[0]) if stats else None,
+        "indexes": indexes
+    }
@@ -0,0 +1,453 @@
+# ingest.py
+import os
+import math
+import tempfile
+from datetime import date, datetime, time
+from itertools import chain
+
+import pandas as pd
+from openpyxl import load_workbook
+from sqlalchemy import text
+
+from db import read_engine, write_transaction, quote_identifier, bump_data_version
+from indexes import index_after_ingest
+from fts import sync_fts
+from rollups import build_rollups, capture_affected, refresh_rollups, summary_from_rollups
+from anomalies import build_price_anomalies, capture_affected_codes
+
+# Rows held in memory at any point during ingest; peak memory is bounded by this,
+# not by the size of the uploaded file
+INGEST_BATCH_ROWS = 5000
+
+# Declaration lines are identified by GD number + item line across uploads
+KEY_COLUMN = "GD_NO_Complete"
+LINE_COLUMN = "ITEM LINE"
+STAGING_SUFFIX = "__staging"
+
+INGEST_MODES = ("replace", "append")
+
+# Size of each read when spooling an upload to disk
+SPOOL_CHUNK_BYTES = 1024 * 1024
+
+
+async def spool_upload(file) -> str:
+    """
+    Copy an UploadFile to a named temporary file in fixed-size chunks
+    and return its path. The caller is responsible for deleting it.
+    """
+    suffix = os.path.splitext(file.filename or "")[1].lower() or ".xlsx"
+    fd, path = tempfile.mkstemp(prefix="upload_", suffix=suffix)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = await file.read(SPOOL_CHUNK_BYTES)
+                if not chunk:
+                    break
+                out.write(chunk)
+    except Exception:
+        os.unlink(path)
+        raise
+    return path
+
+
+def detect_format(path: str) -> str:
+    return "csv" if path.lower().endswith((".csv", ".txt")) else "xlsx"
+
+
+def _clean_cell(value):
+    """Normalise a spreadsheet cell into something sqlite3 can bind."""
+    if value is None:
+        return None
+    if hasattr(value, "item") and not isinstance(value, (str, bytes)):
+        # numpy scalars coming out of pandas CSV chunks
+        value = value.item()
+    if isinstance(value, float) and (math.isnan(value) or math.isinf(value)):
+        return None
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, str):
+        # Port extracts pad text cells to a fixed width ("China      ")
+        value = value.strip()
+        return value if value else None
+    if isinstance(value, (datetime, date, time)):
+        return str(value)
+    return value
+
+
+def _unique_columns(header):
+    """Name columns the way pandas does: blank -> 'Unnamed: i', duplicates -> 'name.1'."""
+    header = list(header)
+    while header and header[-1] is None:
+        header.pop()
+
+    columns = []
+    seen = {}
+    for i, name in enumerate(header):
+        name = f"Unnamed: {i}" if name is None or str(name).strip() == "" else str(name).strip()
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        columns.append(name)
+    return columns
+
+
+def _xlsx_batches(path: str, sheet_name=0, batch_rows: int = INGEST_BATCH_ROWS):
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[sheet_name] if isinstance(sheet_name, int) else workbook[sheet_name]
+        rows = sheet.iter_rows(values_only=True)
+
+        header = next(rows, None)
+        if header is None:
+            raise ValueError("The uploaded sheet is empty")
+        columns = _unique_columns(header)
+        width = len(columns)
+        yield columns
+
+        batch = []
+        for row in rows:
+            values = [_clean_cell(v) for v in row[:width]]
+            if all(v is None for v in values):
+                continue
+            if len(values) < width:
+                values.extend([None] * (width - len(values)))
+            batch.append(tuple(values))
+            if len(batch) >= batch_rows:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        workbook.close()
+
+
+def _csv_batches(path: str, batch_rows: int = INGEST_BATCH_ROWS):
+    columns = None
+    for chunk in pd.read_csv(path, chunksize=batch_rows):
+        if columns is None:
+            columns = _unique_columns(chunk.columns)
+            yield columns
+        yield [
+            tuple(_clean_cell(v) for v in row)
+            for row in chunk.itertuples(index=False, name=None)
+        ]
+    if columns is None:
+        raise ValueError("The uploaded file is empty")
+
+
+def read_batches(path: str, file_format: str = None, sheet_name=0, batch_rows: int = INGEST_BATCH_ROWS):
+    """
+    Open a spreadsheet for streaming.
+    Returns (columns, iterator of row-tuple batches).
+    """
+    file_format = file_format or detect_format(path)
+    if file_format == "csv":
+        stream = _csv_batches(path, batch_rows)
+    else:
+        stream = _xlsx_batches(path, sheet_name, batch_rows)
+    columns = next(stream)
+    return columns, stream
+
+
+def _infer_sql_type(values) -> str:
+    kinds = {type(v) for v in values if v is not None}
+    if not kinds:
+        # Nothing to go on yet; leave the column without affinity so later
+        # numbers aren't coerced to text
+        return ""
+    if kinds <= {int}:
+        return "BIGINT"
+    if kinds <= {int, float}:
+        return "FLOAT"
+    return "TEXT"
+
+
+def create_table_sql(table: str, columns, sample_rows) -> str:
+    """CREATE TABLE statement with column affinities inferred from the first batch."""
+    definitions = []
+    for i, column in enumerate(columns):
+        sql_type = _infer_sql_type(row[i] for row in sample_rows)
+        definitions.append(f"\t{quote_identifier(column)} {sql_type}".rstrip())
+    return f"CREATE TABLE {quote_identifier(table)} (\n" + ", \n".join(definitions) + "\n)"
+
+
+def insert_sql(table: str, columns) -> str:
+    column_list = ", ".join(quote_identifier(c) for c in columns)
+    placeholders = ", ".join("?" for _ in columns)
+    return f"INSERT INTO {quote_identifier(table)} ({column_list}) VALUES ({placeholders})"
+
+
+def _table_columns(conn, table: str):
+    return [r[1] for r in conn.execute(f"PRAGMA table_info({quote_identifier(table)})").fetchall()]
+
+
+def _table_exists(conn, table: str) -> bool:
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone()
+    return row is not None
+
+
+def _with_item_lines(columns, batches):
+    """
+    Add an ITEM LINE column numbering the items of each GD in file order,
+    unless the file already carries one. Together with GD_NO_Complete it
+    identifies a declaration line across uploads.
+    """
+    if LINE_COLUMN in columns or KEY_COLUMN not in columns:
+        return columns, batches
+
+    key_index = columns.index(KEY_COLUMN)
+    lines_seen = {}
+
+    def numbered():
+        for batch in batches:
+            out = []
+            for row in batch:
+                gd_no = row[key_index]
+                line = lines_seen.get(gd_no, 0) + 1
+                lines_seen[gd_no] = line
+                out.append(row + (line,))
+            yield out
+
+    return columns + [LINE_COLUMN], numbered()
+
+
+def _load_staging(conn, staging: str, columns, batches, progress=None):
+    """Create `staging` from the first batch and executemany the rest into it."""
+    first_batch = next(batches, [])
+    conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(staging)}")
+    conn.execute(create_table_sql(staging, columns, first_batch))
+
+    total_rows = 0
+    statement = insert_sql(staging, columns)
+    for batch in chain([first_batch], batches):
+        if not batch:
+            continue
+        conn.executemany(statement, batch)
+        total_rows += len(batch)
+        print(f"📥 Staged {total_rows:,} rows")
+        if progress:
+            progress("insert", total_rows)
+    return total_rows
+
+
+def _dedupe_staging(conn, staging: str) -> int:
+    """Keep only the last copy of each (GD, item line) inside the upload itself."""
+    key = f"{quote_identifier(KEY_COLUMN)}, {quote_identifier(LINE_COLUMN)}"
+    conn.execute(f"""
+        DELETE FROM {quote_identifier(staging)}
+        WHERE {quote_identifier(KEY_COLUMN)} IS NOT NULL
+          AND rowid NOT IN (
+              SELECT MAX(rowid) FROM {quote_identifier(staging)}
+              WHERE {quote_identifier(KEY_COLUMN)} IS NOT NULL
+              GROUP BY {key}
+          )
+    """)
+    return conn.execute("SELECT changes()").fetchone()[0]
+
+
+def _ensure_key_index(conn, table: str):
+    conn.execute(
+        f"CREATE UNIQUE INDEX IF NOT EXISTS {quote_identifier(f'ux_{table}_gd_item_line')} "
+        f"ON {quote_identifier(table)} ({quote_identifier(KEY_COLUMN)}, {quote_identifier(LINE_COLUMN)})"
+    )
+
+
+def _backfill_item_lines(conn, table: str):
+    """Number item lines on a table loaded before ITEM LINE existed."""
+    table_q = quote_identifier(table)
+    key_q = quote_identifier(KEY_COLUMN)
+    line_q = quote_identifier(LINE_COLUMN)
+    print(f"🔄 Backfilling {LINE_COLUMN} on {table}")
+    conn.execute(f"ALTER TABLE {table_q} ADD COLUMN {line_q} BIGINT")
+    conn.execute(f"""
+        UPDATE {table_q} SET {line_q} = numbered.line
+        FROM (
+            SELECT rowid AS rid, ROW_NUMBER() OVER (PARTITION BY {key_q} ORDER BY rowid) AS line
+            FROM {table_q}
+        ) AS numbered
+        WHERE {table_q}.rowid = numbered.rid
+    """)
+
+
+def _swap_in(conn, staging: str, table: str):
+    conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(table)}")
+    conn.execute(f"ALTER TABLE {quote_identifier(staging)} RENAME TO {quote_identifier(table)}")
+
+
+def _merge_staging(conn, staging: str, table: str, before_upsert=None):
+    """
+    Upsert staging rows into `table` on (GD_NO_Complete, ITEM LINE).
+    Only the delta is scanned; existing rows are reached through the key index.
+    `before_upsert(conn, key_match)` runs just before rows are written, with
+    key_match joining staging (s) to the table (t).
+    Returns (inserted, updated, skipped).
+    """
+    table_q = quote_identifier(table)
+    staging_q = quote_identifier(staging)
+
+    if LINE_COLUMN not in _table_columns(conn, table):
+        _backfill_item_lines(conn, table)
+    _ensure_key_index(conn, table)
+
+    # Columns that only the new file has are added to the live table
+    existing = set(_table_columns(conn, table))
+    staging_info = conn.execute(f"PRAGMA table_info({staging_q})").fetchall()
+    for _, column, sql_type, *_ in staging_info:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE {table_q} ADD COLUMN {quote_identifier(column)} {sql_type}".rstrip())
+
+    columns = [r[1] for r in staging_info]
+    column_list = ", ".join(quote_identifier(c) for c in columns)
+    key_match = " AND ".join(
+        f"t.{quote_identifier(c)} = s.{quote_identifier(c)}" for c in (KEY_COLUMN, LINE_COLUMN)
+    )
+    same_values = " AND ".join(f"t.{quote_identifier(c)} IS s.{quote_identifier(c)}" for c in columns)
+
+    staged = conn.execute(f"SELECT COUNT(*) FROM {staging_q}").fetchone()[0]
+    matched, unchanged = conn.execute(f"""
+        SELECT COUNT(*), COALESCE(SUM(CASE WHEN {same_values} THEN 1 ELSE 0 END), 0)
+        FROM {staging_q} AS s JOIN {table_q} AS t ON {key_match}
+    """).fetchone()
+
+    if before_upsert:
+        before_upsert(conn, key_match)
+
+    assignments = ", ".join(f"{quote_identifier(c)} = excluded.{quote_identifier(c)}" for c in columns)
+    changed = " OR ".join(
+        f"{table_q}.{quote_identifier(c)} IS NOT excluded.{quote_identifier(c)}" for c in columns
+    )
+    conn.execute(f"""
+        INSERT INTO {table_q} ({column_list})
+        SELECT {column_list} FROM {staging_q} WHERE true
+        ON CONFLICT ({quote_identifier(KEY_COLUMN)}, {quote_identifier(LINE_COLUMN)})
+        DO UPDATE SET {assignments}
+        WHERE {changed}
+    """)
+    conn.execute(f"DROP TABLE {staging_q}")
+
+    return staged - matched, matched - unchanged, unchanged
+
+
+def ingest_file(path: str, table: str = "customs", file_format: str = None, sheet_name=0,
+                mode: str = "replace", batch_rows: int = INGEST_BATCH_ROWS, target_engine=None,
+                progress=None):
+    """
+    Stream a CSV/XLSX file into `table`.
+    Rows are read in batches of `batch_rows` and executemany'd into a staging
+    table, which is then swapped in (mode="replace") or upserted on
+    GD_NO_Complete + ITEM LINE (mode="append"). Everything runs in one
+    transaction, so readers see either the old table or the new one.
+    `progress(phase, rows_processed)` is called as the ingest advances.
+    """
+    if mode not in INGEST_MODES:
+        raise ValueError(f"Invalid ingest mode '{mode}'. Use one of: {', '.join(INGEST_MODES)}")
+
+    if progress:
+        progress("parse", 0)
+    columns, batches = read_batches(path, file_format, sheet_name, batch_rows)
+    columns, batches = _with_item_lines(columns, batches)
+    has_key = KEY_COLUMN in columns and LINE_COLUMN in columns
+    if mode == "append" and not has_key:
+        raise ValueError(f"Append mode needs a '{KEY_COLUMN}' column to match rows on")
+
+    staging = f"{table}{STAGING_SUFFIX}"
+
+    with write_transaction(target_engine) as conn:
+        staged_rows = _load_staging(conn, staging, columns, batches, progress)
+        duplicates = _dedupe_staging(conn, staging) if has_key else 0
+
+        appending = mode == "append" and _table_exists(conn, table)
+        if appending:
+            inserted, updated, skipped = _merge_staging(
+                conn, staging, table,
+                before_upsert=lambda c, key_match: capture_affected(c, staging, table, key_match)
+            )
+        else:
+            _swap_in(conn, staging, table)
+            if has_key:
+                _ensure_key_index(conn, table)
+            inserted, updated, skipped = staged_rows - duplicates, 0, 0
+
+        if progress:
+            progress("index", staged_rows)
+        index_after_ingest(conn, table)
+        sync_fts(conn, table, rebuild=not appending)
+
+        if progress:
+            progress("rollup", staged_rows)
+        if appending:
+            # refresh_rollups() drops the capture; the anomaly stage needs its HS codes
+            rescore_codes = capture_affected_codes(conn)
+            refresh_rollups(conn, table)
+        else:
+            build_rollups(conn, table)
+
+        if progress:
+            progress("anomalies", staged_rows)
+        flagged = build_price_anomalies(conn, table, delta=appending and rescore_codes)
+
+        data_version = bump_data_version(conn, table)
+
+    result = {
+        "table": table,
+        "mode": mode,
+        "rows": staged_rows,
+        "inserted": inserted,
+        "updated": updated,
+        "skipped": skipped + duplicates,
+        "data_version": data_version,
+        "flagged_anomalies": flagged,
+        "columns": columns
+    }
+    print(f"✅ Ingest complete ({mode}): {inserted:,} inserted, {updated:,} updated, "
+          f"{skipped + duplicates:,} skipped")
+    return result
+
+
+def summarize_table(table: str = "customs", target_engine=None):
+    """
+    Upload summary computed by SQLite instead of over an in-memory DataFrame.
+    Read from the rollup tables when they exist, otherwise from the table itself.
+    """
+    target_engine = target_engine or read_engine
+    table_q = quote_identifier(table)
+
+    with target_engine.connect() as conn:
+        columns = [r[1] for r in conn.execute(text(f"PRAGMA table_info({table_q})")).fetchall()]
+
+        summary = summary_from_rollups(conn, table)
+        if summary is not None:
+            summary["columns"] = columns
+            return summary
+
+        def distinct(column):
+            return f"COUNT(DISTINCT {quote_identifier(column)})" if column in columns else "0"
+
+        def total(column):
+            return f"COALESCE(SUM({quote_identifier(column)}), 0)" if column in columns else "0"
+
+        row = conn.execute(text(f"""
+            SELECT COUNT(*),
+                   {distinct('IMPORTER NAME')},
+                   {distinct('HS CODE')},
+                   {distinct('ORIGIN COUNTRY')},
+                   {total('ASSESSED IMPORT VALUE RS')},
+                   {total('Customs Duty PAID')},
+                   {total('Sales Tax PAID')}
+            FROM {table_q}
+        """)).fetchone()
+
+    return {
+        "totalRows": int(row[0]),
+        "uniqueImporters": int(row[1]),
+        "uniqueHSCodes": int(row[2]),
+        "uniqueCountries": int(row[3]),
+        "totalValue": float(row[4]),
+        "totalDutyPaid": float(row[5]),
+        "totalTaxPaid": float(row[6]),
+        "columns": columns
+    }
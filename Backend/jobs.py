@@ -0,0 +1,139 @@
+# jobs.py
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# SQLite has a single writer per file, so with one shared database ingest jobs
+# run one at a time. Per-session datasets can ingest side by side.
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "1"))
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+
+# Finished jobs kept around for polling before the oldest are dropped
+MAX_FINISHED_JOBS = 200
+
+FINISHED_STATES = ("done", "failed")
+
+_jobs = OrderedDict()
+_jobs_lock = threading.Lock()
+
+
+class Job:
+    """
+    Progress of one background job. Workers call update(); readers take
+    snapshot(), which is safe to serialise as JSON.
+    """
+
+    def __init__(self, kind: str, details: dict = None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.details = details or {}
+        self.phase = "queued"
+        self.rows_processed = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        # bumped on every update so streams can tell when to emit
+        self.version = 0
+        self._lock = threading.Lock()
+
+    def update(self, phase: str = None, rows_processed: int = None):
+        with self._lock:
+            if phase and phase != self.phase:
+                self.phase = phase
+                print(f"⏳ Job {self.id[:8]}: {phase}")
+            if rows_processed is not None:
+                self.rows_processed = rows_processed
+            self.version += 1
+
+    def publish(self, result):
+        """Partial result of a job still running, e.g. a ranking so far."""
+        with self._lock:
+            self.result = result
+            self.version += 1
+
+    def start(self):
+        with self._lock:
+            self.started_at = time.time()
+            self.version += 1
+
+    def finish(self, result=None, error: str = None):
+        with self._lock:
+            self.finished_at = time.time()
+            self.phase = "failed" if error else "done"
+            self.result = result
+            self.error = error
+            self.version += 1
+
+    @property
+    def finished(self) -> bool:
+        return self.phase in FINISHED_STATES
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            elapsed = None
+            throughput = None
+            if self.started_at:
+                elapsed = (self.finished_at or time.time()) - self.started_at
+                if elapsed > 0:
+                    throughput = round(self.rows_processed / elapsed, 1)
+            return {
+                "job_id": self.id,
+                "kind": self.kind,
+                "phase": self.phase,
+                "status": self.phase if self.finished else ("queued" if self.phase == "queued" else "running"),
+                "rows_processed": self.rows_processed,
+                "rows_per_second": throughput,
+                "elapsed_seconds": round(elapsed, 2) if elapsed is not None else None,
+                "details": self.details,
+                "result": self.result,
+                "error": self.error,
+                "version": self.version
+            }
+
+
+def _prune():
+    finished = [job_id for job_id, job in _jobs.items() if job.finished]
+    for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+        del _jobs[job_id]
+
+
+def submit_job(kind: str, fn, *args, details: dict = None, executor=None, cleanup=None, **kwargs):
+    """
+    Run fn(job, *args, **kwargs) in the background and return the Job.
+    fn's return value becomes the job result; an exception marks it failed.
+    `cleanup` runs after fn whatever the outcome.
+    """
+    job = Job(kind, details)
+    with _jobs_lock:
+        _jobs[job.id] = job
+        _prune()
+
+    def run():
+        job.start()
+        try:
+            job.finish(result=fn(job, *args, **kwargs))
+        except Exception as e:
+            traceback.print_exc()
+            job.finish(error=str(e))
+        finally:
+            if cleanup:
+                cleanup()
+
+    (executor or ingest_executor).submit(run)
+    return job
+
+
+def get_job(job_id: str):
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def list_jobs():
+    with _jobs_lock:
+        return [job.snapshot() for job in reversed(_jobs.values())]
@@ -2,18 +2,53 @@
 # llm.py
 import requests
 import json
-from openai import OpenAI
+import httpx
+from openai import OpenAI, AsyncOpenAI
+from llm_resilience import call_with_resilience, stream_with_resilience, LLMEmptyResponse
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
+LLM_BASE_URL = os.getenv("LLM_BASE_URL", "https://openrouter.ai/api/v1")
+
 # Initialize OpenRouter client
 client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
+    base_url=LLM_BASE_URL,
     api_key=os.getenv("OPENAI_API_KEY")
 )
 
+# Async client shared by every /query. One pooled httpx client keeps TLS
+# connections to the provider alive between requests, so concurrency is
+# bounded by LLM_MAX_CONNECTIONS sockets rather than server threads.
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "200"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "50"))
+LLM_KEEPALIVE_SECONDS = float(os.getenv("LLM_KEEPALIVE_SECONDS", "60"))
+LLM_CONNECT_TIMEOUT_SECONDS = float(os.getenv("LLM_CONNECT_TIMEOUT_SECONDS", "10"))
+# Streams can pause between tokens while a reasoning model thinks
+LLM_READ_TIMEOUT_SECONDS = float(os.getenv("LLM_READ_TIMEOUT_SECONDS", "120"))
+
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE,
+        keepalive_expiry=LLM_KEEPALIVE_SECONDS
+    ),
+    timeout=httpx.Timeout(LLM_READ_TIMEOUT_SECONDS, connect=LLM_CONNECT_TIMEOUT_SECONDS)
+)
+
+# Retries and timeouts are handled per call in llm_resilience, not by the SDK
+async_client = AsyncOpenAI(
+    base_url=LLM_BASE_URL,
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=http_client,
+    max_retries=0
+)
+
+async def aclose_llm_clients():
+    """Close pooled connections on shutdown"""
+    await async_client.close()
+
 OLLAMA_URL = "http://localhost:11434/api/generate"
 
 def check_ollama():
@@ -67,6 +102,15 @@ SQL_MODEL = "openai/gpt-oss-20b:free"
 # Model for data analysis
 ANALYSIS_MODEL = "tngtech/deepseek-r1t2-chimera:free"
 
+# Hedge/fallback targets when a model is slow, rate limited or its circuit is open.
+# By default the two models back each other up; set to "" to disable.
+SQL_FALLBACK_MODEL = os.getenv("SQL_FALLBACK_MODEL", ANALYSIS_MODEL)
+ANALYSIS_FALLBACK_MODEL = os.getenv("ANALYSIS_FALLBACK_MODEL", SQL_MODEL)
+FALLBACK_MODELS = {
+    SQL_MODEL: SQL_FALLBACK_MODEL,
+    ANALYSIS_MODEL: ANALYSIS_FALLBACK_MODEL,
+}
+
 def generate_llm_response(system_prompt: str, user_prompt: str, model: str = SQL_MODEL):
     """
     Generate SQL queries using OpenRouter
@@ -114,6 +158,56 @@ def stream_llm_analysis(prompt: str, model: str = ANALYSIS_MODEL):
         print(f"Streaming Error: {e}")
         yield f"Error generating analysis: {str(e)}"
 
+async def agenerate_llm_response(system_prompt: str, user_prompt: str, model: str = SQL_MODEL,
+                                 fallback_model: str = None):
+    """
+    Async generate_llm_response over the pooled client
+    Used by the async /query pipeline. Deadlines, retries, hedging to the
+    fallback model and circuit breaking come from llm_resilience; raises
+    LLMUnavailable instead of returning None
+    """
+    async def complete(candidate: str):
+        response = await async_client.chat.completions.create(
+            model=candidate,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ]
+        )
+        content = response.choices[0].message.content if response.choices else None
+        if not content or not content.strip():
+            raise LLMEmptyResponse(f"{candidate} returned no content")
+        return content
+
+    return await call_with_resilience(complete, model, fallback_model or FALLBACK_MODELS.get(model))
+
+async def astream_llm_analysis(prompt: str, model: str = ANALYSIS_MODEL, fallback_model: str = None):
+    """
+    Async stream_llm_analysis over the pooled client, with the same
+    resilience as agenerate_llm_response up to the first token.
+    Raises LLMUnavailable instead of yielding an error string
+    """
+    async def open_stream(candidate: str):
+        stream = await async_client.chat.completions.create(
+            model=candidate,
+            messages=[
+                {"role": "user", "content": prompt}
+            ],
+            stream=True
+        )
+        try:
+            async for chunk in stream:
+                # Skip empty content and reasoning tokens
+                if chunk.choices and chunk.choices[0].delta.content:
+                    content = chunk.choices[0].delta.content
+                    if content.strip():
+                        yield content
+        finally:
+            await stream.close()
+
+    async for content in stream_with_resilience(open_stream, model, fallback_model or FALLBACK_MODELS.get(model)):
+        yield content
+
 
 
 # llm.py
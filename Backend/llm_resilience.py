@@ -0,0 +1,330 @@
+# llm_resilience.py
+import asyncio
+import os
+import random
+import time
+from collections import deque
+
+import httpx
+import openai
+
+# Whole-call budget, retries and hedges included
+LLM_DEADLINE_SECONDS = float(os.getenv("LLM_DEADLINE_SECONDS", "60"))
+# One attempt: a full completion, or the first token of a stream
+LLM_ATTEMPT_TIMEOUT_SECONDS = float(os.getenv("LLM_ATTEMPT_TIMEOUT_SECONDS", "25"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_BACKOFF_BASE_SECONDS = 0.5
+LLM_BACKOFF_MAX_SECONDS = 8.0
+# Start the same request on the fallback model if nothing has come back by then (0 disables)
+LLM_HEDGE_AFTER_MS = int(os.getenv("LLM_HEDGE_AFTER_MS", "6000"))
+# Longest gap allowed between two tokens once a stream has started
+LLM_STREAM_IDLE_SECONDS = float(os.getenv("LLM_STREAM_IDLE_SECONDS", "30"))
+
+# Consecutive retryable failures before a model is skipped, and for how long
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.getenv("LLM_BREAKER_COOLDOWN_SECONDS", "30"))
+
+# Latencies kept per model for the percentiles in /llm/stats
+LATENCY_WINDOW = 500
+
+
+class LLMUnavailable(Exception):
+    """No model produced a response within the deadline."""
+
+
+class LLMEmptyResponse(Exception):
+    """The model answered with no content."""
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Timeouts, dropped connections, 429s and 5xx are worth another try; 4xx are not."""
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, (
+        asyncio.TimeoutError, LLMEmptyResponse, openai.APIConnectionError, httpx.TransportError
+    ))
+
+
+def _retry_after(error: BaseException):
+    """Seconds a 429 asked us to wait, if it said."""
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def backoff_delay(attempt: int, error: BaseException = None) -> float:
+    """Full-jitter exponential backoff, stretched to honour Retry-After."""
+    delay = random.uniform(0, min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * 2 ** attempt))
+    retry_after = _retry_after(error) if error is not None else None
+    if retry_after:
+        delay = max(delay, min(retry_after, LLM_BACKOFF_MAX_SECONDS))
+    return delay
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `failures` consecutive retryable failures.
+    After `cooldown` seconds one probe call is let through (half-open);
+    its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failures: int = LLM_BREAKER_FAILURES, cooldown: float = LLM_BREAKER_COOLDOWN_SECONDS):
+        self.failure_threshold = failures
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+            return True
+        return False
+
+    def record_success(self):
+        self.state = "closed"
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                print(f"🔌 Circuit opened after {self.consecutive_failures} failures")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release_probe(self):
+        """A half-open probe was cancelled before it finished; let the next call probe."""
+        if self.state == "half_open":
+            self.state = "open"
+
+
+class ModelStats:
+    """Outcome counters and recent latencies for one model."""
+
+    def __init__(self):
+        self.attempts = 0
+        self.successes = 0
+        self.failures = 0
+        self.timeouts = 0
+        # attempts abandoned because the other side of a hedge answered first
+        self.cancelled = 0
+        self.rate_limited = 0
+        self.retries = 0
+        self.hedges_started = 0
+        self.hedge_wins = 0
+        self.breaker_rejections = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def snapshot(self):
+        ordered = sorted(self.latencies)
+
+        def percentile(p):
+            if not ordered:
+                return None
+            return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))], 3)
+
+        return {
+            "attempts": self.attempts,
+            "successes": self.successes,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+            "rate_limited": self.rate_limited,
+            "retries": self.retries,
+            "hedges_started": self.hedges_started,
+            "hedge_wins": self.hedge_wins,
+            "breaker_rejections": self.breaker_rejections,
+            "latency_p50": percentile(50),
+            "latency_p95": percentile(95),
+            "latency_p99": percentile(99),
+        }
+
+
+_breakers = {}
+_stats = {}
+
+
+def breaker(model: str) -> CircuitBreaker:
+    if model not in _breakers:
+        _breakers[model] = CircuitBreaker()
+    return _breakers[model]
+
+
+def model_stats(model: str) -> ModelStats:
+    if model not in _stats:
+        _stats[model] = ModelStats()
+    return _stats[model]
+
+
+def llm_stats():
+    return {
+        model: {**stats.snapshot(), "circuit": breaker(model).state}
+        for model, stats in _stats.items()
+    }
+
+
+async def _attempt(fn, model: str, timeout: float):
+    """One call of fn(model) under `timeout`, recorded in the model's stats and breaker."""
+    stats = model_stats(model)
+    stats.attempts += 1
+    started = time.monotonic()
+    try:
+        result = await asyncio.wait_for(fn(model), timeout)
+    except asyncio.CancelledError:
+        # lost a hedge race; says nothing about the model's health
+        stats.cancelled += 1
+        breaker(model).release_probe()
+        raise
+    except Exception as e:
+        stats.failures += 1
+        if isinstance(e, asyncio.TimeoutError):
+            stats.timeouts += 1
+        elif isinstance(e, openai.RateLimitError):
+            stats.rate_limited += 1
+        if is_retryable(e):
+            breaker(model).record_failure()
+        print(f"⚠️ LLM {model} failed after {time.monotonic() - started:.1f}s: {type(e).__name__}: {e}")
+        raise
+    stats.successes += 1
+    stats.latencies.append(time.monotonic() - started)
+    breaker(model).record_success()
+    return result
+
+
+async def _discard(result, close):
+    if close is not None:
+        try:
+            await close(result)
+        except Exception:
+            pass
+
+
+async def _hedged(fn, model: str, fallback: str, timeout: float, close=None):
+    """
+    Run fn(model); if it hasn't finished after LLM_HEDGE_AFTER_MS, also run
+    fn(fallback) and take whichever succeeds first. `close` disposes of a
+    result that arrived but lost.
+    """
+    primary = asyncio.ensure_future(_attempt(fn, model, timeout))
+    tasks = [primary]
+    try:
+        hedge_after = LLM_HEDGE_AFTER_MS / 1000
+        if fallback and hedge_after > 0:
+            done, _ = await asyncio.wait([primary], timeout=min(hedge_after, timeout))
+            if not done and breaker(fallback).allow():
+                model_stats(model).hedges_started += 1
+                print(f"🪁 No answer from {model} after {hedge_after:g}s, hedging with {fallback}")
+                tasks.append(asyncio.ensure_future(_attempt(fn, fallback, timeout)))
+
+        errors = []
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winners = [t for t in tasks if t in done and t.exception() is None]
+            errors += [t.exception() for t in tasks if t in done and t.exception() is not None]
+            if winners:
+                for loser in winners[1:]:
+                    await _discard(loser.result(), close)
+                if winners[0] is not primary:
+                    model_stats(fallback).hedge_wins += 1
+                return winners[0].result()
+        raise errors[0]
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+def _choose_models(model: str, fallback: str = None):
+    """(model to call, model to hedge with) given which circuits are open."""
+    fallback = fallback if fallback and fallback != model else None
+    if breaker(model).allow():
+        return model, fallback
+    model_stats(model).breaker_rejections += 1
+    if fallback and breaker(fallback).allow():
+        return fallback, None
+    return None, None
+
+
+async def call_with_resilience(fn, model: str, fallback: str = None, deadline: float = LLM_DEADLINE_SECONDS,
+                               close=None):
+    """
+    await fn(model) with per-attempt timeouts, jittered retries, per-model
+    circuit breakers and a hedged request to `fallback`. Raises LLMUnavailable
+    once the deadline or retries run out, or on a non-retryable error.
+    """
+    end = time.monotonic() + deadline
+    last_error = None
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            break
+
+        current, hedge = _choose_models(model, fallback)
+        if current is None:
+            last_error = LLMUnavailable(f"circuit open for {model}" + (f" and {fallback}" if fallback else ""))
+        else:
+            try:
+                return await _hedged(fn, current, hedge, min(LLM_ATTEMPT_TIMEOUT_SECONDS, remaining), close)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise LLMUnavailable(f"{type(e).__name__}: {e}") from e
+                last_error = e
+
+        if attempt == LLM_MAX_RETRIES:
+            break
+        delay = backoff_delay(attempt, last_error)
+        if time.monotonic() + delay >= end:
+            break
+        model_stats(model).retries += 1
+        await asyncio.sleep(delay)
+
+    reason = f"{type(last_error).__name__}: {last_error}" if last_error else "deadline exceeded"
+    raise LLMUnavailable(f"LLM {model} unavailable ({reason})") from last_error
+
+
+async def stream_with_resilience(open_stream, model: str, fallback: str = None):
+    """
+    Stream text from open_stream(model), an async generator of chunks.
+    Retries, hedging and breakers apply up to the first non-blank chunk;
+    after that a stream that stalls for LLM_STREAM_IDLE_SECONDS or fails
+    raises LLMUnavailable, since the tokens already sent can't be taken back.
+    """
+    async def first_chunk(candidate):
+        chunks = open_stream(candidate).__aiter__()
+        try:
+            while True:
+                chunk = await chunks.__anext__()
+                if chunk and chunk.strip():
+                    return candidate, chunk, chunks
+        except StopAsyncIteration:
+            raise LLMEmptyResponse(f"{candidate} returned an empty stream")
+        except BaseException:
+            await _discard(chunks, lambda c: c.aclose())
+            raise
+
+    winner, chunk, chunks = await call_with_resilience(
+        first_chunk, model, fallback, close=lambda result: result[2].aclose()
+    )
+    try:
+        yield chunk
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), LLM_STREAM_IDLE_SECONDS)
+            except StopAsyncIteration:
+                break
+            except Exception as e:
+                model_stats(winner).failures += 1
+                if is_retryable(e):
+                    breaker(winner).record_failure()
+                reason = f"no token for {LLM_STREAM_IDLE_SECONDS:g}s" if isinstance(e, asyncio.TimeoutError) else f"{type(e).__name__}: {e}"
+                raise LLMUnavailable(f"LLM {winner} stream broke off ({reason})") from e
+            yield chunk
+    finally:
+        await _discard(chunks, lambda c: c.aclose())
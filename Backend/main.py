@@ -2,23 +2,58 @@
 from fastapi import FastAPI, HTTPException, File, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from models.request_models import QueryRequest
-from db import engine, get_schema, attach_schema_descriptions
-from agents.sql_agent import generate_sql, sanitize_sql
-from agents.analysis_agent import analyze_data_stream
+from agents.sql_agent import agenerate_sql, sanitize_sql
+from agents.analysis_agent import aanalyze_data_stream
+from agents.intent_matcher import match_intent, intent_stats, hs_code_range
+from agents.prompt_builder import relevant_columns
+from stats_engine import result_profile
+from sampling import sample_rows
+from result_store import result_store
+from anomalies import list_anomalies, flagged_in_result
+from audit_scan import run_audit_scan, audit_executor, shutdown_process_pool, AUDIT_TOP_IMPORTERS
+from ingest import spool_upload, ingest_file, summarize_table, INGEST_MODES
+from indexes import list_indexes, rebuild_indexes
+from jobs import submit_job, get_job, list_jobs
+from datasets import datasets, DatasetNotFound, DATASET_EVICT_INTERVAL_SECONDS
+from query_executor import execute_query, QueryRejected, QueryTimeout
+from sql_cache import sql_cache, cache_key, SQL_CACHE_ENABLED
+from llm import SQL_MODEL, ANALYSIS_MODEL, aclose_llm_clients
+from response_cache import response_cache, response_key, replay_tokens, RESPONSE_CACHE_ENABLED, RESPONSE_REPLAY_DELAY_MS
+from llm_resilience import LLMUnavailable, llm_stats
+from fastapi.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager, contextmanager, ExitStack
 import pandas as pd
 from sqlalchemy import text
 from fastapi.responses import StreamingResponse, Response, FileResponse
 from io import BytesIO
 import os
 import json
+import asyncio
 import hashlib
+import uuid
 from datetime import datetime
 import numpy as np
 
-from agents.visualization_agent import generate_visualization_code
+from agents.visualization_agent import agenerate_visualization_code
 from utility.utils import execute_visualization_code
+from utility.sse import sse_event, coalesce_tokens, TextBuffer, HEARTBEAT_FRAME
 
-app = FastAPI()
+async def evict_idle_datasets():
+    """Close datasets idle past DATASET_IDLE_SECONDS even when no new session arrives to trigger it"""
+    while True:
+        await asyncio.sleep(DATASET_EVICT_INTERVAL_SECONDS)
+        await asyncio.to_thread(datasets.evict_idle)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    evictor = asyncio.create_task(evict_idle_datasets())
+    yield
+    evictor.cancel()
+    await aclose_llm_clients()
+    shutdown_process_pool()
+    result_store.purge()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -28,41 +63,154 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Store query results temporarily (in production use Redis or similar)
-query_results_cache = {}
+# How often /jobs/{id}/events checks for progress
+JOB_EVENTS_POLL_SECONDS = 0.5
+
+# Generate chart code alongside the analysis stream instead of after it.
+# QueryRequest.parallel_visualization overrides this per request.
+PARALLEL_VISUALIZATION = os.getenv("PARALLEL_VISUALIZATION", "1") == "1"
 
 @app.get("/")
 async def root():
     return {"message": "Customs Data Analysis API is running"}
 
+def remove_file(path: str):
+    if path and os.path.exists(path):
+        os.unlink(path)
+
+@contextmanager
+def dataset_errors():
+    """
+    A malformed session id, or (in per-session mode) one nothing has been
+    uploaded for yet, as an HTTP error
+    """
+    try:
+        yield
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    except DatasetNotFound as e:
+        raise HTTPException(404, str(e))
+
+def get_dataset(session_id: str = None, create: bool = False):
+    """Dataset for a session"""
+    with dataset_errors():
+        return datasets.get(session_id, create=create)
+
+def run_ingest_job(job, path: str, mode: str, session_id: str):
+    """
+    Background ingest: parse -> insert -> index -> summarise
+    """
+    with datasets.lease(session_id, create=True) as dataset:
+        result = ingest_file(path, mode=mode, target_engine=dataset.write_engine, progress=job.update)
+        dataset.schema_registry.invalidate()
+
+        job.update("summarise")
+        summary = summarize_table(target_engine=dataset.read_engine)
+
+    return {
+        "summary": summary,
+        "ingest": {k: result[k] for k in ("mode", "inserted", "updated", "skipped")}
+    }
+
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(file: UploadFile = File(...), mode: str = "replace", session_id: str = None):
+    """
+    Spool the upload to disk and ingest it in the background.
+    mode=replace swaps the uploaded file in as the whole customs table,
+    mode=append upserts it on GD_NO_Complete + ITEM LINE.
+    With DATASET_MODE=session the data goes to the session's own database;
+    a new session id is issued when none is given.
+    Poll /jobs/{job_id} (or stream /jobs/{job_id}/events) for progress and the summary.
+    """
+    if mode not in INGEST_MODES:
+        raise HTTPException(400, f"Invalid mode. Use one of: {', '.join(INGEST_MODES)}")
+
+    if not session_id:
+        session_id = uuid.uuid4().hex if datasets.mode == "session" else "user_session_1"
     try:
-        contents = await file.read()
-        df = pd.read_excel(BytesIO(contents))
-        df.to_sql("customs", engine, if_exists="replace", index=False)
-        
-        summary = {
-            "totalRows": len(df),
-            "uniqueImporters": int(df['IMPORTER NAME'].nunique()) if 'IMPORTER NAME' in df.columns else 0,
-            "uniqueHSCodes": int(df['HS CODE'].nunique()) if 'HS CODE' in df.columns else 0,
-            "uniqueCountries": int(df['ORIGIN COUNTRY'].nunique()) if 'ORIGIN COUNTRY' in df.columns else 0,
-            "totalValue": float(df['ASSESSED IMPORT VALUE RS'].sum()) if 'ASSESSED IMPORT VALUE RS' in df.columns else 0,
-            "totalDutyPaid": float(df['Customs Duty PAID'].sum()) if 'Customs Duty PAID' in df.columns else 0,
-            "totalTaxPaid": float(df['Sales Tax PAID'].sum()) if 'Sales Tax PAID' in df.columns else 0,
-            "columns": df.columns.tolist()
-        }
+        session_id = datasets.resolve_session_id(session_id)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
 
-        session_id = "user_session_1"
-        
-        return {"status": "success", "summary": summary, "session_id": session_id}
+    try:
+        path = await spool_upload(file)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+    job = submit_job(
+        "ingest",
+        run_ingest_job, path, mode, session_id,
+        details={"filename": file.filename, "mode": mode, "session_id": session_id},
+        cleanup=lambda: remove_file(path)
+    )
+
+    return {"status": "accepted", "job_id": job.id, "session_id": session_id}
+
+def run_audit_job(job, session_id: str, top: int):
+    """
+    Background audit scan: importer risk ranking over the whole table,
+    published to the job after every partition
+    """
+    with datasets.lease(session_id) as dataset:
+        columns = dataset.schema_registry.current()["columns"]
+        return run_audit_scan(
+            dataset.path, columns, target_engine=dataset.read_engine,
+            progress=job.update, publish=job.publish, top=top
+        )
+
+@app.post("/audit/scan")
+def start_audit_scan(session_id: str = None, top: int = AUDIT_TOP_IMPORTERS):
+    """
+    Rank importers by audit risk across the full dataset, scanned in parallel worker processes.
+    Poll /jobs/{job_id} or stream /jobs/{job_id}/events: the ranking so far is in "result"
+    while the scan runs.
+    """
+    get_dataset(session_id)
+    job = submit_job(
+        "audit_scan",
+        run_audit_job, session_id, max(1, min(top, 1000)),
+        details={"session_id": session_id, "top": top},
+        executor=audit_executor
+    )
+    return {"status": "accepted", "job_id": job.id}
+
+@app.get("/jobs")
+def get_jobs():
+    return {"jobs": list_jobs()}
+
+@app.get("/jobs/{job_id}")
+def get_job_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(404, "Job not found")
+    return job.snapshot()
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    """
+    SSE stream of job snapshots, sent whenever the job changes, until it finishes
+    """
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(404, "Job not found")
+
+    async def event_generator():
+        last_version = -1
+        while True:
+            snapshot = job.snapshot()
+            if snapshot["version"] != last_version:
+                last_version = snapshot["version"]
+                yield f"data: {json.dumps(snapshot)}\n\n"
+            if job.finished:
+                break
+            await asyncio.sleep(JOB_EVENTS_POLL_SECONDS)
+
+    return StreamingResponse(event_generator(), media_type="text/event-stream")
+
 @app.get("/health")
-async def health_check():
+async def health_check(session_id: str = None):
     try:
-        with engine.connect() as conn:
+        with datasets.get(session_id).read_engine.connect() as conn:
             result = conn.execute(text("SELECT COUNT(*) FROM customs"))
             row_count = result.scalar()
     except:
@@ -73,6 +221,119 @@ async def health_check():
         "rows_in_database": row_count,
     }
 
+@app.get("/db/stats")
+def get_db_stats(session_id: str = None):
+    """
+    Writer/reader connection pool utilisation
+    """
+    return get_dataset(session_id).pool_stats()
+
+@app.get("/datasets")
+def get_datasets():
+    """
+    Open datasets, their idle time and how many have been closed to save handles
+    """
+    return datasets.stats()
+
+@app.get("/schema")
+def get_schema_info(session_id: str = None):
+    """
+    Current schema version, columns with descriptions and schema.json mismatches
+    """
+    return get_dataset(session_id).schema_registry.info()
+
+@app.get("/indexes")
+def get_indexes(session_id: str = None):
+    """
+    Indexes on the customs table and their ANALYZE statistics
+    """
+    return list_indexes(target_engine=get_dataset(session_id).read_engine)
+
+@app.post("/indexes/rebuild")
+def rebuild_customs_indexes(session_id: str = None):
+    """
+    Rebuild all customs indexes and refresh planner statistics
+    """
+    dataset = get_dataset(session_id)
+    try:
+        rebuild_indexes(target_engine=dataset.write_engine)
+        return list_indexes(target_engine=dataset.read_engine)
+    except Exception as e:
+        raise HTTPException(500, f"Index rebuild failed: {str(e)}")
+
+@app.get("/cache/sql")
+def get_sql_cache(limit: int = 100):
+    """
+    SQL cache hit/miss counters and the most recently used entries
+    """
+    return {"stats": sql_cache.stats(), "entries": sql_cache.entries(limit)}
+
+@app.delete("/cache/sql")
+def purge_sql_cache(key: str = None, fingerprint: str = None):
+    """
+    Delete one cached entry (key), every entry for a schema fingerprint, or everything
+    """
+    removed = sql_cache.purge(key=key, fingerprint=fingerprint)
+    print(f"🧹 Purged {removed} cached SQL entries")
+    return {"removed": removed}
+
+@app.get("/cache/responses")
+def get_response_cache(limit: int = 100):
+    """
+    Analysis/visualization cache counters and the most recently used entries
+    """
+    return {"stats": response_cache.stats(), "entries": response_cache.entries(limit)}
+
+@app.delete("/cache/responses")
+def purge_response_cache(kind: str = None, fingerprint: str = None):
+    """
+    Delete cached analyses and visualization code, optionally only one kind or schema fingerprint
+    """
+    removed = response_cache.purge(kind=kind, fingerprint=fingerprint)
+    print(f"🧹 Purged {removed} cached responses")
+    return {"removed": removed}
+
+@app.get("/cache/results")
+def get_result_store(limit: int = 100):
+    """
+    Stored query results: memory and disk usage, hits, spills, evictions and the most recently used entries
+    """
+    return {"stats": result_store.stats(), "entries": result_store.entries(limit)}
+
+@app.get("/llm/stats")
+def get_llm_stats():
+    """
+    Per-model attempts, failures, retries, hedges, circuit state and latency percentiles
+    """
+    return llm_stats()
+
+@app.get("/intents/stats")
+def get_intent_stats():
+    """
+    How many questions were answered from SQL templates, per intent, and why the rest went to the model
+    """
+    return intent_stats.snapshot()
+
+@app.get("/anomalies")
+def get_anomalies(session_id: str = None, hs_code: str = None, ntn: str = None, importer: str = None,
+                  origin: str = None, flag: str = None, min_score: float = None, limit: int = 100):
+    """
+    Declarations whose unit prices stand out from their HS code's baseline, highest score first
+    """
+    hs_range = None
+    if hs_code:
+        try:
+            hs_range = hs_code_range(hs_code.strip())
+        except ValueError:
+            raise HTTPException(400, f"Invalid HS code '{hs_code}'")
+    result = list_anomalies(
+        target_engine=get_dataset(session_id).read_engine, hs_range=hs_range, ntn=ntn, importer=importer,
+        origin=origin, flag=flag, min_score=min_score, limit=max(1, min(limit, 1000))
+    )
+    if result is None:
+        raise HTTPException(404, "No price baselines for this dataset yet. Upload data first.")
+    return result
+
 def detect_data_request(query: str) -> bool:
     """Detect if user is asking for specific data rather than just analysis"""
     data_keywords = [
@@ -83,11 +344,156 @@ def detect_data_request(query: str) -> bool:
     query_lower = query.lower()
     return any(keyword in query_lower for keyword in data_keywords)
 
+def clean_visualization_code(viz_code: str) -> str:
+    """
+    Strip markdown fences and smart punctuation from generated matplotlib code
+    """
+    # Clean up code if it has markdown formatting
+    if "```python" in viz_code:
+        viz_code = viz_code.split("```python")[1].split("```")[0].strip()
+    elif "```" in viz_code:
+        viz_code = viz_code.split("```")[1].split("```")[0].strip()
+
+    # --- Sanitize visualization code (fix Windows smart chars) ---
+    replacements = {
+        "“": '"', "”": '"',
+        "‘": "'", "’": "'",
+        "–": "-", "—": "-",
+        "•": "*",
+        "…": "..."
+    }
+
+    for bad, good in replacements.items():
+        viz_code = viz_code.replace(bad, good)
+
+    # Ensure UTF-8 encoding header for Python
+    if not viz_code.startswith("# -*- coding: utf-8 -*-"):
+        viz_code = "# -*- coding: utf-8 -*-\n" + viz_code
+    # --------------------------------------------------------------
+    return viz_code
+
+def visualization_event(result_id: str, viz_task) -> str:
+    """
+    Cache the finished visualization code and build its SSE event
+    (visualization_ready, or an error if generation failed)
+    """
+    try:
+        viz_code = clean_visualization_code(viz_task.result())
+    except Exception as e:
+        print(f"❌ Visualization code generation failed: {e}")
+        error_json = json.dumps({
+            "type": "error",
+            "content": f"\n\n⚠️ Visualization error: {str(e)}"
+        })
+        return f"data: {error_json}\n\n"
+
+    print(f"✅ Generated visualization code ({len(viz_code)} chars)\n")
+
+    # Store visualization code
+    result_store.set_viz_code(result_id, viz_code)
+    print("✅ Visualization code generated and cached")
+
+    return visualization_ready_event(result_id)
+
+def visualization_ready_event(result_id: str) -> str:
+    # Send visualization ready signal
+    viz_ready_json = json.dumps({
+        "type": "visualization_ready",
+        "result_id": result_id
+    })
+    return f"data: {viz_ready_json}\n\n"
+
+def lookup_responses(analysis_key: str, viz_key: str):
+    """
+    Cached analysis text and visualization code for this question, SQL and data (None when absent)
+    """
+    if not RESPONSE_CACHE_ENABLED:
+        return None, None
+    return response_cache.get("analysis", analysis_key), response_cache.get("visualization", viz_key)
+
+async def remember_response(kind: str, key: str, user_query: str, sql: str, fingerprint: str, content: str):
+    if RESPONSE_CACHE_ENABLED and content:
+        await run_in_threadpool(response_cache.put, kind, key, user_query, sql, fingerprint, content)
+
+async def interleave_visualization(tokens, viz_task=None):
+    """
+    Yield ("token", text) from the analysis stream, plus ("visualization", task)
+    the moment viz_task finishes rather than after the last token.
+    Whatever is still running is cancelled if the client goes away.
+    """
+    tokens = tokens.__aiter__()
+    next_token = asyncio.ensure_future(tokens.__anext__())
+    pending_viz = viz_task
+    try:
+        while True:
+            waiting = {next_token} if pending_viz is None else {next_token, pending_viz}
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+
+            if pending_viz in done:
+                yield "visualization", pending_viz
+                pending_viz = None
+
+            if next_token in done:
+                try:
+                    token = next_token.result()
+                except StopAsyncIteration:
+                    break
+                yield "token", token
+                next_token = asyncio.ensure_future(tokens.__anext__())
+
+        # Analysis finished first
+        if pending_viz is not None:
+            await asyncio.wait([pending_viz])
+            yield "visualization", pending_viz
+    finally:
+        for task in (next_token, viz_task):
+            if task is not None and not task.done():
+                task.cancel()
+
+def prepare_query(session_id: str, user_query: str, leased: ExitStack):
+    """
+    Blocking SQLite work before SQL generation: the session's dataset, its
+    schema and system prompt, and SQL for the question from a fixed
+    template (intent) or the SQL cache, if either has it. The dataset is
+    leased on `leased`, which the caller closes once the response is sent
+    """
+    with dataset_errors():
+        dataset = leased.enter_context(datasets.lease(session_id))
+
+    # Schema and rendered SQL prompt come from the registry, loaded once per data version.
+    # One snapshot, so a reload mid-request can't pair one version's schema with another's fingerprint
+    state = dataset.schema_registry.current()
+    schema = state["schema"]
+    system_prompt = state["sql_system_prompt"]
+    fingerprint = state["fingerprint"]
+
+    # Common question shapes are answered from templates without the SQL model
+    intent = match_intent(user_query, state)
+    if intent:
+        return dataset, schema, system_prompt, fingerprint, None, None, intent
+
+    # The same question against the same schema and data reuses its SQL
+    sql_key = cache_key(user_query, fingerprint, system_prompt, SQL_MODEL)
+    cached_sql = sql_cache.get(sql_key) if SQL_CACHE_ENABLED else None
+    return dataset, schema, system_prompt, fingerprint, sql_key, cached_sql, None
+
 @app.post("/query")
-def run_query_stream(req: QueryRequest):
+async def run_query_stream(req: QueryRequest):
     """
-    Main query endpoint with automatic visualization
+    Main query endpoint with automatic visualization.
+    Runs on the event loop: LLM calls are awaited on the pooled async client
+    and SQLite work is handed to the threadpool, so a slow model holds a
+    socket rather than a server thread. The session's dataset stays leased,
+    and so is never evicted, until the last event has been streamed.
     """
+    leased = ExitStack()
+    try:
+        return await query_response(req, leased)
+    except BaseException:
+        leased.close()
+        raise
+
+async def query_response(req: QueryRequest, leased: ExitStack):
     user_query = req.question.strip()
     session_id = req.session_id
     
@@ -96,32 +502,65 @@ def run_query_stream(req: QueryRequest):
     print(f"🆔 Session: {session_id}")
     print(f"{'='*60}\n")
     
-    # Get schema with descriptions
-    schema = get_schema()
-    schema = attach_schema_descriptions(schema)
-    
-    # Generate SQL
-    print("🔄 Generating SQL...")
-    sql = generate_sql(schema, user_query).strip()
-    print(f"✅ Generated SQL:\n{sql}\n")
+    dataset, schema, system_prompt, fingerprint, sql_key, cached_sql, intent = await run_in_threadpool(
+        prepare_query, session_id, user_query, leased
+    )
+
+    sql_params = {}
+    if intent:
+        sql, sql_params = intent["sql"], intent["params"]
+        sql_source = f"intent:{intent['intent']}"
+        print(f"⚡ SQL from intent {intent['intent']}:\n{sql}\n{sql_params}\n")
+    elif cached_sql:
+        sql = cached_sql
+        sql_source = "cache"
+        print(f"⚡ SQL cache hit:\n{sql}\n")
+    else:
+        sql_source = "llm"
+        # Generate SQL
+        print("🔄 Generating SQL...")
+        try:
+            sql = (await agenerate_sql(schema, user_query, system_prompt=system_prompt)).strip()
+        except LLMUnavailable as e:
+            print(f"❌ SQL generation failed: {e}")
+            raise HTTPException(503, f"SQL generation unavailable: {str(e)}")
+        print(f"✅ Generated SQL:\n{sql}\n")
     
     # Sanitize SQL
     sql = sanitize_sql(sql)
     
-    # Execute SQL query
+    # Execute SQL query in batches under row/byte/time budgets
     try:
         print("🔄 Executing SQL query...")
-        df = pd.read_sql(text(sql), engine)
+        df, execution = await run_in_threadpool(
+            execute_query, sql, sql_params, target_engine=dataset.read_engine
+        )
         print(f"✅ Query returned {len(df)} rows")
         print(f"📋 Columns: {df.columns.tolist()}\n")
+    except QueryRejected as e:
+        print(f"❌ Query rejected: {e}")
+        if cached_sql:
+            await run_in_threadpool(sql_cache.invalidate, sql_key)
+        raise HTTPException(400, f"Query rejected: {str(e)}")
+    except QueryTimeout as e:
+        print(f"❌ {e}")
+        raise HTTPException(504, str(e))
     except Exception as e:
         error_msg = f"SQL Execution Error: {str(e)}"
         print(f"❌ {error_msg}")
+        if cached_sql:
+            await run_in_threadpool(sql_cache.invalidate, sql_key)
         raise HTTPException(500, error_msg)
 
+    # Only SQL the model wrote and that actually ran is worth reusing
+    if SQL_CACHE_ENABLED and sql_source == "llm":
+        await run_in_threadpool(
+            sql_cache.put, sql_key, user_query, fingerprint, SQL_MODEL, sql
+        )
+
     # Store result in cache
     result_id = hashlib.md5(f"{user_query}{datetime.now().isoformat()}".encode()).hexdigest()
-    query_results_cache[result_id] = df.copy()
+    await run_in_threadpool(result_store.put, result_id, df)
     
     # Detect if user wants specific data
     wants_data = detect_data_request(user_query)
@@ -130,8 +569,20 @@ def run_query_stream(req: QueryRequest):
     df = df.where(pd.notnull(df), None)
     df_clean = df.replace({np.nan: None, np.inf: None, -np.inf: None})
 
+    parallel_viz = PARALLEL_VISUALIZATION if req.parallel_visualization is None else req.parallel_visualization
+    replay_delay_ms = RESPONSE_REPLAY_DELAY_MS if req.replay_delay_ms is None else req.replay_delay_ms
+
+    # Unchanged SQL over unchanged data replays the analysis and chart it produced last time.
+    # Template SQL is only the same query with the same bound values.
+    query_text = f"{sql}\n{json.dumps(sql_params, sort_keys=True)}" if sql_params else sql
+    analysis_key = response_key("analysis", user_query, query_text, fingerprint, ANALYSIS_MODEL)
+    viz_key = response_key(
+        "visualization", user_query, query_text, fingerprint, SQL_MODEL, "parallel" if parallel_viz else "sequential"
+    )
+    cached_analysis, cached_viz = await run_in_threadpool(lookup_responses, analysis_key, viz_key)
+
     # Stream analysis and visualization
-    def event_generator():
+    async def event_generator():
         # Send metadata
         metadata = {
             "type": "metadata", 
@@ -140,7 +591,15 @@ def run_query_stream(req: QueryRequest):
             "result_id": result_id,
             "wants_data": wants_data,
             "columns": df.columns.tolist(),
-            "has_visualization": True
+            "truncated": execution["truncated"],
+            "truncated_by": execution["truncated_by"],
+            "sql_cached": bool(cached_sql),
+            "sql_source": sql_source,
+            "sql_params": sql_params,
+            "has_visualization": True,
+            "parallel_visualization": parallel_viz,
+            "analysis_cached": cached_analysis is not None,
+            "visualization_cached": cached_viz is not None
         }
         
         # If small dataset and user wants data, include preview
@@ -152,70 +611,88 @@ def run_query_stream(req: QueryRequest):
         yield f"data: {json.dumps(metadata)}\n\n"
         print(f"📤 Sent metadata: {len(df)} rows\n")
         
+        if cached_viz is not None:
+            # Chart code from the response cache is ready before any token
+            result_store.set_viz_code(result_id, cached_viz)
+            print("⚡ Visualization code from cache")
+            yield visualization_ready_event(result_id)
+
         # Stream analysis tokens
         print("🔄 Starting analysis stream...\n")
-        token_count = 0
-        analysis_text = ""
-        
-        try:
-            for token in analyze_data_stream(df, user_query):
-                if token:
-                    token_count += 1
-                    analysis_text += token
-                    
-                    token_json = json.dumps({
-                        "type": "token",
-                        "content": token
-                    })
-                    
-                    yield f"data: {token_json}\n\n"
-                    
-                    if token_count % 20 == 0:
-                        print(f"📤 Streamed {token_count} tokens...")
-            
-            print(f"\n✅ Analysis complete - Total tokens: {token_count}")
-            
-            # Generate visualization code
-            print("🔄 Generating visualization code...")
-
-            viz_code = generate_visualization_code(df, user_query, analysis_text)
-
-            # Clean up code if it has markdown formatting
-            if "```python" in viz_code:
-                viz_code = viz_code.split("```python")[1].split("```")[0].strip()
-            elif "```" in viz_code:
-                viz_code = viz_code.split("```")[1].split("```")[0].strip()
-
-            # --- Sanitize visualization code (fix Windows smart chars) ---
-            replacements = {
-                "“": '"', "”": '"',
-                "‘": "'", "’": "'",
-                "–": "-", "—": "-",
-                "•": "*",
-                "…": "..."
-            }
+        frame_count = 0
+        analysis_text = TextBuffer()
+        analysis_outcome = {}
 
-            for bad, good in replacements.items():
-                viz_code = viz_code.replace(bad, good)
+        # One statistics pass and one row sample over the result, shared by the analysis and chart prompts
+        profile = sample = None
+        if cached_analysis is None or cached_viz is None:
+            columns = relevant_columns(df, user_query, sql)
+            profile = asyncio.ensure_future(asyncio.to_thread(
+                result_profile, df, sql, columns, sql_params, dataset.read_engine, execution["truncated"]
+            ))
+            sample = asyncio.ensure_future(asyncio.to_thread(
+                sample_rows, df, sql, columns, sql_params, dataset.read_engine, execution["truncated"]
+            ))
+        flagged = None
+        if cached_analysis is None:
+            flagged = asyncio.ensure_future(asyncio.to_thread(
+                flagged_in_result, sql, sql_params, list(df.columns), target_engine=dataset.read_engine,
+                df=None if execution["truncated"] else df
+            ))
 
-            # Ensure UTF-8 encoding header for Python
-            if not viz_code.startswith("# -*- coding: utf-8 -*-"):
-                viz_code = "# -*- coding: utf-8 -*-\n" + viz_code
-            # --------------------------------------------------------------
+        if cached_analysis is not None:
+            print("⚡ Replaying cached analysis")
+            tokens = replay_tokens(cached_analysis, replay_delay_ms)
+        else:
+            tokens = aanalyze_data_stream(
+                df, user_query, sql, analysis_outcome,
+                sql_params=sql_params, target_engine=dataset.read_engine, truncated=execution["truncated"],
+                profile=profile, anomalies=flagged, sample=sample
+            )
 
-            print(f"✅ Generated visualization code ({len(viz_code)} chars)\n")
+        # Parallel mode asks for the chart code up front, from the data alone,
+        # so it is usually ready before the analysis finishes streaming
+        viz_task = None
+        if parallel_viz and cached_viz is None:
+            print("🔄 Generating visualization code alongside the analysis...")
+            viz_task = asyncio.create_task(agenerate_visualization_code(df, user_query, profile=profile, sample=sample))
+        
+        try:
+            # Tokens are merged into a frame per flush window instead of one frame each
+            async for kind, item in coalesce_tokens(interleave_visualization(tokens, viz_task)):
+                if kind == "heartbeat":
+                    yield HEARTBEAT_FRAME
+                    continue
 
-            # Store visualization code
-            query_results_cache[f"{result_id}_viz_code"] = viz_code
+                if kind == "visualization":
+                    yield visualization_event(result_id, item)
+                    await remember_response(
+                        "visualization", viz_key, user_query, sql, fingerprint,
+                        result_store.viz_code(result_id)
+                    )
+                    continue
+
+                if item:
+                    frame_count += 1
+                    analysis_text.append(item)
+                    yield sse_event({"type": "token", "content": item})
             
-            # Send visualization ready signal
-            viz_ready_json = json.dumps({
-                "type": "visualization_ready",
-                "result_id": result_id
-            })
-            yield f"data: {viz_ready_json}\n\n"
+            print(f"\n✅ Analysis complete - {analysis_text.chars:,} chars in {frame_count} frames")
+
+            # Only a full model analysis is cached, never the canned fallback
+            if analysis_outcome.get("complete"):
+                await remember_response("analysis", analysis_key, user_query, sql, fingerprint, analysis_text.text())
             
-            print("✅ Visualization code generated and cached")
+            if not parallel_viz and cached_viz is None:
+                # Generate visualization code
+                print("🔄 Generating visualization code...")
+                viz_task = asyncio.create_task(agenerate_visualization_code(df, user_query, analysis_text.text(), profile, sample))
+                await asyncio.wait([viz_task])
+                yield visualization_event(result_id, viz_task)
+                await remember_response(
+                    "visualization", viz_key, user_query, sql, fingerprint,
+                    result_store.viz_code(result_id)
+                )
             
         except Exception as e:
             print(f"❌ Streaming error: {e}")
@@ -229,17 +706,23 @@ def run_query_stream(req: QueryRequest):
         yield f"data: {done_json}\n\n"
         print(f"{'='*60}\n")
 
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    async def leased_events():
+        try:
+            async for frame in event_generator():
+                yield frame
+        finally:
+            leased.close()
+
+    return StreamingResponse(leased_events(), media_type="text/event-stream")
 
 @app.get("/download/{result_id}")
 async def download_result(result_id: str, format: str = "excel"):
     
 
-    if result_id not in query_results_cache:
+    df = await run_in_threadpool(result_store.get, result_id)
+    if df is None:
         raise HTTPException(404, "Result not found or expired")
     
-    df = query_results_cache[result_id]
-    
     if format == "excel":
         output = BytesIO()
         with pd.ExcelWriter(output, engine='openpyxl') as writer:
@@ -285,8 +768,8 @@ def generate_visualization(result_id: str):
     Execute visualization code and return image path
     """
     # Get cached data and code
-    df = query_results_cache.get(result_id)
-    viz_code = query_results_cache.get(f"{result_id}_viz_code")
+    df = result_store.get(result_id)
+    viz_code = result_store.viz_code(result_id)
     
     if df is None:
         raise HTTPException(404, "Result not found")
@@ -300,7 +783,7 @@ def generate_visualization(result_id: str):
         print(f"✅ Visualization created: {image_path}")
         
         # Store image path in cache
-        query_results_cache[f"{result_id}_viz_image"] = image_path
+        result_store.set_viz_image(result_id, image_path)
         
         return {
             "success": True,
@@ -317,7 +800,7 @@ def get_visualization(result_id: str):
     """
     Serve the generated visualization image
     """
-    image_path = query_results_cache.get(f"{result_id}_viz_image")
+    image_path = result_store.viz_image(result_id)
     
     if not image_path or not os.path.exists(image_path):
         raise HTTPException(404, "Visualization not found")
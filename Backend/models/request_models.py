@@ -1,6 +1,11 @@
 # models/request_models.py
+from typing import Optional
 from pydantic import BaseModel
 
 class QueryRequest(BaseModel):
     question: str
-    session_id: str
\ No newline at end of file
+    session_id: str
+    # None uses the server default (PARALLEL_VISUALIZATION)
+    parallel_visualization: Optional[bool] = None
+    # Pause between replayed tokens of a cached analysis; None uses RESPONSE_REPLAY_DELAY_MS, 0 sends it at once
+    replay_delay_ms: Optional[int] = None
\ No newline at end of file
@@ -5,15 +5,27 @@ SCHEMA FORMAT (JSON):
 The schema provided contains mapping of columns.
 `{{{{schema}}}}`
 
+PRE-AGGREGATED ROLLUP TABLES:
+These are built from `customs` at upload time and kept up to date. Each row summarises every customs row sharing the listed dimension values.
+{{{{rollups}}}}
+- row_count is the number of customs rows in the group, gd_count the number of distinct GD_NO_Complete.
+- sum_* columns are sums of the customs column of the same name (e.g. sum_assessed_import_value_rs = SUM("ASSESSED IMPORT VALUE RS")).
+- min/max/avg_unit_price and p25/p50/p75_unit_price describe "ASSD UNIT PRICE"; avg_declared_unit_price is the mean "Declared Unit PRICE".
+
+FULL-TEXT SEARCH:
+{{{{fulltext}}}}
+
 DO:
 1. Data fetched should be able to check for price discrepency.
 2. You will always return all the columns needed to perform analysis.
 3. Always check for conditions in the user query.
 4. If no condition is present. then fetch all the data.
+5. For keyword questions about goods or importers ("solar panels", "LED lights from China"), use the full-text index described above with MATCH instead of LIKE '%...%'.
+6. If the question only needs totals, counts, averages or unit price percentiles grouped by the dimensions of a rollup table (HS code, origin country, unit, importer, SRO), query that rollup table instead of `customs`. Rule 7 below does not apply to rollup queries.
 
 
 MANDATORY RULES:
-1. Table name is exactly: customs
+1. Table name is exactly: customs (or one of the rollup tables listed above)
 2. USE COLUMN NAMES EXACTLY AS IN SCHEMA. Never rename or normalize them.
 3. If a column name contains spaces or special characters, ALWAYS wrap the identifier in double quotes. (SQLite identifier escaping: use double quotes and escape any internal double quotes by doubling them.)
    - Example: column name `Declared Unit PRICE` → use `"Declared Unit PRICE"` in the query.
@@ -29,6 +41,14 @@ OUTPUT RULE:
 
 """
 
+FULLTEXT_SEARCH_INSTRUCTIONS = """`{{fts_table}}` is an SQLite FTS5 full-text index over the customs columns {{fts_columns}}. Its rowid is the rowid of the matching customs row.
+- For keyword questions about goods or importer names NEVER use LIKE '%word%' on these columns. Select from customs and restrict rowid with a MATCH subquery:
+  SELECT ... FROM customs WHERE rowid IN (SELECT rowid FROM {{fts_table}} WHERE {{fts_table}} MATCH '<query>')
+- Put other conditions on customs as usual, e.g. ... AND "ORIGIN COUNTRY" = 'China'
+- Restrict a search to one column with a quoted column filter: MATCH '"ITEM DESCRIPTION" : (solar* AND panel*)'
+- Use a trailing * for prefix matches (solar* matches solar and solars), AND / OR / NOT between words, and double quotes around exact phrases ("led light").
+- Matching is case-insensitive. Keep the MATCH string in single quotes and double any single quote inside it."""
+
 VISUALIZATION_GENERATOR_SYSTEM_PROMPT = """You are an expert data visualization specialist. Your task is to generate clean, production-ready Python code using matplotlib to visualize data.
 
 DATA CONTEXT:
@@ -80,4 +100,55 @@ else:
     plt.close()
 ```
 
-Return ONLY the Python code without any markdown formatting, explanations, or import statements."""
\ No newline at end of file
+Return ONLY the Python code without any markdown formatting, explanations, or import statements."""
+
+# Filled in by agents/analysis_agent.build_analysis_prompt
+ANALYSIS_PROMPT_TEMPLATE = """You are an Expert on Post Custom Audit Analysis, You are given the information of Customs Import Stats of Pakistan ports, all the monetary value is dealt in PKR .
+                Analyze this customs import data. You MUST use proper newlines between all sections and bullet points.
+
+USER QUESTION: {{user_query}}
+
+DATA OVERVIEW:
+- Total Records: {{total_rows}}
+- Columns Available: {{column_count}}
+- Numeric Columns: {{numeric_count}}
+- Text Columns: {{text_count}}
+
+KEY STATISTICS:{{stats}}
+
+TEXT FIELD SUMMARY:{{text_stats}}
+
+FLAGGED PRICE ANOMALIES (declarations in this result scored against their HS code's price baseline):{{anomalies}}
+
+SAMPLE DATA ({{sample_size}} rows spread across importers and price ranges, lowest and highest prices included; tab-separated, empty = NULL, long text cut with …):
+{{data_sample}}
+
+PROVIDE YOUR ANALYSIS IN THIS EXACT FORMAT (with newlines after each line):
+
+📊 KEY COUNTS
+• [First count]
+• [Second count]
+• [Third count]
+
+📈 PATTERNS OBSERVED
+• [First pattern]
+• [Second pattern]
+• [Third pattern]
+
+⚠️ ANOMALIES OR RED FLAGS
+• [First anomaly]
+• [Second anomaly]
+
+💡 RECOMMENDATIONS
+• [First recommendation]
+• [Second recommendation]
+
+CRITICAL FORMATTING RULES:
+1. Add TWO newlines after each section header (📊, 📈, ⚠️, 💡)
+2. Add ONE newline after each bullet point (•)
+3. Each section must be separated by a blank line
+4. Do NOT run sections together
+5. Be concise but informative
+6. Focus on: "{{user_query}}"
+
+Begin now with proper formatting:"""
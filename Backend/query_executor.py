@@ -0,0 +1,160 @@
+# query_executor.py
+import os
+import re
+import sqlite3
+import time
+
+import pandas as pd
+
+from db import read_engine
+
+# Budgets for one /query result. Rows past either limit are not fetched.
+QUERY_MAX_ROWS = int(os.getenv("QUERY_MAX_ROWS", "200000"))
+QUERY_MAX_BYTES = int(os.getenv("QUERY_MAX_BYTES", str(256 * 1024 * 1024)))
+QUERY_TIMEOUT_SECONDS = float(os.getenv("QUERY_TIMEOUT_SECONDS", "30"))
+QUERY_REJECT_CROSS_JOINS = os.getenv("QUERY_REJECT_CROSS_JOINS", "1") == "1"
+
+# Rows pulled from the cursor per fetchmany()
+FETCH_BATCH_ROWS = 5000
+
+# SQLite VM instructions between deadline checks
+PROGRESS_HANDLER_OPS = 10000
+
+# Rough per-value overhead when estimating result size
+VALUE_OVERHEAD_BYTES = 16
+
+
+class QueryRejected(Exception):
+    """The SQL is not something we are willing to run."""
+
+
+class QueryTimeout(Exception):
+    """The SQL ran past its wall-clock budget before returning any rows."""
+
+
+def validate_sql(sql: str) -> str:
+    """Single read-only SELECT/WITH statement, trailing semicolons removed."""
+    statement = sql.strip().rstrip(";").strip()
+    if not statement:
+        raise QueryRejected("Empty SQL statement")
+
+    # Skip leading comments before checking the verb
+    body = re.sub(r"^(\s*(--[^\n]*\n|/\*.*?\*/))*", "", statement, flags=re.DOTALL).lstrip()
+    if not re.match(r"(?i)(select|with)\b", body):
+        raise QueryRejected("Only SELECT queries are allowed")
+    return statement
+
+
+def _full_scans_by_loop(plan_rows):
+    """
+    Group the SCAN steps of an EXPLAIN QUERY PLAN by parent. Steps under the
+    same parent are nested loops, so two full scans there are a cartesian product.
+    """
+    scans = {}
+    for _, parent, _, detail in plan_rows:
+        if not detail.startswith("SCAN "):
+            continue
+        if "VIRTUAL TABLE" in detail or detail.startswith("SCAN CONSTANT ROW"):
+            continue
+        scans.setdefault(parent, []).append(detail[len("SCAN "):])
+    return scans
+
+
+def check_plan(conn, sql: str, params=None):
+    """Reject plans that nest full table scans (unbounded cross joins)."""
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params or {}).fetchall()
+    if QUERY_REJECT_CROSS_JOINS:
+        for tables in _full_scans_by_loop(plan).values():
+            if len(tables) > 1:
+                raise QueryRejected(
+                    f"Query joins {', '.join(tables)} without a join condition (cross join); "
+                    f"add a condition relating them"
+                )
+    return [row[3] for row in plan]
+
+
+def _row_bytes(row) -> int:
+    size = 0
+    for value in row:
+        if isinstance(value, (str, bytes)):
+            size += len(value) + VALUE_OVERHEAD_BYTES
+        else:
+            size += 8 + VALUE_OVERHEAD_BYTES
+    return size
+
+
+def execute_query(sql: str, params=None, max_rows: int = None, max_bytes: int = None,
+                  timeout: float = None, target_engine=None):
+    """
+    Run a generated SELECT on a read-only connection and fetch it in batches.
+    Stops at `max_rows` / `max_bytes` and interrupts SQLite once `timeout`
+    seconds have passed. Returns (DataFrame, info) where info says whether
+    and why the result was truncated.
+    """
+    max_rows = QUERY_MAX_ROWS if max_rows is None else max_rows
+    max_bytes = QUERY_MAX_BYTES if max_bytes is None else max_bytes
+    timeout = QUERY_TIMEOUT_SECONDS if timeout is None else timeout
+
+    statement = validate_sql(sql)
+    started = time.monotonic()
+    deadline = started + timeout
+
+    raw = (target_engine or read_engine).raw_connection()
+    conn = raw.driver_connection
+    # Non-zero return makes SQLite abort the running statement with "interrupted"
+    conn.set_progress_handler(lambda: 1 if time.monotonic() > deadline else 0, PROGRESS_HANDLER_OPS)
+
+    rows = []
+    columns = []
+    total_bytes = 0
+    truncated_by = None
+    try:
+        check_plan(conn, statement, params)
+        cursor = conn.execute(statement, params or {})
+        columns = [d[0] for d in cursor.description]
+
+        while truncated_by is None:
+            try:
+                batch = cursor.fetchmany(FETCH_BATCH_ROWS)
+            except sqlite3.OperationalError as e:
+                if "interrupted" not in str(e):
+                    raise
+                if not rows:
+                    raise QueryTimeout(f"Query exceeded the {timeout:g}s time limit")
+                truncated_by = "timeout"
+                break
+            if not batch:
+                break
+
+            for row in batch:
+                if len(rows) >= max_rows:
+                    truncated_by = "row_limit"
+                    break
+                total_bytes += _row_bytes(row)
+                if total_bytes > max_bytes:
+                    truncated_by = "byte_limit"
+                    break
+                rows.append(row)
+        cursor.close()
+    except sqlite3.OperationalError as e:
+        if "interrupted" in str(e):
+            raise QueryTimeout(f"Query exceeded the {timeout:g}s time limit")
+        raise
+    except sqlite3.ProgrammingError as e:
+        # e.g. "You can only execute one statement at a time."
+        raise QueryRejected(str(e))
+    finally:
+        conn.set_progress_handler(None, 0)
+        raw.close()
+
+    df = pd.DataFrame.from_records(rows, columns=columns)
+    info = {
+        "rows": len(df),
+        "truncated": truncated_by is not None,
+        "truncated_by": truncated_by,
+        "estimated_bytes": total_bytes,
+        "elapsed_seconds": round(time.monotonic() - started, 3),
+    }
+    if truncated_by:
+        print(f"✂️ Result truncated by {truncated_by} at {len(df):,} rows")
+    return df, info
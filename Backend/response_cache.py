@@ -0,0 +1,199 @@
+# response_cache.py
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import time
+
+from sqlalchemy import text
+
+from db import write_transaction
+from prompts import prompts
+from sql_cache import sql_cache, normalize_question
+
+# Finished analysis texts and visualization code, stored next to the SQL cache in cache.db
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") == "1"
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", str(24 * 3600)))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2000"))
+
+# Cached analyses are replayed as token events of about this many characters,
+# RESPONSE_REPLAY_DELAY_MS apart (0 sends them back to back)
+REPLAY_CHUNK_CHARS = 24
+RESPONSE_REPLAY_DELAY_MS = int(os.getenv("RESPONSE_REPLAY_DELAY_MS", "0"))
+
+RESPONSE_TABLE = "response_cache"
+
+# The prompt template each kind of response was generated from
+TEMPLATES = {
+    "analysis": lambda: prompts.ANALYSIS_PROMPT_TEMPLATE,
+    "visualization": lambda: prompts.VISUALIZATION_GENERATOR_SYSTEM_PROMPT,
+}
+
+
+def template_hash(kind: str) -> str:
+    return hashlib.sha256(TEMPLATES[kind]().encode()).hexdigest()
+
+
+def response_key(kind: str, user_query: str, sql: str, fingerprint: str, model: str, variant: str = "") -> str:
+    """
+    Same question, same SQL, same schema and data (registry fingerprint),
+    same prompt template and model -> same response. `variant` separates
+    prompts built differently, e.g. visualization code with or without the analysis.
+    """
+    parts = [kind, normalize_question(user_query), sql.strip(), fingerprint, template_hash(kind), model, variant]
+    return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+
+def replay_chunks(content: str, chunk_chars: int = REPLAY_CHUNK_CHARS):
+    """Split text into token-sized pieces on whitespace so replay reads like a stream."""
+    chunks, current = [], ""
+    for piece in re.split(r"(\s+)", content):
+        current += piece
+        if len(current) >= chunk_chars:
+            chunks.append(current)
+            current = ""
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+async def replay_tokens(content: str, delay_ms: int = RESPONSE_REPLAY_DELAY_MS):
+    """Async token stream over cached text, paced by `delay_ms`."""
+    for chunk in replay_chunks(content):
+        yield chunk
+        if delay_ms > 0:
+            await asyncio.sleep(delay_ms / 1000)
+
+
+class ResponseCache:
+    """
+    Generated analysis/visualization text keyed by response_key(), with the
+    same TTL and LRU eviction as the SQL cache. Lives in the SQL cache's
+    database so one purge point covers both.
+    """
+
+    def __init__(self, ttl: int = RESPONSE_CACHE_TTL_SECONDS, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.write_engine = sql_cache.write_engine
+        self.read_engine = sql_cache.read_engine
+        self._lock = threading.Lock()
+        self.hits = {kind: 0 for kind in TEMPLATES}
+        self.misses = {kind: 0 for kind in TEMPLATES}
+        self.stores = 0
+        self.evictions = 0
+        self._create()
+
+    def _create(self):
+        with write_transaction(self.write_engine) as conn:
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {RESPONSE_TABLE} (
+                    key TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    question TEXT NOT NULL,
+                    sql TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            conn.execute(f"CREATE INDEX IF NOT EXISTS ix_{RESPONSE_TABLE}_last_used ON {RESPONSE_TABLE} (last_used_at)")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS ix_{RESPONSE_TABLE}_fingerprint ON {RESPONSE_TABLE} (fingerprint)")
+
+    def get(self, kind: str, key: str):
+        now = time.time()
+        with self.read_engine.connect() as conn:
+            row = conn.execute(
+                text(f"SELECT content FROM {RESPONSE_TABLE} WHERE key = :key AND created_at > :oldest"),
+                {"key": key, "oldest": now - self.ttl}
+            ).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses[kind] += 1
+                return None
+            self.hits[kind] += 1
+
+        with write_transaction(self.write_engine) as conn:
+            conn.execute(
+                f"UPDATE {RESPONSE_TABLE} SET hits = hits + 1, last_used_at = ? WHERE key = ?", (now, key)
+            )
+        return row[0]
+
+    def put(self, kind: str, key: str, question: str, sql: str, fingerprint: str, content: str):
+        now = time.time()
+        with write_transaction(self.write_engine) as conn:
+            conn.execute(
+                f"""
+                INSERT INTO {RESPONSE_TABLE}
+                    (key, kind, question, sql, fingerprint, content, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    content = excluded.content, created_at = excluded.created_at, last_used_at = excluded.last_used_at
+                """,
+                (key, kind, question, sql, fingerprint, content, now, now)
+            )
+            expired = conn.execute(f"DELETE FROM {RESPONSE_TABLE} WHERE created_at <= ?", (now - self.ttl,)).rowcount
+            overflow = conn.execute(
+                f"""
+                DELETE FROM {RESPONSE_TABLE} WHERE key IN (
+                    SELECT key FROM {RESPONSE_TABLE} ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,)
+            ).rowcount
+        with self._lock:
+            self.stores += 1
+            self.evictions += expired + overflow
+
+    def purge(self, kind: str = None, fingerprint: str = None) -> int:
+        """Delete every response, or those of one kind and/or schema fingerprint."""
+        clauses, params = [], []
+        if kind:
+            clauses.append("kind = ?")
+            params.append(kind)
+        if fingerprint:
+            clauses.append("fingerprint = ?")
+            params.append(fingerprint)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        with write_transaction(self.write_engine) as conn:
+            return conn.execute(f"DELETE FROM {RESPONSE_TABLE}{where}", params).rowcount
+
+    def entries(self, limit: int = 100):
+        with self.read_engine.connect() as conn:
+            rows = conn.execute(
+                text(f"""
+                    SELECT key, kind, question, sql, fingerprint, LENGTH(content) AS chars,
+                           created_at, last_used_at, hits
+                    FROM {RESPONSE_TABLE} ORDER BY last_used_at DESC LIMIT :limit
+                """),
+                {"limit": limit}
+            ).mappings().fetchall()
+        return [dict(row) for row in rows]
+
+    def stats(self):
+        with self.read_engine.connect() as conn:
+            sizes = dict(conn.execute(text(f"SELECT kind, COUNT(*) FROM {RESPONSE_TABLE} GROUP BY kind")).fetchall())
+        with self._lock:
+            by_kind = {}
+            for kind in TEMPLATES:
+                lookups = self.hits[kind] + self.misses[kind]
+                by_kind[kind] = {
+                    "entries": sizes.get(kind, 0),
+                    "hits": self.hits[kind],
+                    "misses": self.misses[kind],
+                    "hit_rate": round(self.hits[kind] / lookups, 3) if lookups else None,
+                }
+            return {
+                "enabled": RESPONSE_CACHE_ENABLED,
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "kinds": by_kind,
+            }
+
+
+response_cache = ResponseCache()
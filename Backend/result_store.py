@@ -0,0 +1,324 @@
+# result_store.py
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401 - only needed for Parquet spill files
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+# Query results kept in memory for /download and /generate-visualization, by DataFrame memory usage
+RESULT_STORE_MAX_BYTES = int(os.getenv("RESULT_STORE_MAX_MB", "512")) * 1024 * 1024
+# Results not used for this long are dropped, from memory and disk
+RESULT_STORE_TTL_SECONDS = int(os.getenv("RESULT_STORE_TTL_SECONDS", str(2 * 3600)))
+# Least recently used results past the memory budget are written here; the oldest go past this size
+RESULT_STORE_DIR = os.path.abspath(os.getenv("RESULT_STORE_DIR", "results"))
+RESULT_STORE_MAX_DISK_BYTES = int(os.getenv("RESULT_STORE_MAX_DISK_MB", "4096")) * 1024 * 1024
+
+
+def frame_bytes(df: pd.DataFrame) -> int:
+    """Real memory held by a DataFrame, strings included."""
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+class StoredResult:
+    """One query result: the DataFrame (or where it was spilled) plus its chart code and image."""
+
+    def __init__(self, result_id: str, df: pd.DataFrame):
+        self.id = result_id
+        self.df = df
+        self.bytes = frame_bytes(df)
+        self.rows = len(df)
+        self.path = None
+        self.disk_bytes = 0
+        self.viz_code = None
+        self.viz_image = None
+        # being written to disk outside the store's lock
+        self.spilling = False
+        self.created_at = time.time()
+        self.last_used = self.created_at
+
+    @property
+    def in_memory(self) -> bool:
+        return self.df is not None
+
+
+class ResultStore:
+    """
+    Query results by result_id, within a memory budget. Past the budget the
+    least recently used DataFrames spill to Parquet (pickle without pyarrow)
+    and are read back on the next use; results unused for `ttl` seconds are
+    dropped with their files.
+    """
+
+    def __init__(self, max_bytes: int = RESULT_STORE_MAX_BYTES, ttl: int = RESULT_STORE_TTL_SECONDS,
+                 spill_dir: str = RESULT_STORE_DIR, max_disk_bytes: int = RESULT_STORE_MAX_DISK_BYTES):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # one directory per process, so workers sharing RESULT_STORE_DIR never touch each other's files
+        self.spill_dir = os.path.join(spill_dir, str(os.getpid()))
+        self.max_disk_bytes = max_disk_bytes
+        self._results = OrderedDict()
+        self._lock = threading.RLock()
+        self.memory_bytes = 0
+        # memory of results picked for spilling whose files are still being written
+        self.pending_bytes = 0
+        self.disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.spills = 0
+        self.spill_failures = 0
+        self.expirations = 0
+        self.evictions = 0
+        # a previous process with the same pid left files nothing can reach any more
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def put(self, result_id: str, df: pd.DataFrame):
+        with self._lock:
+            self._remove(result_id)
+            entry = StoredResult(result_id, df)
+            self._results[result_id] = entry
+            self.memory_bytes += entry.bytes
+            self._expire()
+            spilling = self._select_spills()
+        self._spill(spilling)
+
+    def get(self, result_id: str):
+        """The result's DataFrame, read back from disk if it was spilled; None if unknown or expired."""
+        with self._lock:
+            entry = self._touch(result_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.in_memory:
+                self.hits += 1
+                return entry.df
+            path = entry.path
+
+        # file I/O happens outside the lock so other requests aren't held up behind it
+        try:
+            df = self._load(path)
+        except Exception as e:
+            print(f"⚠️ Could not read spilled result {result_id[:8]}: {e}")
+            with self._lock:
+                self.misses += 1
+                if self._results.get(result_id) is entry:
+                    self._remove(result_id)
+            return None
+
+        with self._lock:
+            self.disk_hits += 1
+            if self._results.get(result_id) is not entry:
+                # dropped while it was being read
+                return df
+            if entry.in_memory:
+                # another request read it back first
+                return entry.df
+            # back in memory as the most recently used; something older may spill in its place
+            entry.df = df
+            self.memory_bytes += entry.bytes
+            spilling = self._select_spills(keep=result_id)
+        self._spill(spilling)
+        return df
+
+    def __contains__(self, result_id: str) -> bool:
+        with self._lock:
+            return self._touch(result_id) is not None
+
+    def set_viz_code(self, result_id: str, code: str):
+        with self._lock:
+            entry = self._touch(result_id)
+            if entry is not None:
+                entry.viz_code = code
+
+    def viz_code(self, result_id: str):
+        with self._lock:
+            entry = self._touch(result_id)
+            return entry.viz_code if entry else None
+
+    def set_viz_image(self, result_id: str, path: str):
+        with self._lock:
+            entry = self._touch(result_id)
+            if entry is not None:
+                entry.viz_image = path
+
+    def viz_image(self, result_id: str):
+        with self._lock:
+            entry = self._touch(result_id)
+            return entry.viz_image if entry else None
+
+    def _touch(self, result_id: str):
+        entry = self._results.get(result_id)
+        if entry is None:
+            return None
+        if time.time() - entry.last_used > self.ttl:
+            self.expirations += 1
+            self._remove(result_id)
+            return None
+        entry.last_used = time.time()
+        self._results.move_to_end(result_id)
+        return entry
+
+    def _expire(self):
+        """Drop results unused for longer than the TTL; the LRU order puts them first."""
+        cutoff = time.time() - self.ttl
+        while self._results:
+            entry = next(iter(self._results.values()))
+            if entry.last_used > cutoff:
+                break
+            self.expirations += 1
+            self._remove(entry.id)
+
+    def _select_spills(self, keep: str = None):
+        """
+        Pick least recently used DataFrames to spill until memory fits. Ones
+        already on disk just let go of their DataFrame; the rest are marked and
+        returned for _spill() to write once the lock is released.
+        """
+        picked = []
+        for entry in list(self._results.values()):
+            if self.memory_bytes - self.pending_bytes <= self.max_bytes:
+                break
+            if not entry.in_memory or entry.spilling or entry.id == keep:
+                continue
+            if entry.path is not None:
+                entry.df = None
+                self.memory_bytes -= entry.bytes
+            else:
+                entry.spilling = True
+                self.pending_bytes += entry.bytes
+                picked.append(entry)
+        return picked
+
+    def _enforce_disk_cap(self):
+        """Drop the oldest spilled results until the spill files fit the disk cap."""
+        for entry in list(self._results.values()):
+            if self.disk_bytes <= self.max_disk_bytes:
+                break
+            if not entry.in_memory:
+                self.evictions += 1
+                self._remove(entry.id)
+
+    def _spill(self, entries):
+        """Write the results _select_spills() picked, without holding the lock, then free their memory."""
+        for entry in entries:
+            path = error = None
+            try:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                path = self._write(entry)
+                size = os.path.getsize(path)
+            except Exception as e:
+                error = e
+
+            with self._lock:
+                entry.spilling = False
+                self.pending_bytes -= entry.bytes
+                if self._results.get(entry.id) is not entry:
+                    # expired, replaced or purged while it was being written
+                    if path and os.path.exists(path):
+                        os.unlink(path)
+                    continue
+                if error is not None:
+                    # nowhere to keep it: the result is dropped rather than the budget broken
+                    print(f"⚠️ Could not spill result {entry.id[:8]}: {error}")
+                    self.spill_failures += 1
+                    self.evictions += 1
+                    self._remove(entry.id)
+                    continue
+                entry.path = path
+                entry.disk_bytes = size
+                self.disk_bytes += size
+                self.spills += 1
+                entry.df = None
+                self.memory_bytes -= entry.bytes
+                self._enforce_disk_cap()
+
+    def _write(self, entry: StoredResult) -> str:
+        # unique per write: a result replaced under the same id mid-spill must not share the file
+        base = os.path.join(self.spill_dir, f"{entry.id}-{os.urandom(4).hex()}")
+        if PARQUET_AVAILABLE:
+            try:
+                entry.df.to_parquet(f"{base}.parquet", index=False)
+                return f"{base}.parquet"
+            except Exception as e:
+                # mixed-type object columns have no Parquet type
+                print(f"⚠️ Parquet spill failed for {entry.id[:8]}, using pickle: {e}")
+        entry.df.to_pickle(f"{base}.pkl")
+        return f"{base}.pkl"
+
+    def _load(self, path: str) -> pd.DataFrame:
+        if path.endswith(".parquet"):
+            return pd.read_parquet(path)
+        return pd.read_pickle(path)
+
+    def _remove(self, result_id: str):
+        entry = self._results.pop(result_id, None)
+        if entry is None:
+            return
+        if entry.in_memory:
+            self.memory_bytes -= entry.bytes
+        for path in (entry.path, entry.viz_image):
+            if path and os.path.exists(path):
+                os.unlink(path)
+        self.disk_bytes -= entry.disk_bytes
+
+    def purge(self):
+        """Drop every result with its files."""
+        with self._lock:
+            removed = len(self._results)
+            for result_id in list(self._results):
+                self._remove(result_id)
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            return removed
+
+    def entries(self, limit: int = 100):
+        with self._lock:
+            recent = list(reversed(self._results.values()))[:limit]
+            return [
+                {
+                    "result_id": entry.id,
+                    "rows": entry.rows,
+                    "bytes": entry.bytes,
+                    "in_memory": entry.in_memory,
+                    "spill_file": os.path.basename(entry.path) if entry.path else None,
+                    "has_visualization": entry.viz_image is not None,
+                    "created_at": entry.created_at,
+                    "last_used_at": entry.last_used,
+                }
+                for entry in recent
+            ]
+
+    def stats(self):
+        with self._lock:
+            self._expire()
+            lookups = self.hits + self.disk_hits + self.misses
+            in_memory = sum(1 for entry in self._results.values() if entry.in_memory)
+            return {
+                "entries": len(self._results),
+                "in_memory": in_memory,
+                "spilled": len(self._results) - in_memory,
+                "memory_bytes": self.memory_bytes,
+                "max_bytes": self.max_bytes,
+                "disk_bytes": self.disk_bytes,
+                "max_disk_bytes": self.max_disk_bytes,
+                "spill_format": "parquet" if PARQUET_AVAILABLE else "pickle",
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.disk_hits) / lookups, 3) if lookups else None,
+                "spills": self.spills,
+                "spill_failures": self.spill_failures,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+result_store = ResultStore()
@@ -0,0 +1,261 @@
+# rollups.py
+import re
+
+from sqlalchemy import text
+
+from db import read_engine, quote_identifier
+
+# Pre-aggregated tables for the audit dimensions most questions group by.
+# (name suffix, dimension columns, include unit-price percentiles)
+ROLLUPS = [
+    ("hs_origin_unit", ["HS CODE", "ORIGIN COUNTRY", "ASSD UNIT"], True),
+    ("hs", ["HS CODE"], False),
+    ("importer", ["IMPORTER NAME", "NTN"], False),
+    ("origin", ["ORIGIN COUNTRY"], False),
+    ("sro", ["SRO"], False),
+]
+
+# Summed per group as sum_<snake_case name>
+MEASURE_COLUMNS = [
+    "ASSESSED IMPORT VALUE RS",
+    "Customs Duty PAID",
+    "Sales Tax PAID",
+    "Income Tax PAID",
+    "Additional Custom Duty PAID",
+    "ADD SALES TAX PAID",
+    "REG.DUTY PAID",
+    "GST PAID",
+    "Total",
+]
+
+GD_COLUMN = "GD_NO_Complete"
+PRICE_COLUMN = "ASSD UNIT PRICE"
+DECLARED_PRICE_COLUMN = "Declared Unit PRICE"
+PERCENTILES = (25, 50, 75)
+
+AFFECTED_TABLE = "_rollup_affected"
+
+
+def rollup_table(table: str, suffix: str) -> str:
+    return f"{table}_rollup_{suffix}"
+
+
+def measure_alias(column: str) -> str:
+    return "sum_" + re.sub(r"[^0-9a-z]+", "_", column.lower()).strip("_")
+
+
+def _table_columns(conn, table: str):
+    return [r[1] for r in conn.execute(f"PRAGMA table_info({quote_identifier(table)})").fetchall()]
+
+
+def _table_exists(conn, table: str) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone() is not None
+
+
+def _active_rollups(columns):
+    """Rollups whose dimensions all exist in the customs table."""
+    return [(suffix, dims, pct) for suffix, dims, pct in ROLLUPS if set(dims) <= set(columns)]
+
+
+def _rollup_select(columns, dims, with_percentiles: bool, source: str) -> str:
+    """
+    One GROUP BY over `source` producing a rollup row per dimension tuple.
+    Percentiles come from a window ranking in the same pass (nearest rank),
+    non-null prices ranked first.
+    """
+    dim_list = ", ".join(quote_identifier(d) for d in dims)
+    aggregates = ["COUNT(*) AS row_count"]
+    if GD_COLUMN in columns:
+        aggregates.append(f"COUNT(DISTINCT {quote_identifier(GD_COLUMN)}) AS gd_count")
+    for measure in MEASURE_COLUMNS:
+        if measure in columns:
+            aggregates.append(f"SUM({quote_identifier(measure)}) AS {measure_alias(measure)}")
+
+    ranked_columns = ""
+    if PRICE_COLUMN in columns:
+        price = quote_identifier(PRICE_COLUMN)
+        aggregates += [
+            f"MIN({price}) AS min_unit_price",
+            f"MAX({price}) AS max_unit_price",
+            f"AVG({price}) AS avg_unit_price",
+        ]
+        if with_percentiles:
+            ranked_columns = (
+                f", ROW_NUMBER() OVER (PARTITION BY {dim_list} ORDER BY {price} IS NULL, {price}) AS _rank"
+                f", COUNT({price}) OVER (PARTITION BY {dim_list}) AS _priced"
+            )
+            for p in PERCENTILES:
+                aggregates.append(
+                    f"MAX(CASE WHEN _rank = CAST({p / 100} * (_priced - 1) AS INTEGER) + 1 "
+                    f"AND {price} IS NOT NULL THEN {price} END) AS p{p}_unit_price"
+                )
+    if DECLARED_PRICE_COLUMN in columns:
+        aggregates.append(f"AVG({quote_identifier(DECLARED_PRICE_COLUMN)}) AS avg_declared_unit_price")
+
+    return f"""
+        SELECT {dim_list}, {', '.join(aggregates)}
+        FROM (SELECT *{ranked_columns} FROM {source})
+        GROUP BY {dim_list}
+    """
+
+
+def _rollup_columns(conn, columns, dims, with_percentiles: bool, table: str):
+    """Columns _rollup_select() would produce for `table` as it is now, read from an empty source."""
+    source = f"(SELECT * FROM {quote_identifier(table)} WHERE 0)"
+    cursor = conn.execute(_rollup_select(columns, dims, with_percentiles, source))
+    return [d[0] for d in cursor.description]
+
+
+def build_rollups(conn, table: str = "customs"):
+    """Rebuild every rollup table from scratch. Used after a replace ingest."""
+    columns = _table_columns(conn, table)
+    built = []
+    for suffix, dims, with_percentiles in ROLLUPS:
+        name = rollup_table(table, suffix)
+        conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(name)}")
+        if not set(dims) <= set(columns):
+            continue
+        conn.execute(
+            f"CREATE TABLE {quote_identifier(name)} AS "
+            + _rollup_select(columns, dims, with_percentiles, quote_identifier(table))
+        )
+        built.append(name)
+    print(f"🧮 Built rollups: {', '.join(built)}")
+    return built
+
+
+def capture_affected(conn, staging: str, table: str, key_match: str):
+    """
+    Before an append is merged, remember the dimension values of the staged
+    rows and of the existing rows they will overwrite. Those are the only
+    rollup groups the append can change. `key_match` joins staging (s) to
+    the live table (t).
+    """
+    columns = _table_columns(conn, table)
+    dims = sorted({d for _, ds, _ in _active_rollups(columns) for d in ds})
+    conn.execute(f"DROP TABLE IF EXISTS temp.{AFFECTED_TABLE}")
+    if not dims:
+        return
+
+    staged_dims = ", ".join(
+        f"s.{quote_identifier(d)}" if d in _table_columns(conn, staging) else f"NULL AS {quote_identifier(d)}"
+        for d in dims
+    )
+    existing_dims = ", ".join(f"t.{quote_identifier(d)}" for d in dims)
+    conn.execute(f"""
+        CREATE TEMP TABLE {AFFECTED_TABLE} AS
+        SELECT {staged_dims} FROM {quote_identifier(staging)} AS s
+        UNION
+        SELECT {existing_dims} FROM {quote_identifier(staging)} AS s
+        JOIN {quote_identifier(table)} AS t ON {key_match}
+    """)
+
+
+def refresh_rollups(conn, table: str = "customs"):
+    """
+    Recompute only the rollup groups recorded by capture_affected(), reading
+    their rows from the live table through its dimension indexes. Falls back
+    to a full build when a rollup table is missing or the append added a
+    measure or price column the existing tables have no column for.
+    """
+    columns = _table_columns(conn, table)
+    active = _active_rollups(columns)
+    captured = conn.execute(
+        "SELECT 1 FROM temp.sqlite_master WHERE type = 'table' AND name = ?", (AFFECTED_TABLE,)
+    ).fetchone() is not None
+    if not captured or not all(
+        _table_columns(conn, rollup_table(table, suffix)) == _rollup_columns(conn, columns, dims, pct, table)
+        for suffix, dims, pct in active
+    ):
+        return build_rollups(conn, table)
+
+    for suffix, dims, with_percentiles in active:
+        name = quote_identifier(rollup_table(table, suffix))
+        groups = f"_rollup_groups_{suffix}"
+        dim_list = ", ".join(quote_identifier(d) for d in dims)
+
+        conn.execute(f"DROP TABLE IF EXISTS temp.{groups}")
+        conn.execute(f"CREATE TEMP TABLE {groups} AS SELECT DISTINCT {dim_list} FROM temp.{AFFECTED_TABLE}")
+        conn.execute(f"CREATE INDEX temp.ix_{groups} ON {groups} ({dim_list})")
+
+        def matches(alias):
+            return " AND ".join(f"g.{quote_identifier(d)} IS {alias}.{quote_identifier(d)}" for d in dims)
+
+        conn.execute(f"DELETE FROM {name} WHERE EXISTS (SELECT 1 FROM temp.{groups} AS g WHERE {matches(name)})")
+
+        source = (
+            f"(SELECT c.* FROM temp.{groups} AS g "
+            f"JOIN {quote_identifier(table)} AS c ON {matches('c')})"
+        )
+        conn.execute(f"INSERT INTO {name} " + _rollup_select(columns, dims, with_percentiles, source))
+        conn.execute(f"DROP TABLE temp.{groups}")
+
+    affected = conn.execute(f"SELECT COUNT(*) FROM temp.{AFFECTED_TABLE}").fetchone()[0]
+    conn.execute(f"DROP TABLE temp.{AFFECTED_TABLE}")
+    print(f"🧮 Refreshed rollups for {affected:,} affected dimension combinations")
+
+
+def summary_from_rollups(conn, table: str = "customs"):
+    """
+    Upload summary read from the rollup tables, or None if they're missing.
+    `conn` is a SQLAlchemy connection.
+    """
+    origin = rollup_table(table, "origin")
+    importer = rollup_table(table, "importer")
+    hs = rollup_table(table, "hs")
+    existing = {r[0] for r in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'")).fetchall()}
+    if not {origin, importer, hs} <= existing:
+        return None
+
+    origin_columns = [r[1] for r in conn.execute(text(f"PRAGMA table_info({quote_identifier(origin)})")).fetchall()]
+
+    def total(column):
+        alias = measure_alias(column)
+        return f"COALESCE(SUM({alias}), 0)" if alias in origin_columns else "0"
+
+    totals = conn.execute(text(f"""
+        SELECT COALESCE(SUM(row_count), 0),
+               COUNT({quote_identifier('ORIGIN COUNTRY')}),
+               {total('ASSESSED IMPORT VALUE RS')},
+               {total('Customs Duty PAID')},
+               {total('Sales Tax PAID')}
+        FROM {quote_identifier(origin)}
+    """)).fetchone()
+    importers = conn.execute(text(
+        f"SELECT COUNT(DISTINCT {quote_identifier('IMPORTER NAME')}) FROM {quote_identifier(importer)}"
+    )).scalar()
+    hs_codes = conn.execute(text(f"SELECT COUNT({quote_identifier('HS CODE')}) FROM {quote_identifier(hs)}")).scalar()
+
+    return {
+        "totalRows": int(totals[0]),
+        "uniqueImporters": int(importers),
+        "uniqueHSCodes": int(hs_codes),
+        "uniqueCountries": int(totals[1]),
+        "totalValue": float(totals[2]),
+        "totalDutyPaid": float(totals[3]),
+        "totalTaxPaid": float(totals[4]),
+    }
+
+
+def describe_rollups(table: str = "customs", target_engine=None) -> str:
+    """Text block telling the SQL generator which rollup tables exist and what they hold."""
+    target_engine = target_engine or read_engine
+    lines = []
+    with target_engine.connect() as conn:
+        existing = {r[0] for r in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'")).fetchall()}
+        for suffix, dims, _ in ROLLUPS:
+            name = rollup_table(table, suffix)
+            if name not in existing:
+                continue
+            columns = [r[1] for r in conn.execute(text(f"PRAGMA table_info({quote_identifier(name)})")).fetchall()]
+            metrics = [c for c in columns if c not in dims]
+            lines.append(
+                f"- {name}: one row per ({', '.join(quote_identifier(d) for d in dims)}). "
+                f"Columns: {', '.join(metrics)}"
+            )
+
+    if not lines:
+        return "(no rollup tables available - query customs directly)"
+    return "\n".join(lines)
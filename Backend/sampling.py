@@ -0,0 +1,140 @@
+# sampling.py
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+from db import quote_identifier
+from query_executor import validate_sql, PROGRESS_HANDLER_OPS
+from rollups import PRICE_COLUMN, DECLARED_PRICE_COLUMN
+from stats_engine import STATS_TIMEOUT_SECONDS
+from agents.prompt_builder import MAX_SAMPLE_ROWS
+
+# Rows are spread over the first of these the result has, in proportion to each group's size
+STRATA_COLUMNS = ["IMPORTER NAME", "HS CODE", "ORIGIN COUNTRY"]
+# Lowest and highest priced rows always included, this many of each
+EXTREME_ROWS = 3
+
+
+def sampling_plan(df: pd.DataFrame):
+    """(stratum column, price column) the result has, either may be None."""
+    stratum = next((c for c in STRATA_COLUMNS if c in df.columns), None)
+    price = next((c for c in (PRICE_COLUMN, DECLARED_PRICE_COLUMN) if c in df.columns), None)
+    if price is None:
+        numeric = [c for c in df.columns if pd.api.types.is_numeric_dtype(df[c]) and c not in STRATA_COLUMNS]
+        price = numeric[0] if numeric else None
+    return stratum, price
+
+
+def sample_statement(sql: str, columns, stratum: str = None, price: str = None, n: int = MAX_SAMPLE_ROWS,
+                     extremes: int = EXTREME_ROWS) -> str:
+    """
+    One statement returning up to `n` + 2 * `extremes` rows of `sql`'s result:
+    the price extremes first, then each stratum's rows sorted by price and
+    taken at even spacing (centred, so a single pick is the stratum's median),
+    with quotas proportional to stratum size. The LIMIT takes the first pick
+    of every stratum, largest first, before anyone's second.
+    """
+    selected = ", ".join(quote_identifier(c) for c in columns)
+    group = quote_identifier(stratum) if stratum else "NULL"
+    by_price = f"{quote_identifier(price)}, sample_row" if price else "sample_row"
+    quota = f"MAX(1, CAST(ROUND(cnt * {n}.0 / total) AS INTEGER))"
+    ctes = [
+        f"r AS MATERIALIZED (SELECT *, ROW_NUMBER() OVER () AS sample_row FROM ({sql}))",
+        f"ranked AS (SELECT sample_row, {group} AS stratum, "
+        f"ROW_NUMBER() OVER (PARTITION BY {group} ORDER BY {by_price}) - 1 AS rn, "
+        f"COUNT(*) OVER (PARTITION BY {group}) AS cnt, COUNT(*) OVER () AS total FROM r)",
+        f"picked AS (SELECT sample_row, stratum, cnt, ROW_NUMBER() OVER (PARTITION BY stratum ORDER BY rn) AS pick "
+        f"FROM ranked WHERE (rn * {quota} + cnt / 2) % cnt < {quota})",
+    ]
+    chosen = [
+        f"SELECT sample_row, {2 * extremes} + ROW_NUMBER() OVER (ORDER BY pick, cnt DESC, stratum) AS ord "
+        f"FROM (SELECT * FROM picked ORDER BY pick, cnt DESC, stratum LIMIT {n})"
+    ]
+    if price and extremes:
+        price_column = quote_identifier(price)
+        for offset, direction in ((0, "ASC"), (extremes, "DESC")):
+            chosen.append(
+                f"SELECT sample_row, {offset} + ROW_NUMBER() OVER (ORDER BY {price_column} {direction}, sample_row) "
+                f"AS ord FROM (SELECT sample_row, {price_column} FROM r WHERE {price_column} IS NOT NULL "
+                f"ORDER BY {price_column} {direction}, sample_row LIMIT {extremes})"
+            )
+    ctes.append(f"chosen AS ({' UNION ALL '.join(chosen)})")
+    return (
+        f"WITH {', '.join(ctes)} SELECT {selected} FROM r "
+        f"JOIN (SELECT sample_row, MIN(ord) AS ord FROM chosen GROUP BY sample_row) c USING (sample_row) "
+        f"ORDER BY c.ord"
+    )
+
+
+def sample_query(sql: str, columns, stratum: str = None, price: str = None, params=None, target_engine=None,
+                 n: int = MAX_SAMPLE_ROWS, timeout: float = STATS_TIMEOUT_SECONDS):
+    """The sample computed by SQLite over the full result. None if it fails or times out."""
+    statement = sample_statement(validate_sql(sql), columns, stratum, price, n)
+    started = time.monotonic()
+    deadline = started + timeout
+
+    raw = target_engine.raw_connection()
+    conn = raw.driver_connection
+    conn.set_progress_handler(lambda: 1 if time.monotonic() > deadline else 0, PROGRESS_HANDLER_OPS)
+    try:
+        cursor = conn.execute(statement, params or {})
+        sample = pd.DataFrame.from_records(cursor.fetchall(), columns=list(columns))
+    except sqlite3.Error as e:
+        print(f"⚠️ SQL sampling failed, falling back to pandas: {e}")
+        return None
+    finally:
+        conn.set_progress_handler(None, 0)
+        raw.close()
+
+    print(f"🎯 Sampled {len(sample)} rows in SQL ({time.monotonic() - started:.2f}s)")
+    return sample
+
+
+def dataframe_sample(df: pd.DataFrame, columns, stratum: str = None, price: str = None,
+                     n: int = MAX_SAMPLE_ROWS, extremes: int = EXTREME_ROWS) -> pd.DataFrame:
+    """The same sample taken from a result already in memory, row for row."""
+    frame = df.reset_index(drop=True)
+    if frame.empty:
+        return frame[columns]
+    ordered = frame.sort_values(price, kind="stable", na_position="first") if price else frame
+    keys = ordered[stratum] if stratum else pd.Series(0, index=ordered.index)
+    grouped = ordered.groupby(keys, dropna=False, sort=False)
+    rn = grouped.cumcount()
+    cnt = grouped[ordered.columns[0]].transform("size")
+    quota = np.maximum(1, np.floor(cnt * n / len(frame) + 0.5)).astype(int)
+    chosen = ordered[(rn * quota + cnt // 2) % cnt < quota]
+    picks = pd.DataFrame({
+        "pick": chosen.groupby(keys.loc[chosen.index], dropna=False, sort=False).cumcount(),
+        "size": -cnt.loc[chosen.index],
+        "stratum": keys.loc[chosen.index],
+    }).sort_values(["pick", "size", "stratum"], kind="stable", na_position="first")
+
+    rows = []
+    if price and extremes:
+        priced = frame[frame[price].notna()]
+        rows += [priced.sort_values(price, kind="stable").index[:extremes],
+                 priced.sort_values(price, ascending=False, kind="stable").index[:extremes]]
+    rows.append(picks.index[:n])
+    rows = pd.Index(np.concatenate(rows)).drop_duplicates()
+    return frame.loc[rows, columns]
+
+
+def sample_rows(df: pd.DataFrame, sql: str = "", columns=None, params=None, target_engine=None,
+                truncated: bool = False, n: int = MAX_SAMPLE_ROWS) -> pd.DataFrame:
+    """
+    Rows for the model to look at instead of df.head(): the price extremes,
+    then a spread across importers (or HS codes, or origins) and across each
+    one's price range. Taken in SQLite when the fetched rows are not the
+    whole result, otherwise from the DataFrame that already holds it.
+    """
+    columns = [c for c in (columns if columns is not None else df.columns) if list(df.columns).count(c) == 1]
+    stratum, price = sampling_plan(df)
+    if truncated and sql and target_engine is not None:
+        needed = list(dict.fromkeys(columns + [c for c in (stratum, price) if c]))
+        sample = sample_query(sql, needed, stratum, price, params, target_engine, n)
+        if sample is not None:
+            return sample[columns]
+    return dataframe_sample(df, columns, stratum, price, n)
+
@@ -0,0 +1,141 @@
+# schema_registry.py
+import difflib
+import hashlib
+import threading
+import time
+
+from sqlalchemy import text
+
+from db import read_engine, get_schema, attach_schema_descriptions, load_schema_descriptions, get_data_version, quote_identifier
+from rollups import describe_rollups
+from fts import describe_fulltext, fulltext_columns
+from agents.sql_agent import build_sql_system_prompt
+
+# How long a loaded schema is trusted before checking the dataset's
+# data_version again (another worker may have ingested in the meantime)
+REGISTRY_RECHECK_SECONDS = 2.0
+
+# Distinct origin countries are kept for the intent matcher; skip if there are implausibly many
+COUNTRY_COLUMN = "ORIGIN COUNTRY"
+MAX_KNOWN_COUNTRIES = 500
+
+
+class SchemaRegistry:
+    """
+    In-memory view of the customs table schema, loaded once per data version.
+    Holds the column list with schema.json descriptions, the rendered SQL
+    system prompt, and any mismatch between schema.json and the table.
+    """
+
+    def __init__(self, table: str = "customs", read_engine=None):
+        self.table = table
+        self.read_engine = read_engine
+        self._lock = threading.Lock()
+        self._descriptions = None
+        self._state = None
+        self._checked_at = 0.0
+
+    def invalidate(self):
+        """Force a reload on next use. Called after every ingest."""
+        with self._lock:
+            self._state = None
+
+    def _database_facts(self, columns):
+        """Tables in the database and the distinct origin countries of the customs table."""
+        with (self.read_engine or read_engine).connect() as conn:
+            tables = {r[0] for r in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'")).fetchall()}
+            countries = []
+            if COUNTRY_COLUMN in columns:
+                # served by the origin index
+                countries = [r[0] for r in conn.execute(text(
+                    f"SELECT DISTINCT {quote_identifier(COUNTRY_COLUMN)} FROM {quote_identifier(self.table)} "
+                    f"WHERE {quote_identifier(COUNTRY_COLUMN)} IS NOT NULL LIMIT {MAX_KNOWN_COUNTRIES + 1}"
+                )).fetchall()]
+        return tables, countries if len(countries) <= MAX_KNOWN_COUNTRIES else []
+
+    def _descriptions_once(self):
+        if self._descriptions is None:
+            self._descriptions = load_schema_descriptions()
+        return self._descriptions
+
+    def _load(self, data_version: int, data_token: str):
+        descriptions = self._descriptions_once()
+        schema = attach_schema_descriptions(get_schema(self.table, self.read_engine), descriptions)
+        columns = [row["column"] for row in schema]
+
+        missing = [c for c in descriptions if c not in columns]
+        undescribed = [c for c in columns if c not in descriptions]
+        mismatches = {
+            "described_but_missing": [
+                {"column": c, "did_you_mean": difflib.get_close_matches(c, undescribed, n=1)[:1] or None}
+                for c in missing
+            ],
+            "present_but_undescribed": undescribed,
+        }
+        if columns and (missing or undescribed):
+            print(f"⚠️ schema.json mismatch: described but missing {missing}, undescribed {undescribed}")
+
+        # Columns and their order define the prompt; the data token changes on every ingest
+        fingerprint = hashlib.sha256(
+            "\x1f".join([f"{r['column']}:{r['type']}" for r in schema] + [data_token]).encode()
+        ).hexdigest()
+
+        tables, countries = self._database_facts(columns)
+
+        system_prompt = build_sql_system_prompt(
+            schema,
+            describe_rollups(self.table, self.read_engine),
+            describe_fulltext(self.table, self.read_engine)
+        )
+
+        print(f"📚 Schema registry loaded: {self.table} v{data_version}, {len(columns)} columns")
+        return {
+            "version": data_version,
+            "data_token": data_token,
+            "fingerprint": fingerprint,
+            "schema": schema,
+            "columns": columns,
+            "mismatches": mismatches,
+            "sql_system_prompt": system_prompt,
+            "table": self.table,
+            "tables": tables,
+            "countries": countries,
+            "fulltext_columns": fulltext_columns(self.table, self.read_engine),
+            "loaded_at": time.time(),
+        }
+
+    def current(self):
+        """The loaded state, reloaded if the data version moved on."""
+        with self._lock:
+            now = time.time()
+            if self._state is not None and now - self._checked_at < REGISTRY_RECHECK_SECONDS:
+                return self._state
+
+            data_version, data_token = get_data_version(self.table, self.read_engine)
+            if self._state is None or self._state["data_token"] != data_token:
+                self._state = self._load(data_version, data_token)
+            self._checked_at = now
+            return self._state
+
+    def schema(self):
+        return self.current()["schema"]
+
+    def sql_system_prompt(self) -> str:
+        return self.current()["sql_system_prompt"]
+
+    def fingerprint(self) -> str:
+        return self.current()["fingerprint"]
+
+    def info(self):
+        state = self.current()
+        return {
+            "table": self.table,
+            "version": state["version"],
+            "fingerprint": state["fingerprint"],
+            "columns": state["schema"],
+            "mismatches": state["mismatches"],
+            "loaded_at": state["loaded_at"],
+        }
+
+
+schema_registry = SchemaRegistry()
@@ -0,0 +1,178 @@
+# sql_cache.py
+import hashlib
+import os
+import re
+import threading
+import time
+import unicodedata
+
+from sqlalchemy import text
+
+from db import create_engines, write_transaction
+
+# Generated SQL is kept in its own small database so clearing or deleting it
+# never touches customs data
+SQL_CACHE_PATH = os.path.abspath(os.getenv("SQL_CACHE_PATH", "cache.db"))
+SQL_CACHE_ENABLED = os.getenv("SQL_CACHE_ENABLED", "1") == "1"
+SQL_CACHE_TTL_SECONDS = int(os.getenv("SQL_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+SQL_CACHE_MAX_ENTRIES = int(os.getenv("SQL_CACHE_MAX_ENTRIES", "5000"))
+
+CACHE_TABLE = "sql_cache"
+
+
+def normalize_question(question: str) -> str:
+    """
+    Fold the differences that don't change the SQL: case, unicode forms,
+    whitespace and trailing punctuation. Codes such as 8513.101 are kept as-is.
+    """
+    question = unicodedata.normalize("NFKC", question).casefold()
+    question = re.sub(r"\s+", " ", question).strip()
+    return question.strip(" \"'").rstrip("?!. ")
+
+
+def cache_key(question: str, fingerprint: str, system_prompt: str, model: str) -> str:
+    prompt_hash = hashlib.sha256(system_prompt.encode()).hexdigest()
+    parts = [normalize_question(question), fingerprint, prompt_hash, model]
+    return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+
+class SQLCache:
+    """
+    Question -> SQL cache persisted in SQLite. Entries belong to one schema
+    fingerprint (columns + data token), expire after `ttl` seconds and the
+    least recently used are dropped past `max_entries`.
+    """
+
+    def __init__(self, path: str = SQL_CACHE_PATH, ttl: int = SQL_CACHE_TTL_SECONDS,
+                 max_entries: int = SQL_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.write_engine, self.read_engine = create_engines(path, read_pool_size=2, read_pool_overflow=2)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._create()
+
+    def _create(self):
+        with write_transaction(self.write_engine) as conn:
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {CACHE_TABLE} (
+                    key TEXT PRIMARY KEY,
+                    question TEXT NOT NULL,
+                    normalized_question TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    sql TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            conn.execute(f"CREATE INDEX IF NOT EXISTS ix_{CACHE_TABLE}_last_used ON {CACHE_TABLE} (last_used_at)")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS ix_{CACHE_TABLE}_fingerprint ON {CACHE_TABLE} (fingerprint)")
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key: str):
+        """Cached SQL for `key`, or None if absent or expired."""
+        now = time.time()
+        with self.read_engine.connect() as conn:
+            row = conn.execute(
+                text(f"SELECT sql FROM {CACHE_TABLE} WHERE key = :key AND created_at > :oldest"),
+                {"key": key, "oldest": now - self.ttl}
+            ).fetchone()
+        if row is None:
+            self._count("misses")
+            return None
+
+        with write_transaction(self.write_engine) as conn:
+            conn.execute(
+                f"UPDATE {CACHE_TABLE} SET hits = hits + 1, last_used_at = ? WHERE key = ?", (now, key)
+            )
+        self._count("hits")
+        return row[0]
+
+    def put(self, key: str, question: str, fingerprint: str, model: str, sql: str):
+        now = time.time()
+        with write_transaction(self.write_engine) as conn:
+            conn.execute(
+                f"""
+                INSERT INTO {CACHE_TABLE}
+                    (key, question, normalized_question, fingerprint, model, sql, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    sql = excluded.sql, created_at = excluded.created_at, last_used_at = excluded.last_used_at
+                """,
+                (key, question, normalize_question(question), fingerprint, model, sql, now, now)
+            )
+            evicted = self._evict(conn, now)
+        self._count("stores")
+        if evicted:
+            with self._lock:
+                self.evictions += evicted
+
+    def _evict(self, conn, now: float) -> int:
+        """Drop expired entries, then the least recently used past max_entries."""
+        expired = conn.execute(f"DELETE FROM {CACHE_TABLE} WHERE created_at <= ?", (now - self.ttl,)).rowcount
+        overflow = conn.execute(
+            f"""
+            DELETE FROM {CACHE_TABLE} WHERE key IN (
+                SELECT key FROM {CACHE_TABLE} ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_entries,)
+        ).rowcount
+        return expired + overflow
+
+    def invalidate(self, key: str):
+        """Forget one entry, e.g. when its SQL stopped executing."""
+        self.purge(key=key)
+
+    def purge(self, key: str = None, fingerprint: str = None) -> int:
+        """Delete one entry, every entry for a fingerprint, or everything."""
+        clauses, params = [], []
+        if key:
+            clauses.append("key = ?")
+            params.append(key)
+        if fingerprint:
+            clauses.append("fingerprint = ?")
+            params.append(fingerprint)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        with write_transaction(self.write_engine) as conn:
+            return conn.execute(f"DELETE FROM {CACHE_TABLE}{where}", params).rowcount
+
+    def entries(self, limit: int = 100):
+        with self.read_engine.connect() as conn:
+            rows = conn.execute(
+                text(f"""
+                    SELECT key, question, fingerprint, model, sql, created_at, last_used_at, hits
+                    FROM {CACHE_TABLE} ORDER BY last_used_at DESC LIMIT :limit
+                """),
+                {"limit": limit}
+            ).mappings().fetchall()
+        return [dict(row) for row in rows]
+
+    def stats(self):
+        with self.read_engine.connect() as conn:
+            size = conn.execute(text(f"SELECT COUNT(*) FROM {CACHE_TABLE}")).scalar()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": SQL_CACHE_ENABLED,
+                "entries": size,
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "stores": self.stores,
+                "evictions": self.evictions,
+            }
+
+
+sql_cache = SQLCache()
@@ -0,0 +1,80 @@
+# stats_engine.py
+import os
+
+import pandas as pd
+
+from rollups import PRICE_COLUMN, DECLARED_PRICE_COLUMN
+from streaming_stats import stream_profile
+
+# Columns summarised for the analysis prompt, as many as it shows
+STATS_MAX_NUMERIC_COLUMNS = 5
+STATS_MAX_TEXT_COLUMNS = 3
+
+# Unit prices also get these percentiles (nearest rank)
+PERCENTILE_COLUMNS = [PRICE_COLUMN, DECLARED_PRICE_COLUMN]
+PERCENTILES = (5, 25, 75, 95)
+
+STATS_TIMEOUT_SECONDS = float(os.getenv("STATS_TIMEOUT_SECONDS", "10"))
+
+
+def pick_columns(df: pd.DataFrame, columns=None):
+    """(numeric, text) columns worth summarising, in result order, capped at what the prompt shows."""
+    columns = [c for c in (columns if columns is not None else df.columns) if list(df.columns).count(c) == 1]
+    numeric = [c for c in columns if pd.api.types.is_numeric_dtype(df[c])]
+    text = [c for c in columns if pd.api.types.is_object_dtype(df[c]) or pd.api.types.is_string_dtype(df[c])]
+    return numeric[:STATS_MAX_NUMERIC_COLUMNS], text[:STATS_MAX_TEXT_COLUMNS]
+
+
+def dataframe_profile(df: pd.DataFrame, numeric_columns, text_columns):
+    """The same profile computed in pandas, for results already in memory."""
+    profile = {"row_count": len(df), "numeric": {}, "text": {}}
+    for col in numeric_columns:
+        try:
+            clean_col = df[col].dropna()
+            if len(clean_col) > 0:
+                profile["numeric"][col] = {
+                    "count": len(clean_col),
+                    "mean": float(clean_col.mean()),
+                    "std": float(clean_col.std()) if len(clean_col) > 1 else 0.0,
+                    "min": float(clean_col.min()),
+                    "max": float(clean_col.max()),
+                    "sum": float(clean_col.sum()),
+                    "median": float(clean_col.median()),
+                }
+                if col in PERCENTILE_COLUMNS:
+                    profile["numeric"][col]["percentiles"] = {
+                        f"p{p}": float(clean_col.quantile(p / 100, interpolation="nearest")) for p in PERCENTILES
+                    }
+        except Exception as col_error:
+            print(f"⚠️ Skipping column {col}: {col_error}")
+    for col in text_columns:
+        try:
+            counts = df[col].value_counts()
+            top = sorted(counts.items(), key=lambda item: (-item[1], str(item[0])))[:5]
+            profile["text"][col] = {
+                "unique_count": int(len(counts)),
+                "top_value": str(top[0][0]) if top else "N/A",
+                "top_values": [[str(value), int(count)] for value, count in top],
+            }
+        except Exception:
+            continue
+    return profile
+
+
+def result_profile(df: pd.DataFrame, sql: str = "", columns=None, params=None, target_engine=None,
+                   truncated: bool = False):
+    """
+    Summary statistics for a query result:
+    - truncated (more rows than were fetched): one streaming pass over the
+      cursor with sketches, bounded memory however large the result
+    - otherwise the rows are all in `df` already, and pandas summarises them
+      without running the SQL again
+    """
+    numeric_columns, text_columns = pick_columns(df, columns)
+    profile = None
+    if truncated and sql and target_engine is not None:
+        profile = stream_profile(
+            sql, numeric_columns, text_columns, params, target_engine, STATS_TIMEOUT_SECONDS,
+            PERCENTILE_COLUMNS, PERCENTILES
+        )
+    return profile or dataframe_profile(df, numeric_columns, text_columns)
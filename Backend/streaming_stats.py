@@ -0,0 +1,268 @@
+# streaming_stats.py
+import math
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+from db import read_engine, quote_identifier
+from query_executor import validate_sql, FETCH_BATCH_ROWS, PROGRESS_HANDLER_OPS
+
+# KLL accuracy parameter: rank error is roughly 1.7 / k (about 1% at 200)
+QUANTILE_SKETCH_K = 200
+# HyperLogLog registers = 2 ** HLL_PRECISION (standard error 1.04 / sqrt(registers), about 0.8%)
+HLL_PRECISION = 14
+# Distinct values are counted exactly until there are this many, then estimated
+EXACT_DISTINCT_LIMIT = 4096
+# Values tracked per text column for the most common ones; counts undercount by at most rows / (capacity + 1)
+HEAVY_HITTER_CAPACITY = 1024
+
+
+class RunningMoments:
+    """Count, mean, variance, min, max and sum, updated a batch at a time (Welford/Chan merge)."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, values: np.ndarray):
+        if len(values) == 0:
+            return
+        n, mean = len(values), float(values.mean())
+        m2 = float(((values - mean) ** 2).sum())
+        delta = mean - self.mean
+        combined = self.count + n
+        self.mean += delta * n / combined
+        self.m2 += m2 + delta * delta * self.count * n / combined
+        self.count = combined
+        self.total += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def std(self):
+        # sample standard deviation, as pandas reports it
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+
+class QuantileSketch:
+    """
+    KLL sketch: levels of sorted samples where an item at level h stands for
+    2**h values. A full level is sorted and every other item (random offset)
+    is promoted, so memory stays under about 3 * k items whatever the input size.
+    """
+
+    def __init__(self, k: int = QUANTILE_SKETCH_K, seed: int = 0):
+        self.k = k
+        self.count = 0
+        self.levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, level: int) -> int:
+        depth = len(self.levels) - level - 1
+        return max(2, math.ceil(self.k * (2 / 3) ** depth))
+
+    def update(self, values: np.ndarray):
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(items)
+                # an odd item out stays behind so weights stay exact
+                keep, items = (items[-1:], items[:-1]) if len(items) % 2 else (items[:0], items)
+                promoted = items[self._rng.integers(2)::2]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+                self.levels[level] = keep
+            level += 1
+
+    def quantile(self, q: float):
+        if self.count == 0:
+            return None
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2 ** h) for h, level in enumerate(self.levels)])
+        order = np.argsort(items, kind="stable")
+        items, cumulative = items[order], np.cumsum(weights[order])
+        index = int(np.searchsorted(cumulative, q * cumulative[-1], side="left"))
+        return float(items[min(index, len(items) - 1)])
+
+
+class DistinctCounter:
+    """Exact distinct count while small, HyperLogLog estimate after that."""
+
+    def __init__(self, precision: int = HLL_PRECISION, exact_limit: int = EXACT_DISTINCT_LIMIT):
+        self.precision = precision
+        self.registers = np.zeros(2 ** precision, dtype=np.uint8)
+        self.exact = set()
+        self.exact_limit = exact_limit
+
+    def update(self, values: np.ndarray):
+        if len(values) == 0:
+            return
+        if self.exact is not None:
+            self.exact.update(values.tolist())
+            if len(self.exact) > self.exact_limit:
+                self.exact = None
+
+        hashes = pd.util.hash_array(values.astype(object))
+        p = np.uint64(self.precision)
+        index = (hashes >> (np.uint64(64) - p)).astype(np.int64)
+        rest = hashes << p
+        # position of the first 1 bit in what is left of the hash
+        width = 64 - self.precision
+        leading = np.full(len(rest), width + 1, dtype=np.uint8)
+        nonzero = rest != 0
+        leading[nonzero] = (64 - np.floor(np.log2(rest[nonzero].astype(np.float64)))).astype(np.uint8)
+        np.maximum.at(self.registers, index, np.minimum(leading, width + 1))
+
+    def estimate(self) -> int:
+        if self.exact is not None:
+            return len(self.exact)
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / float(np.sum(2.0 ** -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            raw = m * math.log(m / zeros)  # linear counting for small cardinalities
+        return int(round(raw))
+
+    @property
+    def approximate(self) -> bool:
+        return self.exact is None
+
+
+class HeavyHitters:
+    """
+    Misra-Gries summary merged a batch at a time: counts are exact while
+    there are at most `capacity` distinct values and otherwise undercount by
+    at most rows / (capacity + 1), so anything that frequent is never lost.
+    """
+
+    def __init__(self, capacity: int = HEAVY_HITTER_CAPACITY):
+        self.capacity = capacity
+        self.counts = pd.Series(dtype=np.int64)
+
+    def update(self, values: np.ndarray):
+        if len(values) == 0:
+            return
+        batch = pd.Series(values).value_counts()
+        counts = self.counts.add(batch, fill_value=0) if len(self.counts) else batch
+        if len(counts) > self.capacity:
+            threshold = counts.nlargest(self.capacity + 1).iloc[-1]
+            counts = counts[counts > threshold] - threshold
+        self.counts = counts.astype(np.int64)
+
+    def top(self, n: int = 5):
+        # most frequent first; ties broken on the value, like pandas mode()
+        ordered = sorted(self.counts.items(), key=lambda item: (-item[1], str(item[0])))
+        return [(value, int(count)) for value, count in ordered[:n]]
+
+
+class StreamingProfiler:
+    """The stats_engine profile built from result batches in bounded memory."""
+
+    def __init__(self, numeric_columns, text_columns, percentile_columns=(), percentiles=()):
+        self.numeric_columns = list(numeric_columns)
+        self.text_columns = list(text_columns)
+        self.percentile_columns = [c for c in percentile_columns if c in self.numeric_columns]
+        self.percentiles = percentiles
+        self.rows = 0
+        self.moments = {c: RunningMoments() for c in self.numeric_columns}
+        self.sketches = {c: QuantileSketch() for c in self.numeric_columns}
+        self.distinct = {c: DistinctCounter() for c in self.text_columns}
+        self.hitters = {c: HeavyHitters() for c in self.text_columns}
+
+    def update(self, batch):
+        """`batch` is a list of row tuples in numeric_columns + text_columns order."""
+        if not batch:
+            return
+        self.rows += len(batch)
+        columns = list(zip(*batch))
+        width = len(self.numeric_columns)
+        for column, values in zip(self.numeric_columns, columns[:width]):
+            numbers = pd.to_numeric(pd.Series(values), errors="coerce").to_numpy(dtype=np.float64)
+            numbers = numbers[~np.isnan(numbers)]
+            self.moments[column].update(numbers)
+            self.sketches[column].update(numbers)
+        for column, values in zip(self.text_columns, columns[width:]):
+            present = np.array([v for v in values if v is not None], dtype=object)
+            self.distinct[column].update(present)
+            self.hitters[column].update(present)
+
+    def profile(self):
+        profile = {"row_count": self.rows, "numeric": {}, "text": {}, "approximate": True}
+        for column in self.numeric_columns:
+            moments, sketch = self.moments[column], self.sketches[column]
+            if not moments.count:
+                continue
+            stats = {
+                "count": moments.count,
+                "mean": moments.mean,
+                "std": moments.std(),
+                "min": moments.min,
+                "max": moments.max,
+                "sum": moments.total,
+                "median": sketch.quantile(0.5),
+            }
+            if column in self.percentile_columns:
+                stats["percentiles"] = {f"p{p}": sketch.quantile(p / 100) for p in self.percentiles}
+            profile["numeric"][column] = stats
+        for column in self.text_columns:
+            top = self.hitters[column].top()
+            profile["text"][column] = {
+                "unique_count": self.distinct[column].estimate(),
+                "unique_approximate": self.distinct[column].approximate,
+                "top_value": str(top[0][0]) if top else "N/A",
+                "top_values": [[str(value), count] for value, count in top],
+            }
+        return profile
+
+
+def stream_profile(sql: str, numeric_columns, text_columns, params=None, target_engine=None,
+                   timeout: float = None, percentile_columns=(), percentiles=()):
+    """
+    Profile the full result of `sql` in one pass over the cursor, a batch at
+    a time, keeping only the sketches. Returns None if the query fails or
+    runs past `timeout` seconds.
+    """
+    columns = list(numeric_columns) + list(text_columns)
+    if not columns:
+        return None
+    statement = (
+        f"SELECT {', '.join(quote_identifier(c) for c in columns)} FROM ({validate_sql(sql)})"
+    )
+    profiler = StreamingProfiler(numeric_columns, text_columns, percentile_columns, percentiles)
+    started = time.monotonic()
+    deadline = started + timeout if timeout else math.inf
+
+    raw = (target_engine or read_engine).raw_connection()
+    conn = raw.driver_connection
+    conn.set_progress_handler(lambda: 1 if time.monotonic() > deadline else 0, PROGRESS_HANDLER_OPS)
+    try:
+        cursor = conn.execute(statement, params or {})
+        while True:
+            batch = cursor.fetchmany(FETCH_BATCH_ROWS)
+            if not batch:
+                break
+            profiler.update(batch)
+            if time.monotonic() > deadline:
+                raise sqlite3.OperationalError("interrupted")
+        cursor.close()
+    except sqlite3.Error as e:
+        print(f"⚠️ Streaming statistics failed after {profiler.rows:,} rows: {e}")
+        return None
+    finally:
+        conn.set_progress_handler(None, 0)
+        raw.close()
+
+    print(f"🌊 Streamed statistics over {profiler.rows:,} rows ({time.monotonic() - started:.2f}s)")
+    return profiler.profile()
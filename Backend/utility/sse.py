@@ -0,0 +1,116 @@
+# utility/sse.py
+import asyncio
+import json
+import os
+import time
+
+# Tokens arriving within this window of the first one go out in the same frame
+SSE_FLUSH_MS = int(os.getenv("SSE_FLUSH_MS", "40"))
+# A frame is sent early once it holds this many characters
+SSE_MAX_FRAME_CHARS = int(os.getenv("SSE_MAX_FRAME_CHARS", "512"))
+# Comment line sent when nothing else has gone out for this long, so proxies keep the connection
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+# Items read ahead of a slow client; when full the upstream (the LLM stream) is not read further
+SSE_MAX_PENDING_ITEMS = int(os.getenv("SSE_MAX_PENDING_ITEMS", "256"))
+
+HEARTBEAT_FRAME = ": ping\n\n"
+
+_END = object()
+
+
+def sse_event(payload: dict) -> str:
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+class TextBuffer:
+    """Streamed text collected as a list of pieces, joined once at the end."""
+
+    def __init__(self):
+        self.parts = []
+        self.chars = 0
+
+    def append(self, piece: str):
+        self.parts.append(piece)
+        self.chars += len(piece)
+
+    def text(self) -> str:
+        if len(self.parts) > 1:
+            self.parts = ["".join(self.parts)]
+        return self.parts[0] if self.parts else ""
+
+
+async def coalesce_tokens(items, flush_ms: int = SSE_FLUSH_MS, max_chars: int = SSE_MAX_FRAME_CHARS,
+                          heartbeat_seconds: float = SSE_HEARTBEAT_SECONDS,
+                          max_pending: int = SSE_MAX_PENDING_ITEMS):
+    """
+    Re-yield (kind, item) pairs from the async iterator `items`, merging runs
+    of ("token", text) into one token per flush window or `max_chars`.
+    Other kinds pass through in order, after any tokens before them.
+    ("heartbeat", None) is yielded when nothing arrived for `heartbeat_seconds`.
+
+    A reader task runs ahead of the caller by at most `max_pending` items.
+    While the client is slow to take frames, tokens pile up there and go
+    out together in the next frame; once the queue is full the reader stops
+    pulling from `items`, so a stalled client also pauses the model stream.
+    The first token is sent at once so time-to-first-token is unchanged.
+    """
+    queue = asyncio.Queue(maxsize=max(1, max_pending))
+
+    async def read():
+        try:
+            async for item in items:
+                await queue.put(item)
+            await queue.put((_END, None))
+        except Exception as e:
+            await queue.put((_END, e))
+
+    reader = asyncio.ensure_future(read())
+    window = flush_ms / 1000
+    first_token = True
+    held = None  # a non-token item read while filling a frame
+    try:
+        while True:
+            if held is not None:
+                kind, item = held
+                held = None
+            else:
+                try:
+                    kind, item = await asyncio.wait_for(queue.get(), heartbeat_seconds)
+                except asyncio.TimeoutError:
+                    yield "heartbeat", None
+                    continue
+
+            if kind is _END:
+                if item is not None:
+                    raise item
+                return
+            if kind != "token":
+                yield kind, item
+                continue
+            if first_token:
+                first_token = False
+                yield "token", item
+                continue
+
+            parts, size = [item], len(item)
+            deadline = time.monotonic() + window
+            while size < max_chars:
+                if queue.empty():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        next_item = await asyncio.wait_for(queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    next_item = queue.get_nowait()
+                if next_item[0] != "token":
+                    held = next_item
+                    break
+                parts.append(next_item[1])
+                size += len(next_item[1])
+            yield "token", "".join(parts)
+    finally:
+        if not reader.done():
+            reader.cancel()
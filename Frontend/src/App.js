@@ -349,6 +349,7 @@ export default function CustomsAnalysisPlatform() {
   const [validationError, setValidationError] = useState(null);
   const [sidebarOpen, setSidebarOpen] = useState(true);
   const [apiConnected, setApiConnected] = useState(false);
+  const [uploadProgress, setUploadProgress] = useState(null);
   const messagesEndRef = useRef(null);
   const fileInputRef = useRef(null);
   const [visualizationModal, setVisualizationModal] = useState({
@@ -381,6 +382,28 @@ export default function CustomsAnalysisPlatform() {
     }
   };
 
+  // Uploads are ingested in the background; poll the job until it finishes
+  const waitForIngestJob = async (jobId) => {
+    while (true) {
+      const response = await fetch(`${API_BASE_URL}/jobs/${jobId}`);
+      if (!response.ok) {
+        throw new Error('Lost track of the upload job');
+      }
+
+      const job = await response.json();
+      setUploadProgress(job);
+
+      if (job.status === 'done') {
+        return job.result;
+      }
+      if (job.status === 'failed') {
+        throw new Error(job.error || 'Failed to ingest file');
+      }
+
+      await new Promise((resolve) => setTimeout(resolve, 1000));
+    }
+  };
+
   const handleFileUpload = async (event) => {
     const file = event.target.files[0];
     if (!file) return;
@@ -404,11 +427,23 @@ export default function CustomsAnalysisPlatform() {
         return;
       }
 
-      const result = await response.json();
+      const accepted = await response.json();
+
+      let result;
+      try {
+        result = await waitForIngestJob(accepted.job_id);
+      } catch (jobError) {
+        setValidationError(jobError.message);
+        setUploadProgress(null);
+        setIsProcessing(false);
+        return;
+      }
+      setUploadProgress(null);
+
       const summary = result.summary;
       
       setUploadedFile(file);
-      setSessionId(result.session_id);
+      setSessionId(accepted.session_id);
 
       const welcomeMessage = {
         role: 'assistant',
@@ -421,6 +456,7 @@ export default function CustomsAnalysisPlatform() {
       setApiConnected(true);
     } catch (error) {
       setValidationError(`Network error: ${error.message}. Make sure backend is running.`);
+      setUploadProgress(null);
       setIsProcessing(false);
       setApiConnected(false);
     }
@@ -479,13 +515,16 @@ export default function CustomsAnalysisPlatform() {
       const decoder = new TextDecoder();
       let accumulatedContent = '';
       let metadata = null;
+      // A frame can arrive split across reads; keep the unfinished last line for the next read
+      let pending = '';
   
       while (true) {
         const { done, value } = await reader.read();
         if (done) break;
   
-        const chunk = decoder.decode(value, { stream: true });
+        const chunk = pending + decoder.decode(value, { stream: true });
         const lines = chunk.split('\n');
+        pending = lines.pop();
   
         for (const line of lines) {
           if (line.startsWith('data: ')) {
@@ -615,7 +654,7 @@ export default function CustomsAnalysisPlatform() {
             <input
               ref={fileInputRef}
               type="file"
-              accept=".xlsx,.xls"
+              accept=".xlsx,.xls,.csv"
               onChange={handleFileUpload}
               className="hidden"
               id="file-upload"
@@ -656,6 +695,18 @@ export default function CustomsAnalysisPlatform() {
             </div>
           )}
 
+          {uploadProgress && (
+            <div className="mb-6 p-4 bg-blue-50 border border-blue-200 rounded-lg">
+              <p className="text-sm font-medium text-blue-800">
+                Processing upload: {uploadProgress.phase}
+              </p>
+              <p className="text-xs text-blue-600 mt-1">
+                {uploadProgress.rows_processed.toLocaleString()} rows
+                {uploadProgress.rows_per_second ? ` • ${Math.round(uploadProgress.rows_per_second).toLocaleString()} rows/s` : ''}
+              </p>
+            </div>
+          )}
+
           {validationError && (
             <div className="mb-6 p-4 bg-red-50 border border-red-200 rounded-lg">
               <div className="flex items-start">